@@ -17,3 +17,6 @@ login_manager.session_protection = "strong"
 
 
 from app import models, views
+from app.profiling import RequestProfiler
+
+profiler = RequestProfiler(app)
@@ -0,0 +1,397 @@
+"""
+File catalog of the backups of one Backup. The catalog records, for every
+path that was ever backed up, the increments it exists in and its size in
+each, so questions like "which night has this file" are answered without
+reading the repository.
+
+Each catalog is a SQLite database. A file that stays the same across
+increments is stored as one version spanning them, so a catalog grows with
+the changes between increments rather than with their number. Directories
+are catalogued like files, without a size, so any increment can be browsed
+one directory at a time.
+"""
+
+from __future__ import absolute_import
+from collections import OrderedDict
+import logging
+import os
+import sqlite3
+import threading
+
+from six.moves.urllib.parse import quote
+
+from app import app
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS increments (
+    id INTEGER PRIMARY KEY,
+    time REAL UNIQUE NOT NULL,
+    label TEXT,
+    source_files INTEGER,
+    source_bytes INTEGER,
+    growth_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS paths_parent ON paths (parent, name);
+CREATE TABLE IF NOT EXISTS versions (
+    path_id INTEGER NOT NULL,
+    first_increment INTEGER NOT NULL,
+    last_increment INTEGER,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path_id, last_increment);
+CREATE INDEX IF NOT EXISTS versions_open ON versions (last_increment);
+"""
+
+
+def catalog_for(backup_id, catalog_dir=None, create=True):
+    """
+    Returns the catalog of a backup, in catalog_dir. With create False the
+    catalog is opened read-only, and None is returned if it does not exist.
+    """
+    if catalog_dir is None:
+        catalog_dir = app.config['CATALOG_DIR']
+    path = os.path.join(catalog_dir, "{}.db".format(backup_id))
+    if not create and not os.path.exists(path):
+        return None
+    return Catalog(path, read_only=not create)
+
+
+def split_path(path):
+    """ Returns the (parent, name) of a relative path. """
+    parent, _, name = path.rpartition('/')
+    return parent, name
+
+
+class ListingCache(object):
+    """
+    Least recently used cache of directory listings. The listing of an
+    increment never changes, so entries are never stale.
+    """
+
+    def __init__(self, size):
+        """
+        size (int) - Most listings kept
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._listings = OrderedDict()
+
+    def get(self, key, load):
+        """
+        Returns the listing cached under key, calling load() to list the
+        directory if it is not cached.
+        """
+        with self._lock:
+            listing = self._listings.pop(key, None)
+            if listing is not None:
+                self._listings[key] = listing
+                return listing
+
+        listing = load()
+        with self._lock:
+            self._listings[key] = listing
+            while len(self._listings) > self.size:
+                self._listings.popitem(last=False)
+        return listing
+
+
+def update_catalog(backup_id, engine, catalog_dir=None):
+    """
+    Brings the catalog of a backup up to date with its repository. A
+    failure is only logged, as the catalog can catch up on the next run.
+
+    engine (AbstractBackupEngine) - Engine of the backup's repository
+    """
+    try:
+        catalog = catalog_for(backup_id, catalog_dir)
+    except Exception:
+        LOGGER.exception("Catalog: Failed to open the catalog of backup {}."
+                         .format(backup_id))
+        return
+    try:
+        added = catalog.update(engine)
+        if added:
+            LOGGER.info("Catalog: Added {} increments of backup {}."
+                        .format(added, backup_id))
+    except Exception:
+        LOGGER.exception("Catalog: Failed to update the catalog of backup "
+                         "{}.".format(backup_id))
+    finally:
+        catalog.close()
+
+
+class Catalog(object):
+    """
+    Catalog of the files in each increment of one Backup.
+    """
+
+    def __init__(self, path, read_only=False):
+        """
+        path (str) - SQLite database of the catalog, created if missing
+        read_only (bool) - Whether to open an existing catalog for reading
+            only, without creating its tables
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        if read_only:
+            self._db = self._connect_read_only(path)
+            self.fts = self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'paths_fts'")\
+                .fetchone() is not None
+            return
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self.fts = self._create_fts()
+
+    @staticmethod
+    def _connect_read_only(path):
+        """ Opens the database at path for reading only. """
+        try:
+            return sqlite3.connect("file:{}?mode=ro".format(quote(path)),
+                                   uri=True, check_same_thread=False)
+        except TypeError:
+            # Python 2 opens no URI filenames, so writes are refused instead
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA query_only = ON")
+            return db
+
+    def _create_fts(self):
+        """ Creates the full-text index of paths, if SQLite has FTS4. """
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS paths_fts "
+                             "USING fts4(path)")
+            return True
+        except sqlite3.OperationalError:
+            LOGGER.warning("Catalog: SQLite has no FTS4, searching {} "
+                           "without an index.".format(self.path))
+            return False
+
+    def close(self):
+        self._db.close()
+
+    def increments(self):
+        """ Returns the times of the catalogued increments, oldest first. """
+        with self._lock:
+            rows = self._db.execute("SELECT time FROM increments "
+                                    "ORDER BY time")
+            return [time for (time,) in rows]
+
+    def update(self, engine):
+        """
+        Adds the increments of a repository newer than the catalogued ones,
+        and forgets the ones pruned from it. The file listing of each
+        increment comes from the metadata the engine keeps, so increments
+        without a kept listing are skipped.
+
+        engine (AbstractBackupEngine) - Engine of the repository
+        Returns the number of increments added.
+        """
+        increments = engine.increments()
+        if not increments:
+            return 0
+        self.remove_before(increments[0][0])
+
+        catalogued = self.increments()
+        latest = catalogued[-1] if catalogued else None
+        added = 0
+        for time, label in increments:
+            if latest is not None and time <= latest:
+                continue
+            entries = engine.listing(label)
+            if entries is None:
+                continue
+            if self.add_increment(time, entries, label=label,
+                                  statistics=engine.statistics(label)):
+                added += 1
+        return added
+
+    def add_increment(self, time, entries, label=None, statistics=None):
+        """
+        Adds an increment from the listing of every file in it. Increments
+        older than the latest catalogued one are ignored.
+
+        time (float) - Time of the increment in seconds since the epoch
+        entries (iterable) - (path, size, mtime) of each file and
+            directory, with a size of None for directories
+        label (str) - Name of the increment in the repository
+        statistics (dict) - rdiff-backup session statistics
+        Returns True if the increment was added.
+        """
+        statistics = statistics or {}
+        with self._lock:
+            db = self._db
+            latest = db.execute("SELECT MAX(time), MAX(id) FROM increments")\
+                .fetchone()
+            if latest[0] is not None and time <= latest[0]:
+                return False
+            previous = latest[1]
+
+            try:
+                db.execute("CREATE TEMP TABLE IF NOT EXISTS listing "
+                           "(path TEXT PRIMARY KEY, size INTEGER, "
+                           "mtime REAL, parent TEXT, name TEXT)")
+                db.execute("DELETE FROM listing")
+                db.executemany("INSERT OR REPLACE INTO listing VALUES "
+                               "(?, ?, ?, ?, ?)",
+                               ((path, size, mtime) + split_path(path)
+                                for path, size, mtime in entries))
+
+                cursor = db.execute(
+                    "INSERT INTO increments (time, label, source_files, "
+                    "source_bytes, growth_bytes) VALUES (?, ?, ?, ?, ?)",
+                    (time, label, statistics.get('SourceFiles'),
+                     statistics.get('SourceFileSize'),
+                     statistics.get('TotalDestinationSizeChange')))
+                increment = cursor.lastrowid
+
+                max_path = db.execute("SELECT COALESCE(MAX(id), 0) "
+                                      "FROM paths").fetchone()[0]
+                db.execute("INSERT OR IGNORE INTO paths (path, parent, name) "
+                           "SELECT path, parent, name FROM listing")
+                if self.fts:
+                    db.execute("INSERT INTO paths_fts (docid, path) "
+                               "SELECT id, path FROM paths WHERE id > ?",
+                               (max_path,))
+
+                # Versions that changed or are gone end with the previous
+                # increment
+                db.execute(
+                    "UPDATE versions SET last_increment = ? "
+                    "WHERE last_increment IS NULL AND NOT EXISTS ("
+                    "  SELECT 1 FROM listing JOIN paths "
+                    "  ON paths.path = listing.path "
+                    "  WHERE paths.id = versions.path_id "
+                    "  AND listing.size IS versions.size "
+                    "  AND listing.mtime IS versions.mtime)", (previous,))
+                db.execute(
+                    "INSERT INTO versions (path_id, first_increment, "
+                    "last_increment, size, mtime) "
+                    "SELECT paths.id, ?, NULL, listing.size, listing.mtime "
+                    "FROM listing JOIN paths ON paths.path = listing.path "
+                    "WHERE NOT EXISTS (SELECT 1 FROM versions "
+                    "  WHERE versions.path_id = paths.id "
+                    "  AND versions.last_increment IS NULL)", (increment,))
+                db.execute("DELETE FROM listing")
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return True
+
+    def remove_before(self, time):
+        """
+        Forgets the increments older than time, as they have been pruned
+        from the repository.
+        """
+        with self._lock:
+            db = self._db
+            try:
+                oldest = db.execute("SELECT MIN(id) FROM increments "
+                                    "WHERE time >= ?", (time,)).fetchone()[0]
+                if oldest is None:
+                    return
+                db.execute("DELETE FROM versions WHERE last_increment < ?",
+                           (oldest,))
+                db.execute("DELETE FROM increments WHERE id < ?", (oldest,))
+                # Paths no increment holds any more are no longer found
+                if self.fts:
+                    db.execute("DELETE FROM paths_fts WHERE docid IN ("
+                               "SELECT id FROM paths WHERE NOT EXISTS ("
+                               "SELECT 1 FROM versions "
+                               "WHERE versions.path_id = paths.id))")
+                db.execute("DELETE FROM paths WHERE NOT EXISTS ("
+                           "SELECT 1 FROM versions "
+                           "WHERE versions.path_id = paths.id)")
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+    def restore_points(self):
+        """
+        Returns the (id, time, label) of each catalogued increment, newest
+        first.
+        """
+        with self._lock:
+            return list(self._db.execute("SELECT id, time, label "
+                                         "FROM increments ORDER BY time DESC"))
+
+    def list_directory(self, increment, directory='', after='', limit=100):
+        """
+        Returns one page of the entries of a directory in an increment, by
+        name. Pages are found through the index of names, so a page of a
+        large directory costs no more to list than a small directory.
+
+        increment (int) - Id of the increment
+        directory (str) - Relative path of the directory, '' for the root
+        after (str) - Name after which the page starts, '' for the first
+        limit (int) - Most entries in the page
+        Returns a list of (name, size, mtime), with a size of None for
+        directories.
+        """
+        with self._lock:
+            return list(self._db.execute(
+                "SELECT paths.name, versions.size, versions.mtime "
+                "FROM paths JOIN versions ON versions.path_id = paths.id "
+                "WHERE paths.parent = ? AND paths.name > ? "
+                "AND versions.first_increment <= ? "
+                "AND (versions.last_increment IS NULL "
+                "     OR versions.last_increment >= ?) "
+                "ORDER BY paths.name LIMIT ?",
+                (directory, after, increment, increment, limit)))
+
+    def search(self, pattern, limit=100):
+        """
+        Returns up to limit catalogued paths matching pattern, a word or
+        word prefix of the path with the full-text index, else a substring.
+        """
+        with self._lock:
+            if self.fts:
+                query = " ".join('"{}*"'.format(word.replace('"', ''))
+                                 for word in pattern.split())
+                rows = self._db.execute(
+                    "SELECT paths.path FROM paths_fts "
+                    "JOIN paths ON paths.id = paths_fts.docid "
+                    "WHERE paths_fts.path MATCH ? ORDER BY paths.path "
+                    "LIMIT ?", (query, limit))
+            else:
+                rows = self._db.execute(
+                    "SELECT path FROM paths WHERE path LIKE ? "
+                    "ORDER BY path LIMIT ?",
+                    ('%{}%'.format(pattern), limit))
+            return [path for (path,) in rows]
+
+    def history(self, path):
+        """
+        Returns the (increment time, size, mtime) of every increment that
+        holds path, oldest first.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT increments.time, versions.size, versions.mtime "
+                "FROM paths JOIN versions ON versions.path_id = paths.id "
+                "JOIN increments ON increments.id >= versions.first_increment "
+                "AND (versions.last_increment IS NULL "
+                "     OR increments.id <= versions.last_increment) "
+                "WHERE paths.path = ? ORDER BY increments.time", (path,))
+            return list(rows)
@@ -1,4 +1,6 @@
 from __future__ import absolute_import
+import posixpath
+
 from flask.ext.bcrypt import Bcrypt
 from flask.ext.wtf import Form
 from wtforms import BooleanField, IntegerField, PasswordField, SelectField,\
@@ -65,6 +67,40 @@ class BackupForm(Form):
                     validators=[validators.DataRequired(),
                                 validators.NumberRange(min=1, max=10957)])
 
+    shards = IntegerField('Parallel Streams', default=1,
+                    validators=[validators.Optional(),
+                                validators.NumberRange(min=1, max=32)])
+
+    engine = SelectField(choices=[(1, 'rdiff-backup'), (2, 'Deduplicated'),
+                                  (3, 'Block delta')],
+                         coerce=int, default=1)
+
+
+def inside_share(form, field):
+    """ Validates that a path does not leave the root of the share. """
+    path = posixpath.normpath(field.data.strip('/') or '.')
+    if path == '..' or path.startswith('../'):
+        raise validators.ValidationError('Path is outside of the share.')
+
+
+class RestoreForm(Form):
+    """
+    Form for requesting a restore. The backup choices are set by the view.
+    """
+    backup = SelectField(coerce=int)
+
+    path = StringField('path', default='/',
+                       validators=[validators.DataRequired(),
+                                   validators.Length(min=1, max=4096),
+                                   inside_share])
+
+    time_format = StringField('time_format', default='now',
+                    validators=[validators.DataRequired(),
+                                validators.Length(min=1, max=64),
+                                validators.Regexp(
+                                    r'^[0-9A-Za-z][0-9A-Za-z:/+-]*$',
+                                    message='Invalid point in time.')])
+
 
 class EditAccountForm(Form):
     """
@@ -77,6 +113,13 @@ class EditAccountForm(Form):
                                     validators=[validators.DataRequired()])
 
 
+class CancelBackupForm(Form):
+    """
+    Form for cancelling a running backup.
+    """
+    pass
+
+
 class DeleteBackupForm(Form):
     """
     Form for deleting a backup.
@@ -0,0 +1,312 @@
+"""
+Metrics of the appliance in the Prometheus text exposition format.
+
+Metrics are counters, gauges and histograms kept up to date in memory by the
+code they measure, so rendering them never touches the database. The web app
+and the backup runner are separate processes: the runner writes its metrics
+to RUNNER_METRICS_FILE every few seconds, and the web app's /metrics
+endpoint serves its own metrics followed by the contents of that file.
+"""
+from __future__ import absolute_import
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from app import app
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class Registry(object):
+    """ A set of metrics rendered together. """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format. """
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+class _Metric(object):
+    """ A metric with a value for each combination of its label values. """
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        """
+        name (str) - Name of the metric
+        help (str) - One-line description of the metric
+        labels (tuple) - Names of the labels the values are split by
+        registry (Registry) - Registry to render the metric with
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        # A metric without labels is rendered before anything is recorded
+        if not self.labels:
+            self._values[()] = self._initial()
+        if registry is not None:
+            registry.register(self)
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{} takes the labels {}."\
+                .format(self.name, ', '.join(self.labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                              for name, value in pairs) + '}'
+
+    def render(self):
+        lines = ['# HELP {} {}\n'.format(self.name, self.help),
+                 '# TYPE {} {}\n'.format(self.name, self.kind)]
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._render_value(key, self._values[key]))
+        return ''.join(lines)
+
+    def _render_value(self, key, value):
+        return ['{}{} {}\n'.format(self.name, self._label_text(key),
+                                   _format(value))]
+
+
+class Counter(_Metric):
+    """ A count that only goes up. """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """ A value that goes up and down. """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """ Observations counted in buckets by their upper bounds. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=(), registry=None):
+        """
+        buckets (list) - Upper bounds of the buckets, in increasing order.
+            A bucket for any value is added.
+        """
+        self.buckets = list(buckets)
+        super(Histogram, self).__init__(name, help, labels, registry)
+
+    def _initial(self):
+        return [0] * (len(self.buckets) + 1), 0
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or self._initial()
+            # Each observation is counted in the first bucket it fits in,
+            # and the buckets are summed up when rendered
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}\n'.format(
+                self.name, self._label_text(key, [('le', _format(bound))]),
+                cumulative))
+        lines.append('{}_sum{} {}\n'.format(self.name, self._label_text(key),
+                                            _format(total)))
+        lines.append('{}_count{} {}\n'.format(self.name,
+                                              self._label_text(key),
+                                              cumulative))
+        return lines
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+class MetricsWriter(object):
+    """
+    MetricsWriter writes the metrics of a registry to a file at a regular
+    interval, for the web app to serve.
+    """
+
+    def __init__(self, registry, path, interval=15, collect=None):
+        """
+        registry (Registry) - Metrics to write
+        path (str) - File to write the metrics to
+        interval (int) - Seconds between writes
+        collect (callable) - Called before each write to update gauges
+        """
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.collect = collect
+
+        self._thread = threading.Thread(target=self._write_loop,
+                                        name="metrics-writer")
+        self._thread.daemon = True
+
+    def start(self):
+        """ Starts writing the metrics in the background. """
+        self._thread.start()
+
+    def write(self):
+        """ Writes the metrics, replacing the file atomically. """
+        if self.collect is not None:
+            self.collect()
+        text = self.registry.render()
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as temp:
+                temp.write(text)
+            # The web app may run as a different user than the runner
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _write_loop(self):
+        while True:
+            try:
+                self.write()
+            except Exception:
+                LOGGER.exception("Metrics: Failed to write {}."\
+                    .format(self.path))
+            time.sleep(self.interval)
+
+
+def read_runner_metrics(path=None, max_age=None):
+    """
+    Returns the metrics last written by the runner, or '' if the runner has
+    not written them within max_age seconds.
+    """
+    if path is None:
+        path = app.config['RUNNER_METRICS_FILE']
+    if max_age is None:
+        max_age = 3 * app.config['METRICS_INTERVAL']
+    try:
+        if time.time() - os.stat(path).st_mtime > max_age:
+            return ''
+        with open(path) as metrics:
+            return metrics.read()
+    except (IOError, OSError):
+        return ''
+
+
+# Buckets of durations, in seconds, from sub-second to days
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60]
+JOB_SECONDS_BUCKETS = [60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600,
+                       8 * 3600, 24 * 3600, 3 * 24 * 3600]
+LAG_SECONDS_BUCKETS = [1, 5, 15, 60, 300, 900, 3600, 4 * 3600]
+THROUGHPUT_BUCKETS = [1024 ** 2 * rate for rate in
+                      (0.1, 1, 5, 10, 25, 50, 100, 250, 500)]
+
+
+# Metrics of the web app
+web = Registry()
+
+http_request_seconds = Histogram(
+    'storagebright_http_request_duration_seconds',
+    'Seconds taken to handle HTTP requests.', SECONDS_BUCKETS,
+    labels=('method', 'endpoint', 'status'), registry=web)
+http_request_queries = Histogram(
+    'storagebright_http_request_queries',
+    'SQL queries run by HTTP requests, while requests are profiled.',
+    [1, 2, 5, 10, 25, 50, 100, 250, 1000], labels=('endpoint',),
+    registry=web)
+runner_up = Gauge(
+    'storagebright_runner_up',
+    '1 if the backup runner has written its metrics recently.',
+    registry=web)
+
+
+# Metrics of the backup runner
+runner = Registry()
+
+jobs_queued = Gauge(
+    'storagebright_jobs_queued',
+    'Jobs waiting for a free worker.', labels=('kind',), registry=runner)
+jobs_running = Gauge(
+    'storagebright_jobs_running',
+    'Jobs running on a worker.', labels=('kind',), registry=runner)
+backups_due = Gauge(
+    'storagebright_backups_due',
+    'Backups past their start time that have not started yet.',
+    registry=runner)
+scheduler_lag_seconds = Histogram(
+    'storagebright_scheduler_lag_seconds',
+    'Seconds from the time a backup was due to the time it started.',
+    LAG_SECONDS_BUCKETS, registry=runner)
+backup_duration_seconds = Histogram(
+    'storagebright_backup_duration_seconds',
+    'Seconds taken by backup runs, by backup id.', JOB_SECONDS_BUCKETS,
+    labels=('backup', 'status'), registry=runner)
+backup_throughput_bytes = Histogram(
+    'storagebright_backup_throughput_bytes_per_second',
+    'Bytes backed up per second by finished backup runs.',
+    THROUGHPUT_BUCKETS, registry=runner)
+mount_seconds = Histogram(
+    'storagebright_mount_duration_seconds',
+    'Seconds taken to mount shares.', SECONDS_BUCKETS,
+    labels=('result',), registry=runner)
+mounts_active = Gauge(
+    'storagebright_mounts',
+    'Shares mounted by the mount pool.', registry=runner)
+repository_bytes = Gauge(
+    'storagebright_repository_bytes',
+    'Bytes in the repository of each backup, by backup id, measured after '
+    'it is backed up or pruned. Chunks shared by deduplicating backups are '
+    'not counted.', labels=('backup',), registry=runner)
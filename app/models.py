@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 import datetime
 
+from sqlalchemy import or_
+
 from app import bcrypt
 from app import db
 
@@ -45,11 +47,23 @@ class Backup(db.Model):
         FINISHED = 2
         ERROR = 3
         NEVER_STARTED = 4
+        CANCELLED = 5
 
     class PROTOCOL():
         """ Enumeration of backup server protocols. """
         SMB = 1
 
+    class ENGINE():
+        """ Enumeration of backup engines. """
+        RDIFF = 1
+        DEDUP = 2
+        DELTA = 3
+
+    class VERIFY():
+        """ Enumeration of verification results. """
+        PASSED = 1
+        FAILED = 2
+
     class INTERVAL():
         """ Enumeration of backup intervals. """
         DAILY = 1
@@ -71,7 +85,9 @@ class Backup(db.Model):
 
     enabled = db.Column(db.Boolean, default=True)
     # True if the backup should start now
-    start_now = db.Column(db.Boolean, default=False)
+    start_now = db.Column(db.Boolean, default=False, index=True)
+    # True if the running backup should be cancelled
+    cancel_requested = db.Column(db.Boolean, default=False, index=True)
 
     server = db.Column(db.String(256))
     port = db.Column(db.Integer)
@@ -86,14 +102,37 @@ class Backup(db.Model):
     # Interval based on INTERVAL enumeration
     interval = db.Column(db.Integer)
     last_backup = db.Column(db.DateTime)
+    # Next scheduled start of the backup job, None if not scheduled
+    next_run_at = db.Column(db.DateTime, index=True)
     # Days to keep backups
     retention = db.Column(db.Integer)
+    # Number of shards the share is split into, each backed up in parallel
+    # into its own repository
+    shards = db.Column(db.Integer, default=1)
+    # Engine based on ENGINE enumeration
+    engine = db.Column(db.Integer, default=1)
+    # Last time increments older than retention were removed, and the bytes
+    # that removing them freed
+    last_pruned = db.Column(db.DateTime, index=True)
+    pruned_bytes = db.Column(db.BigInteger)
+    # Next scheduled verification of the stored backups, None if never
+    # verified, and the result of the last one
+    next_verify_at = db.Column(db.DateTime, index=True)
+    last_verified = db.Column(db.DateTime)
+    verify_status = db.Column(db.Integer)
+    verify_message = db.Column(db.String(512))
 
     status = db.Column(db.Integer)
     error_message = db.Column(db.String(512))
 
+    # Runner currently holding the job and when its lease runs out. A runner
+    # must hold the lease while it runs the job.
+    lease_owner = db.Column(db.String(256))
+    lease_expires = db.Column(db.DateTime, index=True)
+
     def __init__(self, name, server, port, protocol, location, username,
-                 password, start_day, start_time, interval, retention):
+                 password, start_day, start_time, interval, retention,
+                 shards=1, engine=1):
         self.name = name
 
         self.server = server
@@ -107,10 +146,136 @@ class Backup(db.Model):
         self.start_time = start_time
         self.interval = interval
         self.retention = retention
+        self.shards = shards
+        self.engine = engine
 
         # Default properties of a new Backup
         self.status = self.STATUS.NEVER_STARTED
         self.error_message = ''
+        self.schedule_next_run()
+
+    def next_run_after(self, now):
+        """
+        Returns the first scheduled start of the backup job after now, or
+        None if the job has no valid schedule.
+        """
+        if self.start_time is None:
+            return None
+        hour = self.start_time % 24
+        start = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+
+        if self.interval == self.INTERVAL.DAILY:
+            if start <= now:
+                start += datetime.timedelta(days=1)
+            return start
+
+        if self.start_day is None:
+            return None
+        # DAY starts at SUNDAY = 1, datetime.weekday() at Monday = 0
+        weekday = (self.start_day - 2) % 7
+
+        if self.interval == self.INTERVAL.WEEKLY:
+            start += datetime.timedelta(days=(weekday - start.weekday()) % 7)
+            if start <= now:
+                start += datetime.timedelta(days=7)
+            return start
+
+        if self.interval == self.INTERVAL.MONTHLY:
+            # Monthly backups run on the first start_day of the month
+            start = _first_weekday_of_month(now.year, now.month, weekday,
+                                            hour)
+            if start <= now:
+                if now.month == 12:
+                    start = _first_weekday_of_month(now.year + 1, 1,
+                                                    weekday, hour)
+                else:
+                    start = _first_weekday_of_month(now.year, now.month + 1,
+                                                    weekday, hour)
+            return start
+
+        return None
+
+    def schedule_next_run(self, now=None):
+        """ Sets next_run_at to the next scheduled start of the job. """
+        if now is None:
+            now = datetime.datetime.now()
+        if self.enabled is False:
+            self.next_run_at = None
+        else:
+            self.next_run_at = self.next_run_after(now)
+
+    def is_due(self, now):
+        """ Returns True if the backup job should run at the given time. """
+        if self.enabled is False:
+            return False
+        if self.start_now:
+            return True
+        if self.next_run_at is not None and self.next_run_at <= now:
+            return True
+        if self.lease_expired(now):
+            # The runner that started the job has died
+            return True
+        return False
+
+    @property
+    def has_backups(self):
+        """
+        Returns True once a backup run has started, so the repository may
+        hold backups laid out for the backup's shards and engine.
+        """
+        return self.last_backup is not None or \
+            self.runs.first() is not None
+
+    def lease_expired(self, now):
+        """ Returns True if the job is running under an expired lease. """
+        if self.status != self.STATUS.RUNNING:
+            return False
+        if self.lease_expires is None:
+            return False
+        return self.lease_expires < now
+
+    @classmethod
+    def claim(cls, backup_id, owner, ttl, now=None):
+        """
+        Atomically claims the lease of a backup job for ttl seconds. The lease
+        can be claimed if it is free, expired or already held by owner.
+
+        Returns True if the lease was claimed.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=ttl)
+
+        claimed = cls.query.filter(cls.id == backup_id)\
+            .filter(or_(cls.lease_owner == None,
+                        cls.lease_owner == owner,
+                        cls.lease_expires < now))\
+            .update({'lease_owner': owner, 'lease_expires': expires},
+                    synchronize_session=False)
+        return claimed == 1
+
+    @classmethod
+    def renew_leases(cls, backup_ids, owner, ttl, now=None):
+        """
+        Extends the leases held by owner for another ttl seconds.
+
+        Returns the number of leases that were renewed.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=ttl)
+
+        return cls.query.filter(cls.id.in_(backup_ids))\
+            .filter(cls.lease_owner == owner)\
+            .update({'lease_expires': expires}, synchronize_session=False)
+
+    @classmethod
+    def release(cls, backup_id, owner):
+        """ Releases the lease of a backup job held by owner. """
+        cls.query.filter(cls.id == backup_id)\
+            .filter(cls.lease_owner == owner)\
+            .update({'lease_owner': None, 'lease_expires': None},
+                    synchronize_session=False)
 
     def finished(self):
         """ Called when a backup has finished successfully. """
@@ -124,19 +289,331 @@ class Backup(db.Model):
         self.start_now = False
         self.status = self.STATUS.ERROR
         self.error_message = error_message
+        self.schedule_next_run()
+
+    def cancelled(self, reason):
+        """ Called when a running backup has been cancelled. """
+        self.start_now = False
+        self.cancel_requested = False
+        self.status = self.STATUS.CANCELLED
+        self.error_message = reason
+        self.schedule_next_run()
+
+    def pruned(self, reclaimed_bytes):
+        """ Called when old increments of a backup have been removed. """
+        self.last_pruned = datetime.datetime.now()
+        self.pruned_bytes = reclaimed_bytes
+
+    def verify_due(self, now):
+        """ Returns True if the stored backups should be verified. """
+        return self.next_verify_at is None or self.next_verify_at <= now
+
+    def verified(self, checked, sampled, failures, interval):
+        """
+        Called when the stored backups have been verified.
+
+        checked (int) - Files or chunks hashed and compared
+        sampled (int) - Files restored and compared
+        failures (list) - Descriptions of what did not match
+        interval (int) - Seconds until the next verification
+        """
+        now = datetime.datetime.now()
+        self.last_verified = now
+        self.next_verify_at = now + datetime.timedelta(seconds=interval)
+        if failures:
+            self.verify_status = self.VERIFY.FAILED
+            message = "{} of {} checked and {} restored failed: {}".format(
+                len(failures), checked, sampled, "; ".join(failures))
+        else:
+            self.verify_status = self.VERIFY.PASSED
+            message = "{} checked and {} restored.".format(checked, sampled)
+        self.verify_message = message[:512]
 
     def started(self):
         """ Called when a backup has started. """
         self.start_now = False
+        self.cancel_requested = False
         self.status = self.STATUS.RUNNING
         self.error_message = ''
+        self.schedule_next_run()
 
     @property
     def should_start(self):
         """ Returns True if the backup job should run now. """
-        if self.start_now:
-            return True
-        return False
+        return self.is_due(datetime.datetime.now())
 
     def __repr__(self):
         return '<Backup %r>' % (self.name)
+
+
+class Restore(db.Model):
+    """
+    Restore model that represents a requested restore of a path from a
+    backup.
+    """
+
+    class STATUS():
+        """ Enumeration of restore status. """
+        QUEUED = 1
+        RUNNING = 2
+        FINISHED = 3
+        ERROR = 4
+        CANCELLED = 5
+
+    id = db.Column(db.Integer, primary_key=True)
+    backup_id = db.Column(db.Integer, db.ForeignKey('backup.id'), index=True)
+    backup = db.relationship('Backup', backref=db.backref(
+        'restores', lazy='dynamic', cascade='all, delete-orphan'))
+
+    # Path in the share to restore, and the point in time to restore it as
+    # of, in a format accepted by rdiff-backup such as "now" or "3D"
+    path = db.Column(db.String(4096))
+    time_format = db.Column(db.String(64))
+
+    status = db.Column(db.Integer, index=True)
+    error_message = db.Column(db.String(512))
+
+    requested_at = db.Column(db.DateTime, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Bytes restored so far and bytes to restore in total
+    bytes_done = db.Column(db.BigInteger)
+    bytes_total = db.Column(db.BigInteger)
+
+    def __init__(self, backup, path, time_format):
+        self.backup = backup
+        self.path = path
+        self.time_format = time_format
+
+        # Default properties of a new Restore
+        self.status = self.STATUS.QUEUED
+        self.error_message = ''
+        self.requested_at = datetime.datetime.now()
+
+    @property
+    def progress(self):
+        """ Returns the percent of the restore that is done. """
+        if self.status == self.STATUS.FINISHED:
+            return 100
+        if not self.bytes_total:
+            return 0
+        return min(100, 100 * (self.bytes_done or 0) // self.bytes_total)
+
+    def started(self):
+        """ Called when a restore has started. """
+        self.status = self.STATUS.RUNNING
+        self.started_at = datetime.datetime.now()
+        self.bytes_done = 0
+        self.bytes_total = None
+
+    def progressed(self, bytes_done, bytes_total):
+        """ Called as a running restore progresses. """
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+
+    def finished(self):
+        """ Called when a restore has finished successfully. """
+        self.status = self.STATUS.FINISHED
+        self.finished_at = datetime.datetime.now()
+        self.error_message = ''
+
+    def failed(self, error_message):
+        """ Called when a restore has failed. """
+        self.status = self.STATUS.ERROR
+        self.finished_at = datetime.datetime.now()
+        self.error_message = error_message[:512]
+
+    def cancelled(self, reason):
+        """ Called when a running restore has been cancelled. """
+        self.status = self.STATUS.CANCELLED
+        self.finished_at = datetime.datetime.now()
+        self.error_message = reason
+
+    def __repr__(self):
+        return '<Restore %r>' % (self.path)
+
+
+class BackupRun(db.Model):
+    """
+    BackupRun model that records one run of a backup job, so the history
+    of each job is kept rather than overwritten by the next run.
+    """
+
+    class STATUS():
+        """ Enumeration of run status. """
+        RUNNING = 1
+        FINISHED = 2
+        ERROR = 3
+        CANCELLED = 4
+
+    __table_args__ = (
+        db.Index('ix_backup_run_backup_id_started_at', 'backup_id',
+                 'started_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    backup_id = db.Column(db.Integer, db.ForeignKey('backup.id'))
+    backup = db.relationship('Backup', backref=db.backref(
+        'runs', lazy='dynamic', cascade='all, delete-orphan'))
+
+    status = db.Column(db.Integer)
+    error_message = db.Column(db.String(512))
+
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Seconds from start to finish
+    duration = db.Column(db.Float)
+
+    # Statistics of the run, from rdiff-backup's session statistics or the
+    # engine's equivalent. None where the engine does not record them.
+    source_files = db.Column(db.BigInteger)
+    source_bytes = db.Column(db.BigInteger)
+    changed_files = db.Column(db.BigInteger)
+    changed_bytes = db.Column(db.BigInteger)
+    increment_bytes = db.Column(db.BigInteger)
+    errors = db.Column(db.Integer)
+
+    def __init__(self, backup):
+        self.backup = backup
+
+        # Default properties of a new BackupRun
+        self.status = self.STATUS.RUNNING
+        self.error_message = ''
+        self.started_at = datetime.datetime.now()
+
+    @property
+    def throughput(self):
+        """ Returns the bytes backed up per second, or None if unknown. """
+        if not self.duration or self.changed_bytes is None:
+            return None
+        return self.changed_bytes / self.duration
+
+    def _ended(self, status):
+        self.status = status
+        self.finished_at = datetime.datetime.now()
+        self.duration = (self.finished_at - self.started_at).total_seconds()
+
+    def recorded(self, statistics):
+        """
+        Records the statistics of the run.
+
+        statistics (dict) - Numbers named as in rdiff-backup's session
+            statistics
+        """
+        self.source_files = statistics.get('SourceFiles')
+        self.source_bytes = statistics.get('SourceFileSize')
+        changed_files = [statistics.get(name) for name in
+                         ('NewFiles', 'ChangedFiles')]
+        if any(value is not None for value in changed_files):
+            self.changed_files = sum(value or 0 for value in changed_files)
+        changed_bytes = [statistics.get(name) for name in
+                         ('NewFileSize', 'ChangedSourceSize')]
+        if any(value is not None for value in changed_bytes):
+            self.changed_bytes = sum(value or 0 for value in changed_bytes)
+        self.increment_bytes = statistics.get('IncrementFileSize')
+        self.errors = statistics.get('Errors')
+
+    def finished(self, statistics=None):
+        """ Called when the run has finished successfully. """
+        self._ended(self.STATUS.FINISHED)
+        if statistics:
+            self.recorded(statistics)
+
+    def failed(self, error_message, statistics=None):
+        """ Called when the run has failed. """
+        self._ended(self.STATUS.ERROR)
+        self.error_message = error_message[:512]
+        if statistics:
+            self.recorded(statistics)
+
+    def cancelled(self, reason):
+        """ Called when the run has been cancelled. """
+        self._ended(self.STATUS.CANCELLED)
+        self.error_message = reason
+
+    def used(self, usages):
+        """
+        Records the resources used by the processes of the run.
+
+        usages (list) - ProcessUsage of each mount, umount and backup
+            process run
+        """
+        for usage in usages:
+            self.processes.append(BackupRunProcess(usage))
+
+    def _total(self, name):
+        values = [getattr(process, name) for process in self.processes
+                  if getattr(process, name) is not None]
+        return sum(values) if values else None
+
+    @property
+    def cpu_time(self):
+        """ Returns the user and system CPU seconds of the processes. """
+        user, system = self._total('user_time'), self._total('system_time')
+        if user is None and system is None:
+            return None
+        return (user or 0) + (system or 0)
+
+    @property
+    def read_chars(self):
+        """ Returns the bytes the processes read, including from shares. """
+        return self._total('read_chars')
+
+    @property
+    def write_bytes(self):
+        """ Returns the bytes the processes wrote to local disks. """
+        return self._total('write_bytes')
+
+    def __repr__(self):
+        return '<BackupRun %r>' % (self.id)
+
+
+class BackupRunProcess(db.Model):
+    """
+    BackupRunProcess model that records the resources used by one process
+    of a backup run, so a slow run can be told apart as bound by reading
+    the share, by CPU or by writing the backup.
+    """
+
+    # Fields copied from a ProcessUsage
+    FIELDS = ('program', 'started_at', 'exit_code', 'wall_time', 'user_time',
+              'system_time', 'max_rss', 'read_chars', 'write_chars',
+              'read_bytes', 'write_bytes')
+
+    id = db.Column(db.Integer, primary_key=True)
+    backup_run_id = db.Column(db.Integer, db.ForeignKey('backup_run.id'),
+                              index=True)
+    run = db.relationship('BackupRun', backref=db.backref(
+        'processes', cascade='all, delete-orphan',
+        order_by='BackupRunProcess.started_at'))
+
+    # Name of the program, without its arguments
+    program = db.Column(db.String(64))
+    started_at = db.Column(db.DateTime)
+    exit_code = db.Column(db.Integer)
+
+    # Seconds from start to exit, and of user and system CPU
+    wall_time = db.Column(db.Float)
+    user_time = db.Column(db.Float)
+    system_time = db.Column(db.Float)
+    # Peak resident set size in bytes
+    max_rss = db.Column(db.BigInteger)
+    # Bytes read and written, from /proc/<pid>/io. The chars count all I/O,
+    # including the share's, the bytes only the I/O of local disks.
+    read_chars = db.Column(db.BigInteger)
+    write_chars = db.Column(db.BigInteger)
+    read_bytes = db.Column(db.BigInteger)
+    write_bytes = db.Column(db.BigInteger)
+
+    def __init__(self, usage):
+        for name in self.FIELDS:
+            setattr(self, name, getattr(usage, name))
+
+    def __repr__(self):
+        return '<BackupRunProcess %r>' % (self.id)
+
+
+def _first_weekday_of_month(year, month, weekday, hour):
+    """ Returns the first given weekday of a month at the given hour. """
+    first = datetime.datetime(year, month, 1, hour)
+    return first + datetime.timedelta(days=(weekday - first.weekday()) % 7)
@@ -0,0 +1,154 @@
+"""
+Opt-in profiling of the web app's requests. With PROFILE_REQUESTS set, the
+total time, template render time, SQL query count and SQL time of every
+request are logged, and requests slower than SLOW_REQUEST_SECONDS are written
+to SLOW_REQUEST_LOG with the statements they ran.
+
+Statements run more than once with the same parameters by one request are
+counted as repeated, which points at views that load the same rows twice.
+"""
+from __future__ import absolute_import
+from collections import Counter
+import logging
+import time
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import metrics
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+SLOW_LOGGER = logging.getLogger(__name__ + '.slow')
+
+
+# Statements kept for the slow log of a request. Later statements are still
+# counted and timed.
+MAX_STATEMENTS = 500
+# Longest parameter list kept for a statement, in characters
+MAX_PARAMETERS = 200
+
+
+class RequestProfile(object):
+    """ Times and statements recorded for one request. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.template_time = 0.0
+        self.query_count = 0
+        self.sql_time = 0.0
+        # (seconds, statement, parameters) of the first MAX_STATEMENTS
+        self.statements = []
+        self._seen = Counter()
+
+    def query(self, seconds, statement, parameters):
+        self.query_count += 1
+        self.sql_time += seconds
+        parameters = repr(parameters)[:MAX_PARAMETERS]
+        self._seen[(statement, parameters)] += 1
+        if len(self.statements) < MAX_STATEMENTS:
+            self.statements.append((seconds, statement, parameters))
+
+    @property
+    def repeated(self):
+        """ Returns the number of statements that ran again unchanged. """
+        return sum(count - 1 for count in self._seen.values())
+
+    def summary(self, total):
+        return "{:.1f} ms, {} queries ({} repeated) in {:.1f} ms, " \
+               "templates {:.1f} ms".format(
+                   total * 1000, self.query_count, self.repeated,
+                   self.sql_time * 1000, self.template_time * 1000)
+
+
+class TimedTemplate(Template):
+    """ A template that adds its render time to the request's profile. """
+
+    def render(self, *args, **kwargs):
+        profile = _current_profile()
+        if profile is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        started = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            profile.template_time += time.time() - started
+
+
+class RequestProfiler(object):
+    """
+    RequestProfiler hooks into the app's requests, its templates and the
+    SQLAlchemy engines. It only records anything while the app's
+    PROFILE_REQUESTS is set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        # Templates rendered by included or extended templates are rendered
+        # as part of the template that includes them, so each page is timed
+        # once
+        app.jinja_env.template_class = TimedTemplate
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+
+        path = app.config.get('SLOW_REQUEST_LOG')
+        if path:
+            handler = logging.FileHandler(path, delay=True)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            SLOW_LOGGER.addHandler(handler)
+
+    def before_request(self):
+        if self.app.config.get('PROFILE_REQUESTS'):
+            g.profile = RequestProfile()
+
+    def after_request(self, response):
+        profile = getattr(g, 'profile', None)
+        if profile is None:
+            return response
+        g.profile = None
+
+        total = time.time() - profile.started
+        summary = profile.summary(total)
+        LOGGER.info("Request: {} {} {} in {}".format(
+            request.method, request.path, response.status_code, summary))
+        metrics.http_request_queries.observe(
+            profile.query_count, endpoint=request.endpoint or 'none')
+
+        if total >= self.app.config.get('SLOW_REQUEST_SECONDS', 1.0):
+            lines = ["{} {} {} in {}".format(request.method, request.path,
+                                             response.status_code, summary)]
+            for seconds, statement, parameters in profile.statements:
+                lines.append("  {:8.1f} ms  {} {}".format(
+                    seconds * 1000, ' '.join(statement.split()), parameters))
+            if profile.query_count > len(profile.statements):
+                lines.append("  ... {} more".format(
+                    profile.query_count - len(profile.statements)))
+            SLOW_LOGGER.warning('\n'.join(lines))
+        return response
+
+
+def _current_profile():
+    if not has_request_context():
+        return None
+    return getattr(g, 'profile', None)
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if _current_profile() is not None:
+        conn.info.setdefault('profile_started', []).append(time.time())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profile_started')
+    if not started:
+        return
+    seconds = time.time() - started.pop()
+    profile = _current_profile()
+    if profile is not None:
+        profile.query(seconds, statement, parameters)
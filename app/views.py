@@ -1,15 +1,19 @@
 from __future__ import absolute_import
+import datetime
+import time
 
-from flask import abort, flash, g, redirect, render_template, request,\
-    url_for
+from flask import Response, abort, flash, g, redirect, render_template, \
+    request, url_for
 from flask.ext.login import current_user, login_required, login_user, \
     logout_user
 
-from app import app, db, login_manager, bcrypt
-from app.forms import BackupForm, DeleteBackupForm, DisableBackupForm, \
-    EditAccountForm, EnableBackupForm, LoginChecker, LoginForm, \
-    StartBackupForm
-from app.models import Backup, User
+from app import app, db, login_manager, bcrypt, metrics
+from app.catalog import ListingCache, catalog_for
+from app.forms import BackupForm, CancelBackupForm, DeleteBackupForm, \
+    DisableBackupForm, EditAccountForm, EnableBackupForm, LoginChecker, \
+    LoginForm, RestoreForm, StartBackupForm
+from app.models import Backup, BackupRun, Restore, User
+from app.wakeup import notify_runner
 import ldap
 
 
@@ -22,6 +26,15 @@ LDAP_REQUIRED_GROUP = 'ou=IT Admins,dc=crunkcastle,dc=com'
 
 login_manager.login_view = 'login'
 
+# Directory pages recently listed by browse_backup
+listing_cache = ListingCache(app.config['BROWSE_CACHE_SIZE'])
+
+
+@app.template_filter('timestamp')
+def format_timestamp(seconds):
+    """Formats seconds since the epoch as a local date and time."""
+    return datetime.datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M')
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -56,10 +69,13 @@ def new_backup():
                             start_time=form.start_time.data,
                             start_day=form.start_day.data,
                             interval=form.interval.data,
-                            retention=form.retention.data)
+                            retention=form.retention.data,
+                            shards=form.shards.data or 1,
+                            engine=form.engine.data)
 
         db.session.add(new_backup)
         db.session.commit()
+        notify_runner()
 
         flash("Backup job was created successfully.", "success")
         return redirect(url_for('index'))
@@ -73,12 +89,15 @@ def new_backup():
 def edit_backup(backup_id):
     """Route for the edit single backup page."""
 
-    backup_query = Backup.query.filter(Backup.id==backup_id)
+    backup = Backup.query.filter(Backup.id==backup_id).first()
 
-    if backup_query.first() is None:
+    if backup is None:
         return abort(404)
 
-    backup = backup_query.first()
+    # Entries are split between shards by their names, and each engine
+    # lays the repository out its own way, so neither can change once the
+    # repository holds backups
+    locked = backup.has_backups
 
     if request.method == "POST":
         form = BackupForm(request.form)
@@ -91,9 +110,12 @@ def edit_backup(backup_id):
                           start_time=backup.start_time,
                           start_day=backup.start_day,
                           interval=backup.interval,
-                          retention=backup.retention)
+                          retention=backup.retention,
+                          shards=backup.shards,
+                          engine=backup.engine)
 
-    if form.validate_on_submit():
+    if form.validate_on_submit() and \
+            not (locked and _repository_changed(form, backup)):
         # Modify the existing backup
         backup.name = form.name.data
         backup.server = form.server.data
@@ -107,15 +129,39 @@ def edit_backup(backup_id):
         backup.start_day = form.start_day.data
         backup.interval = form.interval.data
         backup.retention = form.retention.data
+        if not locked:
+            backup.shards = form.shards.data or 1
+            backup.engine = form.engine.data
+        backup.schedule_next_run()
 
         # Save changes to the database
         db.session.commit()
+        notify_runner()
 
         flash("Backup job was saved successfully.", "success")
         return redirect(url_for('index'))
 
     return render_template('edit-backup.html', title='Edit Backup',
-                           form=form)
+                           form=form, locked=locked)
+
+
+def _repository_changed(form, backup):
+    """
+    Returns True if the form changes how the backup's repository is laid
+    out, adding an error to each field that changes it. Fields left out
+    of the form keep their values.
+    """
+    changed = False
+    if form.shards.raw_data and \
+            (form.shards.data or 1) != (backup.shards or 1):
+        form.shards.errors.append("Cannot be changed once the backup has "
+                                  "run.")
+        changed = True
+    if form.engine.raw_data and form.engine.data != backup.engine:
+        form.engine.errors.append("Cannot be changed once the backup has "
+                                  "run.")
+        changed = True
+    return changed
 
 
 @app.route('/backups/delete/<backup_id>', methods=['GET', 'POST'])
@@ -133,6 +179,7 @@ def delete_backup(backup_id):
     if form.validate_on_submit():
         backup.delete()
         db.session.commit()
+        notify_runner()
 
         flash("Backup job was deleted successfully.", "success")
         return redirect(url_for('index'))
@@ -146,18 +193,18 @@ def delete_backup(backup_id):
 def disable_backup(backup_id):
     """Route for the disable backup page."""
 
-    backup = Backup.query.filter(Backup.id==backup_id)
+    backup = Backup.query.filter(Backup.id==backup_id).first()
 
-    if backup.first() is None:
+    if backup is None:
         return abort(404)
 
-    backup = backup.first()
-
     form = DisableBackupForm(request.form)
 
     if form.validate_on_submit():
         backup.enabled = False
+        backup.schedule_next_run()
         db.session.commit()
+        notify_runner()
 
         flash("Backup job was disabled successfully.", "success")
         return redirect(url_for('index'))
@@ -171,18 +218,18 @@ def disable_backup(backup_id):
 def enable_backup(backup_id):
     """Route for the enable backup page."""
 
-    backup = Backup.query.filter(Backup.id==backup_id)
+    backup = Backup.query.filter(Backup.id==backup_id).first()
 
-    if backup.first() is None:
+    if backup is None:
         return abort(404)
 
-    backup = backup.first()
-
     form = EnableBackupForm(request.form)
 
     if form.validate_on_submit():
         backup.enabled = True
+        backup.schedule_next_run()
         db.session.commit()
+        notify_runner()
 
         flash("Backup job was enabled successfully.", "success")
         return redirect(url_for('index'))
@@ -196,13 +243,11 @@ def enable_backup(backup_id):
 def start_backup(backup_id):
     """Route for the start backup page."""
 
-    backup = Backup.query.filter(Backup.id==backup_id)
+    backup = Backup.query.filter(Backup.id==backup_id).first()
 
-    if backup.first() is None:
+    if backup is None:
         return abort(404)
 
-    backup = backup.first()
-
     form = StartBackupForm(request.form)
 
     if form.validate_on_submit():
@@ -213,6 +258,7 @@ def start_backup(backup_id):
         if backup.enabled:
             backup.start_now = True
             db.session.commit()
+            notify_runner()
 
             flash("Backup job was scheduled to start.", "success")
             return redirect(url_for('index'))
@@ -224,6 +270,174 @@ def start_backup(backup_id):
                            form=form)
 
 
+@app.route('/backups/cancel/<backup_id>', methods=['GET', 'POST'])
+@login_required
+def cancel_backup(backup_id):
+    """Route for the cancel backup page."""
+
+    backup = Backup.query.filter(Backup.id==backup_id).first()
+
+    if backup is None:
+        return abort(404)
+
+    form = CancelBackupForm(request.form)
+
+    if form.validate_on_submit():
+        if backup.status != backup.STATUS.RUNNING:
+            flash("Backup job is not running.", "danger")
+            return redirect(url_for('index'))
+
+        backup.cancel_requested = True
+        db.session.commit()
+        notify_runner()
+
+        flash("Backup job was scheduled to be cancelled.", "success")
+        return redirect(url_for('index'))
+
+    return render_template('cancel-backup.html', title='Cancel Backup',
+                           form=form)
+
+
+@app.route('/backups/history/<backup_id>', methods=['GET'])
+@login_required
+def backup_history(backup_id):
+    """Route for the run history of a backup."""
+
+    backup = Backup.query.filter(Backup.id==backup_id).first()
+
+    if backup is None:
+        return abort(404)
+
+    # The processes of the listed runs are loaded in one more query, not one
+    # per run
+    runs = backup.runs.options(db.subqueryload(BackupRun.processes))\
+        .order_by(BackupRun.started_at.desc()).limit(100).all()
+
+    return render_template('backup-history.html', title='Backup History',
+                           backup=backup, runs=runs)
+
+
+@app.route('/backups/browse/<backup_id>', methods=['GET'])
+@login_required
+def browse_backup(backup_id):
+    """Route for browsing the contents of a backup at a restore point."""
+
+    backup = Backup.query.filter(Backup.id==backup_id).first()
+
+    if backup is None:
+        return abort(404)
+
+    catalog = catalog_for(backup.id, create=False)
+    if catalog is None:
+        return render_template('browse-backup.html', title='Browse Backup',
+                               backup=backup, restore_points=[])
+
+    try:
+        restore_points = catalog.restore_points()
+        if not restore_points:
+            return render_template('browse-backup.html',
+                                   title='Browse Backup', backup=backup,
+                                   restore_points=[])
+
+        increment = request.args.get('at', restore_points[0][0], type=int)
+        restore_point = dict((point[0], point) for point
+                             in restore_points).get(increment)
+        if restore_point is None:
+            return abort(404)
+
+        directory = request.args.get('path', '').strip('/')
+        after = request.args.get('after', '')
+        limit = app.config['BROWSE_PAGE_SIZE']
+
+        # One entry past the page tells whether there is a next page
+        key = (backup.id, increment, restore_point[1], directory, after, limit)
+        entries = listing_cache.get(key, lambda: catalog.list_directory(
+            increment, directory, after=after, limit=limit + 1))
+    finally:
+        catalog.close()
+
+    parents = []
+    if directory:
+        parts = directory.split('/')
+        parents = [(part, '/'.join(parts[:index + 1]))
+                   for index, part in enumerate(parts)]
+
+    return render_template('browse-backup.html', title='Browse Backup',
+                           backup=backup, restore_points=restore_points,
+                           restore_point=restore_point, directory=directory,
+                           parents=parents, entries=entries[:limit],
+                           after=after,
+                           next_after=entries[limit - 1][0]
+                           if len(entries) > limit else None)
+
+
+@app.route('/backups/search', methods=['GET'])
+@login_required
+def search_backups():
+    """Route for searching the catalogs of every backup for a file."""
+
+    query = request.args.get('q', '').strip()
+    results = []
+    if query:
+        limit = app.config['SEARCH_RESULTS']
+        for backup in Backup.query.order_by(Backup.name):
+            catalog = catalog_for(backup.id, create=False)
+            if catalog is None:
+                continue
+            try:
+                # The history tells which increments hold each path
+                results.extend((backup, path, catalog.history(path))
+                               for path in catalog.search(query, limit))
+            finally:
+                catalog.close()
+
+    return render_template('search-backups.html', title='Search Backups',
+                           query=query, results=results)
+
+
+@app.route('/restore', methods=['GET'])
+@login_required
+def restores():
+    """Route for the restores page."""
+
+    all_restores = Restore.query.order_by(Restore.requested_at.desc())\
+        .limit(100).all()
+
+    return render_template('restores.html', title='Restores',
+                           all_restores=all_restores)
+
+
+@app.route('/restore/new', methods=['GET', 'POST'])
+@login_required
+def new_restore():
+    """Route for the new restore page."""
+
+    if request.method == "POST":
+        form = RestoreForm(request.form)
+    else:
+        # The browse page links here with the backup, path and time set
+        form = RestoreForm(backup=request.args.get('backup', type=int),
+                           path=request.args.get('path', '/'),
+                           time_format=request.args.get('time_format', 'now'))
+    form.backup.choices = [(backup.id, backup.name)
+                           for backup in Backup.query.order_by(Backup.name)]
+
+    if form.validate_on_submit():
+        backup = Backup.query.get(form.backup.data)
+        new_restore = Restore(backup=backup, path=form.path.data,
+                              time_format=form.time_format.data)
+
+        db.session.add(new_restore)
+        db.session.commit()
+        notify_runner()
+
+        flash("Restore was scheduled to start.", "success")
+        return redirect(url_for('restores'))
+
+    return render_template('new-restore.html', title='New Restore',
+                           form=form)
+
+
 @app.route('/account/edit', methods=['GET', 'POST'])
 @login_required
 def edit_account():
@@ -315,12 +529,38 @@ def is_logged_in():
     return False
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    """Route for the metrics of the appliance, in the Prometheus format."""
+
+    # Written by the runner every METRICS_INTERVAL seconds, so a scrape
+    # only reads a file
+    runner_metrics = metrics.read_runner_metrics()
+    metrics.runner_up.set(1 if runner_metrics else 0)
+
+    return Response(metrics.web.render() + runner_metrics,
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.before_request
 def before_request():
     """Before the request, notify flask of the current user."""
+    g.request_started = time.time()
     g.user = current_user
 
 
+@app.after_request
+def after_request(response):
+    """After the request, record how long it took."""
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.http_request_seconds.observe(
+            time.time() - started, method=request.method,
+            endpoint=request.endpoint or 'none',
+            status=response.status_code)
+    return response
+
+
 @login_manager.user_loader
 def load_user(user_id):
     """Returns a user, given a user id."""
@@ -0,0 +1,87 @@
+"""
+Local wake-up channel from the web app to the backup runner.
+
+The runner listens on a Unix domain datagram socket. The web app sends a
+datagram to it whenever a backup job changes, so the runner reloads its
+schedule right away instead of polling the database for changes.
+"""
+from __future__ import absolute_import
+import errno
+import os
+import select
+import socket
+
+from app import app
+
+
+def notify_runner(path=None):
+    """
+    Wakes up the runner listening at path. Does nothing if no runner is
+    listening.
+    """
+    if path is None:
+        path = app.config['RUNNER_SOCKET']
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(b'wake', path)
+    except socket.error:
+        # The runner is not running, or already has wake-ups queued
+        pass
+    finally:
+        sock.close()
+
+
+class WakeupListener(object):
+    """
+    Listens for wake-ups sent by notify_runner.
+    """
+
+    def __init__(self, path=None):
+        """
+        path (str) - Path of the Unix domain socket to listen on
+        """
+        if path is None:
+            path = app.config['RUNNER_SOCKET']
+        self.path = path
+
+        # Remove the socket left behind by a previous runner
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        # The web app may run as a different user than the runner. Wake-ups
+        # carry no data, so anyone may send one.
+        os.chmod(self.path, 0o666)
+
+    def wait(self, timeout):
+        """
+        Blocks until a wake-up arrives or timeout seconds pass.
+
+        Returns True if woken up.
+        """
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return False
+
+        # Several wake-ups sent at once need only one reload
+        while True:
+            try:
+                self._sock.recv(64)
+            except socket.error:
+                break
+        return True
+
+    def close(self):
+        """ Stops listening and removes the socket. """
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,132 @@
+"""
+Admission control for jobs. A job is only started when the backup repository
+has room for it and the host is not already overloaded; otherwise it is
+deferred and tried again later.
+"""
+
+import glob
+import logging
+import multiprocessing
+import os
+import threading
+
+from metadata import read_statistics
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+# Number of recent rdiff-backup sessions used to estimate the next one
+HISTORY_SESSIONS = 5
+
+
+class AdmissionController(object):
+    """
+    AdmissionController decides whether a job may start now, and reserves
+    the space a started job is expected to use until it finishes.
+    """
+
+    def __init__(self, backups_dir, min_free_bytes=0, growth_factor=1.5,
+                 max_load=None, max_io_pressure=None):
+        """
+        backups_dir (str) - Directory holding the backup repositories
+        min_free_bytes (int) - Free space to leave in backups_dir
+        growth_factor (float) - Margin applied to the expected job size
+        max_load (float) - Maximum 1 minute load average per CPU
+        max_io_pressure (float) - Maximum percent of time stalled on I/O
+        """
+        self.backups_dir = backups_dir
+        self.min_free_bytes = min_free_bytes
+        self.growth_factor = growth_factor
+        self.max_load = max_load
+        self.max_io_pressure = max_io_pressure
+
+        self._lock = threading.Lock()
+        self._reserved = {}
+
+    def admit(self, backup_id, repository):
+        """
+        Admits a job if it can run now, reserving its expected size.
+
+        backup_id - Id of the backup the job runs for
+        repository (str) - Backup repository the job writes to
+
+        Returns None if admitted, otherwise the reason the job is deferred.
+        """
+        if self.max_load is not None:
+            load = os.getloadavg()[0] / multiprocessing.cpu_count()
+            if load > self.max_load:
+                return "Host load is too high ({:.1f} per CPU).".format(load)
+
+        if self.max_io_pressure is not None:
+            pressure = io_pressure()
+            if pressure is not None and pressure > self.max_io_pressure:
+                return "Host I/O pressure is too high ({:.0f}%)."\
+                    .format(pressure)
+
+        expected = int(expected_growth(repository) * self.growth_factor)
+        with self._lock:
+            available = free_bytes(self.backups_dir) - \
+                sum(self._reserved.values())
+            if available - expected < self.min_free_bytes:
+                return "Not enough free space for the backup ({} MB free, " \
+                    "{} MB expected).".format(available // 2 ** 20,
+                                              expected // 2 ** 20)
+            self._reserved[backup_id] = expected
+        return None
+
+    def release(self, backup_id):
+        """ Releases the space reserved for a finished job. """
+        with self._lock:
+            self._reserved.pop(backup_id, None)
+
+
+def free_bytes(path):
+    """ Returns the bytes available to unprivileged users at path. """
+    stat = _statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _statvfs(path):
+    # The backups directory is created by the first job
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.statvfs(path)
+
+
+def expected_growth(repository):
+    """
+    Returns the most a repository grew in its recent rdiff-backup sessions,
+    in bytes, or 0 if it has no history. The growth of a sharded repository
+    is the sum of the growth of its shards.
+    """
+    growth = 0
+    for data_dir in [os.path.join(repository, 'rdiff-backup-data')] + \
+            glob.glob(os.path.join(repository, 'shard-*', 'rdiff-backup-data')):
+        pattern = os.path.join(data_dir, 'session_statistics.*.data')
+        shard_growth = 0
+        for path in sorted(glob.glob(pattern))[-HISTORY_SESSIONS:]:
+            statistics = read_statistics(path)
+            shard_growth = max(shard_growth,
+                               statistics.get('TotalDestinationSizeChange', 0))
+        growth += shard_growth
+    return growth
+
+
+def io_pressure(path='/proc/pressure/io'):
+    """
+    Returns the percent of the last 10 seconds in which some tasks were
+    stalled on I/O, or None if the kernel does not report it.
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        name, value = field.split('=')
+                        if name == 'avg10':
+                            return float(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return None
@@ -1,20 +1,41 @@
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-import random
-import string
-
-import envoy
+import pipes
+import re
+import shutil
+import tempfile
+import threading
+import time
 
 import sys
 sys.path.append("..")
 
 from app import db
+from app.catalog import update_catalog
+from app.models import BackupRun
+from checksum import file_digest, parallel_check
+from metadata import latest_mirror_metadata, mirror_metadata_files, \
+    parse_statistics, read_mirror_metadata, session_statistics, session_time
+from process import Process
+from scan import ScanIndex, ShareScanner
+from timespec import parse_time
 
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
 
 
 BACKUPS_DIR = '/var/backups'
+# Scan indexes of the last successful backup of each share
+SCAN_INDEX_DIR = os.path.join(BACKUPS_DIR, '.scan')
+# Chunk store shared by all deduplicated backups
+CHUNK_DIR = os.path.join(BACKUPS_DIR, '.chunks')
+# Scratch space that verification restores sample files into
+VERIFY_DIR = os.path.join(BACKUPS_DIR, '.verify')
+
+# Line rdiff-backup writes for each changed file it backs up, at terminal
+# verbosity 5
+RDIFF_CHANGED_RE = re.compile(r'^Processing changed file (?P<path>.*)$')
 
 
 class Job(object):
@@ -23,134 +44,795 @@ class Job(object):
     a remote file system.
     """
 
-    def __init__(self, backup, mount_fs, backup_wrapper):
+    def __init__(self, backup, mount_fs, backup_wrapper, throttle=None,
+                 prescan_workers=0):
         """
         backup (Backup object) - Backup object containing server credentials
-        mount_fs (AbstractMountFS type) - FS to mount
-        backup_wrapper (RdiffBackupWrapper) - rdiff-backup wrapper to use
+        mount_fs (AbstractMountFS type) - FS to mount, or a MountPool to
+            share the mount with other jobs
+        backup_wrapper (AbstractBackupEngine type) - Backup engine to use
+        throttle (Throttle) - Throttle to limit the I/O rate of the job
+        prescan_workers (int) - Threads scanning the share for changes
+            before a backup, 0 to always back up without scanning
         """
         self.backup = backup
+        self.prescan_workers = prescan_workers
+        # Result of the last prescan of the share
+        self.scan = None
+        # Reason the job was cancelled, None unless cancelled
+        self.cancel_reason = None
 
-        # Setup temp space for the job
-        tmp_name = ''.join(random.choice(string.ascii_lowercase) \
-            for _ in range(12))
-        self.temp_dir = os.path.join('/tmp', tmp_name)
-
-        # Mount the FS needed for hte job
+        # Mount the FS needed for the job. The FS picks its mount point.
         self.fs = mount_fs(username=self.backup.username,
                            password=self.backup.password,
                            remote_addr=self.backup.server,
                            remote_port=self.backup.port,
-                           remote_path=self.backup.location,
-                           local_path=self.temp_dir)
+                           remote_path=self.backup.location)
         self.fs.mount()
+        try:
+            self._setup(backup_wrapper, throttle)
+        except Exception:
+            # A pooled mount is only evicted once every job released it
+            self.cleanup()
+            raise
+
+    def _setup(self, backup_wrapper, throttle):
+        """ Prepares the repository and the engine of the mounted job. """
+        self.mount_path = self.fs.local_path
 
         # Get backup directory of the backup job
         self.local_backup_path = os.path.join(BACKUPS_DIR,
                                               str(self.backup.id))
 
         # Create temp folders if they don't exist
-        if not os.exists(BACKUPS_DIR):
+        if not os.path.exists(BACKUPS_DIR):
             os.makedirs(BACKUPS_DIR)
-        if not os.exists(self.local_backup_path):
+        if not os.path.exists(self.local_backup_path):
             os.makedirs(self.local_backup_path)
 
+        # Index of the share as of the last successful backup
+        index_name = "{}.json.gz".format(self.backup.id)
+        self.scan_index = ScanIndex(os.path.join(SCAN_INDEX_DIR, index_name))
+
         # Create a new backup_job object
-        self.backup_job = backup_wrapper(remote_dir=self.temp_dir,
-                                         backup_dir=self.local_backup_path)
-        
+        self.backup_job = backup_wrapper(remote_dir=self.mount_path,
+                                         backup_dir=self.local_backup_path,
+                                         throttle=throttle,
+                                         server=self.backup.server)
+
+    def prescan(self):
+        """
+        Scans the mounted share for changes since the last successful
+        backup. Returns a ScanResult, or None if scanning is disabled.
+        """
+        if not self.prescan_workers:
+            return None
+
+        scan = ShareScanner(self.mount_path,
+                            workers=self.prescan_workers).scan()
+
+        # Without a repository there is nothing the scan can be compared to
+        previous = None
+        if self.backup_job.has_backups():
+            previous = self.scan_index.load()
+        if previous is not None:
+            scan.compare(previous)
+            LOGGER.info("Scan: {} changed and {} deleted in {}."\
+                .format(len(scan.changed), len(scan.deleted),
+                        self.mount_path))
+        self.scan = scan
+        return scan
+
+    def cancel(self, reason):
+        """
+        Cancels the job, terminating the running backup or restore.
+
+        reason (str) - Reason recorded for the cancellation
+        """
+        self.cancel_reason = reason
+        self.backup_job.cancel()
+
+    def process_usage(self):
+        """
+        Returns the ProcessUsage of the mount and umount commands run for
+        the job, and of the processes run by its last backup.
+        """
+        return self.fs.usage + self.backup_job.process_usage()
+
+    def cleanup(self):
+        """ Unmounts the FS of the job. """
+        try:
+            self.fs.unmount()
+        except Exception:
+            LOGGER.exception("Job: Failed to unmount {}."\
+                .format(self.fs.local_path))
+
     def done(self):
         self.backup.finished()
-        self.fs.unmount()
-        os.removedirs(self.temp_dir)
+        self.cleanup()
 
 
 class BackupJob(Job):
     def run(self):
         self.backup.started()
+        # History of the job, kept across runs
+        self.run_record = BackupRun(backup=self.backup)
+        db.session.add(self.run_record)
+        db.session.commit()
+        statistics = {}
         try:
-            self.backup_job.backup()
+            scan = self.prescan()
+            if scan is not None and scan.unchanged:
+                LOGGER.info("Backup: Nothing changed in {}, skipping."\
+                    .format(self.mount_path))
+                statistics = {'ChangedFiles': 0, 'ChangedSourceSize': 0}
+            else:
+                try:
+                    self.backup_job.backup(scan=scan)
+                finally:
+                    statistics = self.backup_job.run_statistics()
         except Exception as e:
-            print(e)
-            self.backup.failed(e)
+            if self.cancel_reason is not None:
+                LOGGER.info("Backup: Backup of {} was cancelled: {}."\
+                    .format(self.mount_path, self.cancel_reason))
+                self.backup.cancelled(self.cancel_reason)
+                self.run_record.cancelled(self.cancel_reason)
+            else:
+                LOGGER.exception("Backup: Failed to back up {}."\
+                    .format(self.mount_path))
+                self.backup.failed(str(e))
+                self.run_record.failed(str(e), statistics)
+            self.cleanup()
+            self.run_record.used(self.process_usage())
             db.session.commit()
         else:
+            # An incomplete scan may have missed changes, so the index of
+            # the last complete scan is kept
+            if scan is not None and scan.complete:
+                self.scan_index.save(scan.entries)
+            self.run_record.finished(statistics)
             self.done()
+            self.run_record.used(self.process_usage())
             db.session.commit()
+            update_catalog(self.backup.id, self.backup_job)
 
 
 class RestoreJob(Job):
-    def run(self, path, time_format):
-        raise NotImplementedError("Run the restore job here.")
-        self.done()
+    def __init__(self, restore, mount_fs, backup_wrapper, throttle=None,
+                 workers=1, progress_interval=5):
+        """
+        restore (Restore object) - Restore to run
+        mount_fs (AbstractMountFS type) - FS to mount
+        backup_wrapper (AbstractBackupEngine type) - Backup engine to use
+        throttle (Throttle) - Throttle to limit the I/O rate of the job
+        workers (int) - Parallel workers restoring a directory
+        progress_interval (int) - Seconds between progress updates
+        """
+        super(RestoreJob, self).__init__(restore.backup, mount_fs,
+                                         backup_wrapper, throttle=throttle)
+        self.restore = restore
+        self.workers = workers
+        self.progress_interval = progress_interval
 
+        self._lock = threading.Lock()
+        self._progress = None
 
-class RdiffBackupWrapper(object):
+    def report(self, bytes_done, bytes_total):
+        """ Records the progress of the restore. Called from any thread. """
+        with self._lock:
+            self._progress = (bytes_done, bytes_total)
+
+    def run(self):
+        self.restore.started()
+        db.session.commit()
+
+        errors = []
+
+        def restore():
+            try:
+                self.backup_job.restore(path=self.restore.path,
+                                        time_format=self.restore.time_format,
+                                        workers=self.workers,
+                                        progress=self.report)
+            except Exception as e:
+                LOGGER.exception("Restore: Failed to restore {} of backup {}."\
+                    .format(self.restore.path, self.backup.id))
+                errors.append(e)
+
+        thread = threading.Thread(target=restore,
+                                  name="restore-{}".format(self.restore.id))
+        thread.daemon = True
+        thread.start()
+
+        # Progress is saved from this thread, which owns the session
+        while thread.is_alive():
+            thread.join(self.progress_interval)
+            with self._lock:
+                progress, self._progress = self._progress, None
+            if progress is not None:
+                self.restore.progressed(*progress)
+                db.session.commit()
+
+        if errors:
+            if self.cancel_reason is not None:
+                self.restore.cancelled(self.cancel_reason)
+            else:
+                self.restore.failed(str(errors[0]))
+        else:
+            self.restore.finished()
+        self.cleanup()
+        db.session.commit()
+
+
+class AbstractBackupEngine(object):
+    """
+    AbstractBackupEngine for storing backups of a remote directory.
+    """
+
+    def has_backups(self):
+        """ Returns True if at least one backup has been stored. """
+        raise NotImplementedError
+
+    def backup(self, scan=None):
+        """
+        Backup the remote location.
+
+        scan (ScanResult) - Changes found by a prescan of the remote
+            location, None if it was not scanned
+        """
+        raise NotImplementedError
+
+    def restore(self, path='/', time_format="1D", workers=1, progress=None):
+        """
+        Restore a path, recursively to the remote location.
+
+        path (str) - Path to restore
+        time_format (str) - Time of the backup to restore, in a format
+            accepted by rdiff-backup
+        workers (int) - Parallel workers to restore with
+        progress (callable) - Called with (bytes restored, bytes to restore)
+            as the restore progresses
+        """
+        raise NotImplementedError
+
+    def prune(self, retention, timeout=None):
+        """
+        Removes the backups older than the retention period.
+
+        retention (int) - Days of backups to keep
+        timeout (float) - Seconds the prune may take, None for no limit. A
+            prune stopped part way is finished by the next one.
+        Returns the bytes freed.
+        """
+        raise NotImplementedError
+
+    def files(self):
+        """
+        Returns the size of each regular file in the latest backup, by
+        relative path.
+        """
+        raise NotImplementedError
+
+    def increments(self):
+        """
+        Returns the (time, label) of each stored increment, oldest first.
+        time is in seconds since the epoch.
+        """
+        raise NotImplementedError
+
+    def listing(self, label):
+        """
+        Returns the (relative path, size, mtime) of each regular file and
+        directory in an increment, or None if its listing was not kept. The
+        size of a directory is None.
+        """
+        raise NotImplementedError
+
+    def statistics(self, label):
+        """ Returns the statistics recorded for an increment, if any. """
+        return {}
+
+    def run_statistics(self):
+        """
+        Returns the statistics of the last backup, with the names of
+        rdiff-backup's session statistics, as far as the engine keeps them.
+        """
+        return {}
+
+    def process_usage(self):
+        """
+        Returns the ProcessUsage of each subprocess run by the last backup.
+        Engines that back up in-process run none.
+        """
+        return []
+
+    def verify(self, workers=None):
+        """
+        Hashes the stored backups in parallel and compares them with the
+        checksums stored with them.
+
+        workers (int) - Threads to hash with, one per core by default
+        Returns (items checked, list of failures).
+        """
+        raise NotImplementedError
+
+    def check_restored(self, relpath, path):
+        """
+        Returns True if a file restored from the latest backup matches the
+        checksums stored for it.
+
+        relpath (str) - Path of the file in the backup
+        path (str) - Path the file was restored to
+        """
+        raise NotImplementedError
+
+    def cancel(self):
+        raise NotImplementedError
+
+
+class RdiffBackupWrapper(AbstractBackupEngine):
     """
     RdiffBackupWrapper provides a wrapper around rdiff-backup
     """
 
-    def __init__(self, remote_dir, backup_dir):
+    def __init__(self, remote_dir, backup_dir, throttle=None, server=None,
+                 on_event=None):
         """
         remote_dir (str) - Remote directory to backup (mounted locally)
         backup_dir (str) - Destination directory to store backups
+        throttle (Throttle) - Throttle to limit the I/O rate of rdiff-backup
+        server (str) - Server the remote directory is mounted from
+        on_event (callable) - Called with (event, path) as a backup runs,
+            with 'changed' for each changed file backed up
         """
 
         self.remote_dir = remote_dir
         self.backup_dir = backup_dir
+        self.throttle = throttle
+        self.server = server
+        self.on_event = on_event
+        # Changed files backed up by the last backup, and its statistics
+        self.changed_files = 0
+        self._statistics = {}
+        # Lines of the statistics block being printed, None outside of it
+        self._statistics_lines = None
+        # ProcessUsage of the processes run since the last backup started
+        self._usage = []
+
+        self.cancelled = False
+        self._process = None
+        # Processes of a parallel restore
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._digests = None
+
+    def cancel(self):
+        """ Terminates the running backup or restore. """
+        self.cancelled = True
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.terminate()
+
+    def _run(self, command, timeout, direction, on_line=None):
+        """ Runs an rdiff-backup command unless cancelled. """
+        process = Process(command, timeout=timeout, throttle=self.throttle,
+                          server=self.server, direction=direction)
+        with self._lock:
+            self._process = process
+            self._processes.add(process)
+        if self.cancelled:
+            process.terminate()
+        try:
+            return process.run(on_line)
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+                if process.usage is not None:
+                    self._usage.append(process.usage)
+
+    def has_backups(self):
+        """ Returns True if the backup directory holds a repository. """
+        return os.path.isdir(os.path.join(self.backup_dir,
+                                          'rdiff-backup-data'))
+
+    def backup(self, scan=None, include_filelist=None):
+        """
+        Backup the remote location.
 
-    def backup(self):
-        """ Backup the remote location. """
+        scan (ScanResult) - Not used, rdiff-backup compares the remote
+            location with the mirror by itself
+        include_filelist (str) - File listing the paths to back up, one per
+            line. Everything else in the remote location is excluded, and
+            removed from the backup if it was backed up before.
+        """
 
-        template = "rdiff-backup {remote_dir} {backup_dir}"
+        template = "rdiff-backup --terminal-verbosity 5 --print-statistics " \
+                   "{remote_dir} {backup_dir}"
+        if include_filelist is not None:
+            template = "rdiff-backup --terminal-verbosity 5 " \
+                       "--print-statistics " \
+                       "--include-filelist {include_filelist} " \
+                       "--exclude '**' {remote_dir} {backup_dir}"
 
         arguments = {
-            'remote_dir': self.remote_dir,
-            'backup_dir': self.backup_dir
+            'remote_dir': pipes.quote(self.remote_dir),
+            'backup_dir': pipes.quote(self.backup_dir),
+            'include_filelist': pipes.quote(include_filelist or ''),
         }
 
         command = template.format(**arguments)
 
         # Timeout of 7 days
-        r = envoy.run(command, timeout=604800)
+        self.changed_files = 0
+        self._statistics = {}
+        self._usage = []
+        status_code, std_out, std_err = self._run(command, timeout=604800,
+                                                direction='read',
+                                                on_line=self._backup_line)
 
         LOGGER.debug("Backup command: {}".format(command))
-        LOGGER.debug("Backup command stdout: {}".format(r.std_out))
-        if r.std_err:
-            raise RdiffBackupException(r.std_err)
-        
-        LOGGER.info("Backup: Backed up {} to {} successfully."\
-            .format(self.remote_dir, self.backup_dir))
-
-    def restore(self, path='/', time_format="1D"):
+        if self._process.terminated:
+            raise RdiffBackupException("Backup was terminated.")
+        if status_code != 0:
+            raise RdiffBackupException(
+                std_err or "rdiff-backup exited with status {}."\
+                    .format(status_code))
+        if std_err:
+            # Files that could not be read are reported, but do not fail
+            # the backup
+            LOGGER.warning("Backup: rdiff-backup reported for {}: {}"\
+                .format(self.remote_dir, std_err))
+
+        LOGGER.info("Backup: Backed up {} to {} successfully ({} changed "
+                    "files).".format(self.remote_dir, self.backup_dir,
+                                     self.changed_files))
+
+    def run_statistics(self):
+        """ Returns the session statistics printed by the last backup. """
+        return dict(self._statistics)
+
+    def process_usage(self):
+        """ Returns the ProcessUsage of the processes of the last backup. """
+        with self._lock:
+            return list(self._usage)
+
+    def _backup_line(self, stream, line):
+        """ Turns a line of rdiff-backup output into a backup event. """
+        if stream != 'stdout':
+            return
+        if 'Session statistics' in line:
+            self._statistics_lines = []
+            return
+        if self._statistics_lines is not None:
+            if line.strip() and not line.strip('-\n'):
+                # The block ends with a line of dashes
+                self._statistics = parse_statistics(self._statistics_lines)
+                self._statistics_lines = None
+            else:
+                self._statistics_lines.append(line)
+            return
+        match = RDIFF_CHANGED_RE.match(line.rstrip('\n'))
+        if match is not None:
+            self.changed_files += 1
+            if self.on_event is not None:
+                self.on_event('changed', match.group('path'))
+
+    def restore(self, path='/', time_format="1D", workers=1, progress=None):
         """
-        Restore a path, recursively to the remote location.
-        
+        Restore a path, recursively to the remote location, overwriting
+        what is there.
+
+        A directory is restored by up to workers rdiff-backup processes at
+        once, each restoring a group of its entries into a staging
+        directory next to them. Staged entries are then moved into place,
+        so entries of the directory that are not in the backup are kept.
+
         path (str) - Path to restore
         time_format (str) - Time format passed into rdiff-backup to specify
             version of backup to restore.
+        workers (int) - rdiff-backup processes to restore a directory with
+        progress (callable) - Called with (bytes restored, bytes to restore)
+            as the restore progresses
         """
+        # A time rdiff-backup does not accept fails before anything runs
+        parse_time(time_format, time.time())
+
+        relpath = restore_relpath(path)
+        src = os.path.join(self.backup_dir, relpath)
+        dest = os.path.join(self.remote_dir, relpath)
+
+        if os.path.isdir(src):
+            # More groups than workers, so a large group does not hold up
+            # the rest and progress is reported more often
+            groups = self._restore_groups(relpath, workers * 4)
+            self._restore_parallel(src, dest, time_format, groups, workers,
+                                   progress)
+        else:
+            self._restore(src, dest, time_format)
+            if progress is not None:
+                progress(1, 1)
+
+        LOGGER.info("Restore: Restored (time: {}) {} to {} successfully."\
+            .format(time_format, src, dest))
 
-        template = "rdiff-backup -r {time_format} {src} {dest}"
+    def _restore(self, src, dest, time_format, selection=''):
+        """ Restores src to dest with one rdiff-backup process. """
+        template = "rdiff-backup --force -r {time_format} {selection} " \
+                   "{src} {dest}"
 
         arguments = {
-            'time_format': time_format,
-            'src': os.path.join(self.backup_dir, path),
-            'dest': os.path.join(self.remote_dir, path),
+            'time_format': pipes.quote(time_format),
+            'selection': selection,
+            'src': pipes.quote(src),
+            'dest': pipes.quote(dest),
         }
 
         command = template.format(**arguments)
 
         # Timeout of 4 days
-        r = envoy.run(command, timeout=345600)
+        status_code, std_out, std_err = self._run(command, timeout=345600,
+                                                direction='write')
 
         LOGGER.debug("Restore command: {}".format(command))
-        LOGGER.debug("Restore command stdout: {}".format(r.std_out))
-        if r.std_err:
-            raise RdiffRestoreException(r.std_err)
-        
-        LOGGER.info("Restore: Restored (time: {}) {} to {} successfully."\
-            .format(time_format, arguments['src'], arguments['dest']))
+        if self.cancelled:
+            raise RdiffRestoreException("Restore was terminated.")
+        if status_code != 0:
+            raise RdiffRestoreException(
+                std_err or "rdiff-backup exited with status {}."\
+                    .format(status_code))
+
+    def _restore_groups(self, relpath, count):
+        """
+        Splits the entries of a directory in the mirror into up to count
+        groups of about the same size. Returns a list of (names, bytes).
+        """
+        prefix = relpath + '/' if relpath else ''
+        sizes = {}
+        for record in self._mirror_entries():
+            name = record['File']
+            if name == '.' or not name.startswith(prefix) or name == relpath:
+                continue
+            child = name[len(prefix):].split('/', 1)[0]
+            sizes[child] = sizes.get(child, 0) + int(record.get('Size', 0))
+
+        # Largest entries first, each into the smallest group so far
+        groups = [([], 0) for _ in range(min(count, len(sizes)))]
+        for child, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            names, total = min(groups, key=lambda group: group[1])
+            groups.remove((names, total))
+            names.append(child)
+            groups.append((names, total + size))
+        return groups
+
+    def _restore_parallel(self, src, dest, time_format, groups, workers,
+                          progress):
+        """ Restores groups of the entries of src into dest at once. """
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+
+        # Entries that were in the directory at the restore time but are
+        # not in the mirror any more are restored by one more group, of
+        # everything outside the other groups
+        known = [name for names, _ in groups for name in names]
+        tasks = [(names, 'include', size) for names, size in groups]
+        tasks.append((known, 'exclude', 0))
+
+        total = sum(size for names, size in groups) or 1
+        done = [0]
+        lock = threading.Lock()
+
+        def restore_group(task):
+            names, mode, size = task
+            staging = tempfile.mkdtemp(prefix='.restore-', dir=dest)
+            try:
+                with tempfile.NamedTemporaryFile('w', suffix='.filelist',
+                                                 delete=False) as filelist:
+                    for name in names:
+                        filelist.write(os.path.join(src, name))
+                        filelist.write('\n')
+                if mode == 'include':
+                    selection = "--include-filelist {} --exclude '**'"\
+                        .format(filelist.name)
+                else:
+                    selection = "--exclude-filelist {}".format(filelist.name)
+
+                try:
+                    staged = os.path.join(staging, 'data')
+                    self._restore(src, staged, time_format, selection)
+                finally:
+                    os.remove(filelist.name)
+
+                if os.path.isdir(staged):
+                    for name in os.listdir(staged):
+                        _replace(os.path.join(staged, name),
+                                 os.path.join(dest, name))
+            except Exception as e:
+                return "{}: {}".format(', '.join(names[:3]), e)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+            if progress is not None:
+                with lock:
+                    done[0] += size
+                    progress(min(done[0], total), total)
+
+        pool = ThreadPool(workers)
+        try:
+            errors = [error for error in pool.imap_unordered(restore_group,
+                                                             tasks)
+                      if error is not None]
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise RdiffRestoreException("\n".join(errors))
+
+    def prune(self, retention, timeout=None):
+        """
+        Removes increments older than the retention period.
+
+        retention (int) - Days of increments to keep
+        timeout (float) - Seconds before rdiff-backup is terminated, None
+            for a day. It removes increments one at a time, so the next
+            prune removes the rest.
+        Returns the bytes freed.
+        """
+
+        template = "rdiff-backup --force --remove-older-than {retention}D " \
+                   "{backup_dir}"
+
+        arguments = {
+            'retention': retention,
+            'backup_dir': pipes.quote(self.backup_dir),
+        }
+
+        command = template.format(**arguments)
+
+        # Increments are all kept under rdiff-backup-data
+        data_dir = os.path.join(self.backup_dir, 'rdiff-backup-data')
+        size_before = tree_size(data_dir)
+        status_code, std_out, std_err = self._run(
+            command, timeout=timeout if timeout is not None else 86400,
+            direction='write')
+
+        LOGGER.debug("Prune command: {}".format(command))
+        if self._process.terminated:
+            raise RdiffPruneException("Prune was terminated.")
+        # rdiff-backup reports that there was nothing to remove on stderr
+        if status_code != 0:
+            raise RdiffPruneException(std_err)
+
+        freed = max(0, size_before - tree_size(data_dir))
+        LOGGER.info("Prune: Removed increments older than {} days from {}."\
+            .format(retention, self.backup_dir))
+        return freed
+
+    def _mirror_entries(self):
+        """ Yields the mirror metadata of each entry in the mirror. """
+        path = latest_mirror_metadata(self.backup_dir)
+        if path is None:
+            return
+        for record in read_mirror_metadata(path):
+            yield record
+
+    def _mirror_files(self):
+        """ Yields the mirror metadata of each regular file. """
+        for record in self._mirror_entries():
+            if record.get('Type') == 'reg':
+                yield record
+
+    def files(self):
+        """
+        Returns the size of each regular file in the mirror, by relative
+        path.
+        """
+        return dict((record['File'], int(record.get('Size', 0)))
+                    for record in self._mirror_files())
+
+    def digests(self):
+        """
+        Returns the SHA-1 digest that rdiff-backup recorded for each
+        regular file in the mirror, by relative path.
+        """
+        if self._digests is None:
+            self._digests = dict((record['File'], record['SHA1Digest'])
+                                 for record in self._mirror_files()
+                                 if 'SHA1Digest' in record)
+        return self._digests
+
+    def increments(self):
+        """
+        Returns the (time, label) of each session with mirror metadata,
+        oldest first. The label is rdiff-backup's time of the session.
+        """
+        sessions = set()
+        for label, _, _ in mirror_metadata_files(self.backup_dir):
+            time = session_time(label)
+            if time is not None:
+                sessions.add((time, label))
+        return sorted(sessions)
+
+    def listing(self, label):
+        """
+        Returns the files and directories of a session from its mirror
+        metadata, or None if only a diff against a later session was kept.
+        """
+        for time, kind, path in mirror_metadata_files(self.backup_dir):
+            if time == label and kind == 'snapshot':
+                return ((record['File'],
+                         int(record.get('Size', 0))
+                         if record.get('Type') == 'reg' else None,
+                         float(record.get('ModTime', 0)))
+                        for record in read_mirror_metadata(path)
+                        if record.get('Type') in ('reg', 'dir') and
+                        record['File'] != '.')
+        return None
+
+    def statistics(self, label):
+        return session_statistics(self.backup_dir, label)
+
+    def verify(self, workers=None):
+        """
+        Hashes the mirror in parallel and compares each file with the SHA-1
+        digest in the mirror metadata. Increments are not checked.
+
+        workers (int) - Threads to hash with, one per core by default
+        Returns (files checked, list of failures).
+        """
+        digests = self.digests()
+
+        def check(relpath):
+            if self.cancelled:
+                raise RdiffVerifyException("Verify was terminated.")
+            path = os.path.join(self.backup_dir, relpath)
+            if file_digest(path) != digests[relpath]:
+                return "{}: SHA-1 digest does not match.".format(relpath)
+
+        checked, failures = parallel_check(check, sorted(digests), workers)
+        LOGGER.info("Verify: Checked {} files in {}, {} failed."\
+            .format(checked, self.backup_dir, len(failures)))
+        return checked, failures
+
+    def check_restored(self, relpath, path):
+        """
+        Returns True if a restored file matches the SHA-1 digest in the
+        mirror metadata.
+        """
+        return file_digest(path) == self.digests().get(relpath)
+
+
+def restore_relpath(path):
+    """
+    Returns a restore path relative to the root of the share and of the
+    repository. Raises ValueError if the path leaves the root.
+    """
+    relpath = os.path.normpath(path.strip('/') or '.')
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+        raise ValueError("{} is outside of the share.".format(path))
+    return '' if relpath == os.curdir else relpath
+
+
+def tree_size(path):
+    """ Returns the total size of the files under path. """
+    size = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                # Removed while it was walked
+                pass
+    return size
+
+
+def _replace(src, dest):
+    """ Moves src to dest, replacing whatever is at dest. """
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    elif os.path.lexists(dest):
+        os.remove(dest)
+    os.rename(src, dest)
 
 
 class RdiffBackupException(Exception):
@@ -159,3 +841,11 @@ class RdiffBackupException(Exception):
 
 class RdiffRestoreException(Exception):
     pass
+
+
+class RdiffPruneException(Exception):
+    pass
+
+
+class RdiffVerifyException(Exception):
+    pass
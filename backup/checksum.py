@@ -0,0 +1,50 @@
+"""
+Parallel checksums of stored backup files. hashlib releases the GIL while it
+hashes, so a thread pool spreads the hashing across every core.
+"""
+
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+READ_SIZE = 1024 * 1024
+
+
+def file_digest(path, algorithm='sha1'):
+    """ Returns the hex digest of a file's content. """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def parallel_check(check, items, workers=None):
+    """
+    Runs check(item) for every item on a pool of threads. check returns
+    None if the item is intact, else a description of the failure.
+
+    workers (int) - Threads to use, one per core by default
+    Returns (items checked, list of failures).
+    """
+    items = list(items)
+    if not items:
+        return 0, []
+
+    def safe_check(item):
+        try:
+            return check(item)
+        except Exception as e:
+            return "{}: {}".format(item, e)
+
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        results = pool.map(safe_check, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return len(items), [result for result in results if result is not None]
@@ -0,0 +1,608 @@
+"""
+Deduplicated backups. Files are split into content-defined chunks, and each
+chunk is stored once, named by its SHA-256, in a chunk store shared by every
+deduplicated backup. A backup run writes a snapshot listing the chunks of
+each file, so unchanged data is never stored twice, whichever share or run
+it came from.
+"""
+
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+import zlib
+
+from six.moves import range
+
+from backup import AbstractBackupEngine, restore_relpath
+from checksum import parallel_check
+from pool import parallel_map
+from timespec import parse_time
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+# Each byte value is marked or not, and chunks are cut after the first run
+# of CHUNK_RUN marked bytes past CHUNK_MIN. Half of the byte values are
+# marked, giving chunks of about CHUNK_MIN + 128 KB on average.
+CHUNK_MIN = 64 * 1024
+CHUNK_MAX = 1024 * 1024
+CHUNK_RUN = 16
+READ_SIZE = 4 * 1024 * 1024
+
+# The marked byte values are the half that SHA-256 ranks highest, so chunk
+# boundaries never change between runs or versions. The table translates
+# marked bytes to 1 and the others to 0.
+_MARKED = set(sorted(range(256), key=lambda value: hashlib.sha256(
+    str(value).encode('ascii')).digest())[128:])
+MARKS = bytes(bytearray(1 if value in _MARKED else 0 for value in range(256)))
+_CUT = b'\x01' * CHUNK_RUN
+
+# Unreferenced chunks younger than this are kept, as a running backup may
+# have reused them before writing its snapshot
+GC_GRACE_PERIOD = 7 * 24 * 60 * 60
+GC_INTERVAL = 24 * 60 * 60
+
+
+def _find_cut(marks, start, eof):
+    """
+    Returns the end of the chunk starting at start, or None if marks does
+    not hold enough bytes to tell.
+
+    marks (bytearray) - Data translated with MARKS
+    """
+    end = min(len(marks), start + CHUNK_MAX)
+    run = marks.find(_CUT, start + CHUNK_MIN, end)
+    if run >= 0:
+        return run + CHUNK_RUN
+    if end - start == CHUNK_MAX or eof:
+        return end
+    return None
+
+
+def chunks(f):
+    """
+    Yields the content-defined chunks of a file object.
+
+    A boundary is found from the bytes before it, so the chunks after an
+    insertion soon line up with the old ones again. The marks are
+    translated and searched by C code, at several hundred MB/s on one core
+    (see benchmarks/hashing.py). Boundaries must not change between
+    versions, or every chunk would be stored again.
+    """
+    data = bytearray()
+    start = 0
+    eof = False
+    while not eof:
+        block = f.read(READ_SIZE)
+        eof = not block
+        data = data[start:] + bytearray(block)
+        marks = data.translate(MARKS)
+        start = 0
+        while start < len(data):
+            cut = _find_cut(marks, start, eof)
+            if cut is None:
+                break
+            yield bytes(data[start:cut])
+            start = cut
+
+
+class ChunkStore(object):
+    """
+    ChunkStore holds zlib-compressed chunks named by the SHA-256 of their
+    content, in a two-level directory tree.
+
+    Backups reusing a chunk and garbage collection removing one hold the
+    lock file of the store, shared and exclusive, so a chunk is never
+    removed between a backup finding it and recording its reuse.
+    """
+
+    def __init__(self, root):
+        """
+        root (str) - Directory of the chunk store
+        """
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    @contextlib.contextmanager
+    def locked(self, operation):
+        """
+        Holds the lock of the store while in the block.
+
+        operation (int) - fcntl.LOCK_SH or fcntl.LOCK_EX
+        """
+        # Each open file gets its own flock, so threads exclude each other
+        with open(os.path.join(self.root, '.lock'), 'a') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put(self, data):
+        """
+        Stores a chunk unless it is already stored.
+        Returns (digest, True if the chunk was new).
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            # Reuse is recorded so garbage collection spares the chunk
+            # until the snapshot referencing it has been written. If it
+            # was collected meanwhile, utime fails and it is written again.
+            try:
+                with self.locked(fcntl.LOCK_SH):
+                    os.utime(path, None)
+                return digest, False
+            except OSError:
+                pass
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+        # Written aside and renamed so a chunk is never seen half written
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data, 1))
+        os.rename(tmp_path, path)
+        return digest, True
+
+    def get(self, digest):
+        """ Returns the content of a chunk. """
+        with open(self.path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise DedupRestoreException("Chunk {} is corrupt.".format(digest))
+        return data
+
+    def collect_garbage(self, snapshots, grace_period=GC_GRACE_PERIOD):
+        """
+        Removes chunks that no snapshot references. The store is collected
+        one sixteenth at a time to bound the memory used.
+
+        snapshots (list) - Paths of every snapshot using the store
+        grace_period (int) - Seconds unreferenced chunks are kept for
+        Returns (chunks removed, bytes reclaimed).
+        """
+        removed, reclaimed = 0, 0
+        cutoff = time.time() - grace_period
+        for part in '0123456789abcdef':
+            referenced = set()
+            for path in snapshots:
+                for entry in load_snapshot(path).values():
+                    referenced.update(digest for digest in entry.get('c', ())
+                                      if digest[0] == part)
+
+            for top in os.listdir(self.root):
+                if not top.startswith(part):
+                    continue
+                for dirpath, _, filenames in os.walk(
+                        os.path.join(self.root, top)):
+                    for name in filenames:
+                        if name in referenced:
+                            continue
+                        path = os.path.join(dirpath, name)
+                        try:
+                            # A backup may be reusing the chunk right now
+                            with self.locked(fcntl.LOCK_EX):
+                                st = os.stat(path)
+                                if st.st_mtime < cutoff:
+                                    os.remove(path)
+                                    removed += 1
+                                    reclaimed += st.st_size
+                        except OSError:
+                            pass
+        return removed, reclaimed
+
+
+def load_snapshot(path):
+    """ Returns the entries of a snapshot by relative path. """
+    with gzip.open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def save_snapshot(path, entries):
+    """ Writes the entries of a snapshot, atomically. """
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(entries).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+
+class DedupBackupEngine(AbstractBackupEngine):
+    """
+    DedupBackupEngine stores deduplicated backups of a remote directory.
+    Snapshots are kept in the backup directory, named by the time of the
+    run, and the chunks in the shared chunk store.
+    """
+
+    def __init__(self, remote_dir, backup_dir, throttle=None, server=None,
+                 chunk_dir=None):
+        """
+        remote_dir (str) - Remote directory to backup (mounted locally)
+        backup_dir (str) - Directory to store the snapshots in
+        throttle (Throttle) - Throttle to limit the I/O rate of the engine
+        server (str) - Server the remote directory is mounted from
+        chunk_dir (str) - Directory of the shared chunk store
+        """
+        self.remote_dir = remote_dir
+        self.backup_dir = backup_dir
+        self.throttle = throttle
+        self.server = server
+
+        self.store = ChunkStore(chunk_dir)
+        self.snapshot_dir = os.path.join(backup_dir, 'snapshots')
+        self.cancelled = False
+        self._statistics = {}
+
+    def cancel(self):
+        """ Stops the running backup or restore before its next file. """
+        self.cancelled = True
+
+    def _check_cancelled(self, exception):
+        if self.cancelled:
+            raise exception("Job was terminated.")
+
+    def _charge(self, count):
+        if self.throttle is not None:
+            self.throttle.charge(self.server, count)
+
+    def snapshots(self):
+        """ Returns the (time, path) of each snapshot, oldest first. """
+        if not os.path.isdir(self.snapshot_dir):
+            return []
+        snapshots = []
+        for name in os.listdir(self.snapshot_dir):
+            if name.endswith('.json.gz') and name.split('.')[0].isdigit():
+                snapshots.append((int(name.split('.')[0]),
+                                  os.path.join(self.snapshot_dir, name)))
+        return sorted(snapshots)
+
+    def has_backups(self):
+        """ Returns True if at least one snapshot has been written. """
+        return bool(self.snapshots())
+
+    def backup(self, scan=None):
+        """
+        Backup the remote location as a new snapshot.
+
+        scan (ScanResult) - Changes found by a prescan. When the prescan was
+            compared to the last backup, only changed files are read.
+        """
+        snapshots = self.snapshots()
+        previous = load_snapshot(snapshots[-1][1]) if snapshots else {}
+
+        changed = None
+        if scan is not None and scan.complete and scan.changed is not None \
+                and previous:
+            changed = set(scan.changed)
+
+        entries = {}
+        errors = []
+        new_chunks, new_bytes, reused_bytes = 0, 0, 0
+        changed_files, changed_bytes = 0, 0
+        for relpath in self._walk(scan if changed is not None else None):
+            self._check_cancelled(DedupBackupException)
+
+            old = previous.get(relpath)
+            if old is not None and changed is not None and \
+                    relpath not in changed and old['t'] != 'd':
+                entries[relpath] = old
+                reused_bytes += old.get('s', 0)
+                continue
+
+            path = os.path.join(self.remote_dir, relpath)
+            try:
+                st = os.lstat(path)
+                entry = {'m': stat.S_IMODE(st.st_mode), 'mt': st.st_mtime}
+                if stat.S_ISDIR(st.st_mode):
+                    entry['t'] = 'd'
+                elif stat.S_ISLNK(st.st_mode):
+                    entry['t'] = 'l'
+                    entry['l'] = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode):
+                    entry['t'] = 'f'
+                    entry['s'] = st.st_size
+                    if old is not None and old['t'] == 'f' and \
+                            old['s'] == st.st_size and \
+                            old['mt'] == st.st_mtime:
+                        entry['c'] = old['c']
+                        reused_bytes += st.st_size
+                    else:
+                        entry['c'] = []
+                        changed_files += 1
+                        changed_bytes += st.st_size
+                        with open(path, 'rb') as f:
+                            for chunk in chunks(f):
+                                self._check_cancelled(DedupBackupException)
+                                self._charge(len(chunk))
+                                digest, new = self.store.put(chunk)
+                                entry['c'].append(digest)
+                                if new:
+                                    new_chunks += 1
+                                    new_bytes += len(chunk)
+                                else:
+                                    reused_bytes += len(chunk)
+                else:
+                    continue
+            except (IOError, OSError) as e:
+                errors.append("{}: {}".format(relpath, e))
+                continue
+            entries[relpath] = entry
+
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        when = int(time.time())
+        if snapshots and snapshots[-1][0] >= when:
+            when = snapshots[-1][0] + 1
+        save_snapshot(os.path.join(self.snapshot_dir,
+                                   "{}.json.gz".format(when)), entries)
+
+        files = [entry for entry in entries.values() if entry['t'] == 'f']
+        self._statistics = {
+            'SourceFiles': len(files),
+            'SourceFileSize': sum(entry['s'] for entry in files),
+            'ChangedFiles': changed_files,
+            'ChangedSourceSize': changed_bytes,
+            'IncrementFileSize': new_bytes,
+            'Errors': len(errors),
+        }
+
+        LOGGER.info("Backup: Backed up {} to {} ({} new chunks, {} new bytes, "
+                    "{} bytes deduplicated)."
+                    .format(self.remote_dir, self.backup_dir, new_chunks,
+                            new_bytes, reused_bytes))
+        if errors:
+            raise DedupBackupException("Failed to back up {} files: {}"
+                                       .format(len(errors),
+                                               "; ".join(errors[:10])))
+
+    def run_statistics(self):
+        """ Returns the statistics of the last backup. """
+        return dict(self._statistics)
+
+    def _walk(self, scan):
+        """ Yields the relative paths in the remote location. """
+        if scan is not None:
+            # Directories are not part of a scan, so they are derived
+            directories = set()
+            for relpath in scan.entries:
+                parent = os.path.dirname(relpath)
+                while parent and parent not in directories:
+                    directories.add(parent)
+                    parent = os.path.dirname(parent)
+            for relpath in directories:
+                yield relpath
+            for relpath in scan.entries:
+                yield relpath
+            return
+
+        for dirpath, dirnames, filenames in os.walk(self.remote_dir):
+            relative = os.path.relpath(dirpath, self.remote_dir)
+            for name in dirnames + filenames:
+                if relative == '.':
+                    yield name
+                else:
+                    yield os.path.join(relative, name)
+
+    def snapshot_at(self, time_format):
+        """ Returns the path of the last snapshot at or before a time. """
+        when = parse_time(time_format, time.time())
+        chosen = None
+        for taken, path in self.snapshots():
+            if taken <= when:
+                chosen = path
+        return chosen
+
+    def restore(self, path='/', time_format="1D", workers=1, progress=None):
+        """
+        Restore a path, recursively to the remote location.
+
+        path (str) - Path to restore
+        time_format (str) - Time of the backup to restore, in a format
+            accepted by rdiff-backup
+        workers (int) - Threads restoring files at once
+        progress (callable) - Called with (bytes restored, bytes to restore)
+            as the restore progresses
+        """
+        snapshot = self.snapshot_at(time_format)
+        if snapshot is None:
+            raise DedupRestoreException("No backup of {} as of {}."
+                                        .format(self.backup_dir, time_format))
+        entries = load_snapshot(snapshot)
+
+        prefix = restore_relpath(path)
+        selected = sorted(relpath for relpath in entries
+                          if not prefix or relpath == prefix or
+                          relpath.startswith(prefix + '/'))
+        if not selected:
+            raise DedupRestoreException("{} is not in the backup as of {}."
+                                        .format(path, time_format))
+
+        # Directories and links first, so files can be restored in any order
+        directories = []
+        files = []
+        for relpath in selected:
+            self._check_cancelled(DedupRestoreException)
+            entry = entries[relpath]
+            dest = os.path.join(self.remote_dir, relpath)
+            parent = os.path.dirname(dest)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            if entry['t'] == 'd':
+                if not os.path.isdir(dest):
+                    os.makedirs(dest)
+                directories.append((dest, entry))
+            elif entry['t'] == 'l':
+                if os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.remove(dest)
+                os.symlink(entry['l'], dest)
+            else:
+                files.append((dest, entry))
+
+        total = sum(entry['s'] for _, entry in files) or 1
+        done = [0]
+        lock = threading.Lock()
+
+        def restore_file(item):
+            dest, entry = item
+            tmp_path = dest + '.restore.tmp'
+            with open(tmp_path, 'wb') as f:
+                for digest in entry['c']:
+                    self._check_cancelled(DedupRestoreException)
+                    data = self.store.get(digest)
+                    self._charge(len(data))
+                    f.write(data)
+            os.rename(tmp_path, dest)
+            os.chmod(dest, entry['m'])
+            os.utime(dest, (entry['mt'], entry['mt']))
+            if progress is not None:
+                with lock:
+                    done[0] += entry['s']
+                    progress(done[0], total)
+
+        parallel_map(restore_file, files, workers)
+
+        # Restoring files changes the times of their directories
+        for dest, entry in reversed(directories):
+            os.chmod(dest, entry['m'])
+            os.utime(dest, (entry['mt'], entry['mt']))
+
+        LOGGER.info("Restore: Restored (time: {}) {} to {} successfully."
+                    .format(time_format, path, self.remote_dir))
+
+    def prune(self, retention, timeout=None):
+        """
+        Removes snapshots older than the retention period, always keeping
+        the latest, then collects the chunks no snapshot uses any more.
+
+        retention (int) - Days of snapshots to keep
+        timeout (float) - Seconds after which chunks are no longer
+            collected, None for no limit
+        Returns the bytes freed.
+        """
+        started = time.time()
+        snapshots = self.snapshots()
+        cutoff = started - retention * 24 * 60 * 60
+        freed = 0
+        for taken, path in snapshots[:-1]:
+            if taken < cutoff:
+                freed += os.path.getsize(path)
+                os.remove(path)
+                LOGGER.info("Prune: Removed snapshot {}.".format(path))
+
+        # Collecting reads every snapshot, so it is done at most daily
+        marker = os.path.join(self.store.root, '.last-gc')
+        if not os.path.isdir(self.store.root):
+            return freed
+        if os.path.exists(marker) and \
+                time.time() - os.path.getmtime(marker) < GC_INTERVAL:
+            return freed
+        if timeout is not None and time.time() - started >= timeout:
+            return freed
+        with open(marker, 'w'):
+            pass
+
+        backups_dir = os.path.dirname(self.backup_dir)
+        all_snapshots = []
+        for name in os.listdir(backups_dir):
+            snapshot_dir = os.path.join(backups_dir, name, 'snapshots')
+            if os.path.isdir(snapshot_dir):
+                all_snapshots.extend(
+                    os.path.join(snapshot_dir, snapshot)
+                    for snapshot in os.listdir(snapshot_dir)
+                    if snapshot.endswith('.json.gz'))
+        removed, reclaimed = self.store.collect_garbage(all_snapshots)
+        LOGGER.info("Prune: Removed {} unused chunks ({} bytes) from {}."
+                    .format(removed, reclaimed, self.store.root))
+        return freed + reclaimed
+
+    def _latest_files(self):
+        snapshots = self.snapshots()
+        if not snapshots:
+            return {}
+        return dict((relpath, entry) for relpath, entry
+                    in load_snapshot(snapshots[-1][1]).items()
+                    if entry['t'] == 'f')
+
+    def files(self):
+        """
+        Returns the size of each regular file in the latest snapshot, by
+        relative path.
+        """
+        return dict((relpath, entry['s']) for relpath, entry
+                    in self._latest_files().items())
+
+    def increments(self):
+        """ Returns the (time, label) of each snapshot, oldest first. """
+        return [(when, when) for when, _ in self.snapshots()]
+
+    def listing(self, label):
+        """ Returns the files and directories of the snapshot at label. """
+        path = os.path.join(self.snapshot_dir, "{}.json.gz".format(label))
+        if not os.path.isfile(path):
+            return None
+        return [(relpath, entry.get('s'), entry['mt']) for relpath, entry
+                in load_snapshot(path).items() if entry['t'] in ('f', 'd')]
+
+    def verify(self, workers=None):
+        """
+        Reads every chunk the snapshots of this backup use, in parallel,
+        and compares it with the SHA-256 it is named by.
+
+        workers (int) - Threads to hash with, one per core by default
+        Returns (chunks checked, list of failures).
+        """
+        digests = set()
+        for _, path in self.snapshots():
+            for entry in load_snapshot(path).values():
+                digests.update(entry.get('c', ()))
+
+        def check(digest):
+            if self.cancelled:
+                raise DedupVerifyException("Verify was terminated.")
+            self.store.get(digest)
+
+        checked, failures = parallel_check(check, sorted(digests), workers)
+        LOGGER.info("Verify: Checked {} chunks of {}, {} failed."
+                    .format(checked, self.backup_dir, len(failures)))
+        return checked, failures
+
+    def check_restored(self, relpath, path):
+        """
+        Returns True if a restored file splits into the chunks the latest
+        snapshot lists for it.
+        """
+        entry = self._latest_files().get(relpath)
+        if entry is None:
+            return False
+        with open(path, 'rb') as f:
+            digests = [hashlib.sha256(chunk).hexdigest()
+                       for chunk in chunks(f)]
+        return digests == entry['c']
+
+
+class DedupBackupException(Exception):
+    pass
+
+
+class DedupRestoreException(Exception):
+    pass
+
+
+class DedupVerifyException(Exception):
+    pass
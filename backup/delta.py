@@ -0,0 +1,1013 @@
+"""
+Block-delta backups. The backup directory holds a mirror of the share, the
+metadata of the share as of each run, and for each run the reverse deltas
+that turn the files it changed back into their previous versions.
+
+Changed files are compared to their mirrored version with rsync-style
+rolling checksums. The block signatures of each mirrored file are kept on
+disk, keyed by path, size and mtime, so a changed file is read once from
+the share and its mirror is never read to recompute signatures.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import struct
+import threading
+import time
+import zlib
+
+from backup import AbstractBackupEngine, restore_relpath, tree_size
+from checksum import parallel_check
+from pool import parallel_map
+from timespec import parse_time
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+# Block sizes grow with the square root of the file size, so the signature
+# of a large VM image stays small
+BLOCK_MIN = 8 * 1024
+BLOCK_MAX = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+# Largest literal written to a delta as one operation
+LITERAL_MAX = 1024 * 1024
+# Blocks of unmatched data searched a byte at a time after the last match.
+# Past them, only one block of positions in every SEARCH_STRIDE blocks is
+# searched a byte at a time, and only block-aligned windows in between.
+SEARCH_BLOCKS = 8
+SEARCH_STRIDE = 16
+
+ADLER_MOD = 65521
+
+# Suffixes of the increment files of a run
+DIFF_SUFFIX = '.diff'
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+def block_size_for(size):
+    """ Returns the block size of the signature of a file. """
+    block_size = BLOCK_MIN
+    while block_size * block_size < size and block_size < BLOCK_MAX:
+        block_size *= 2
+    return block_size
+
+
+def weak_checksum(data):
+    """ Returns the Adler-32 weak checksum of a block. """
+    return zlib.adler32(bytes(data)) & 0xffffffff
+
+
+def strong_checksum(data):
+    return hashlib.md5(bytes(data)).digest()
+
+
+class Signature(object):
+    """
+    Signature holds the weak and strong checksums of each block of one
+    version of a file, identified by its size and mtime.
+    """
+
+    RECORD = struct.Struct('>I16s')
+
+    def __init__(self, size, mtime, block_size=None):
+        """
+        size (int) - Size of the file version
+        mtime (float) - Modification time of the file version
+        block_size (int) - Size of the blocks, by default chosen by size
+        """
+        self.size = size
+        self.mtime = mtime
+        self.block_size = block_size or block_size_for(size)
+        self.weak = []
+        self.strong = []
+        self._pending = bytearray()
+        self._table = None
+
+    def matches(self, size, mtime):
+        """ Returns True if the signature is of the given file version. """
+        return self.size == size and self.mtime == mtime
+
+    def update(self, data):
+        """ Adds data of the file, in order, to the signature. """
+        self._pending += data
+        block_size = self.block_size
+        start = 0
+        while len(self._pending) - start >= block_size:
+            self._add_block(self._pending[start:start + block_size])
+            start += block_size
+        del self._pending[:start]
+
+    def finish(self):
+        """ Adds the last, partial block. """
+        if self._pending:
+            self._add_block(self._pending)
+            self._pending = bytearray()
+        return self
+
+    def _add_block(self, block):
+        self.weak.append(weak_checksum(block))
+        self.strong.append(strong_checksum(block))
+
+    def block_length(self, index):
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def weak_table(self):
+        """ Returns the indexes of the blocks by weak checksum. """
+        if self._table is None:
+            self._table = {}
+            for index, checksum in enumerate(self.weak):
+                self._table.setdefault(checksum, []).append(index)
+        return self._table
+
+    def find(self, weak, block):
+        """
+        Returns the index of a block with the given weak checksum and
+        content, or None.
+        """
+        candidates = self.weak_table().get(weak)
+        if not candidates:
+            return None
+        strong = strong_checksum(block)
+        for index in candidates:
+            if self.strong[index] == strong and \
+                    self.block_length(index) == len(block):
+                return index
+        return None
+
+    @classmethod
+    def compute(cls, path, size, mtime):
+        """ Returns the signature of a local file. """
+        signature = cls(size, mtime)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                signature.update(data)
+        return signature.finish()
+
+    def save(self, path):
+        """ Writes the signature, atomically. """
+        header = json.dumps({'size': self.size, 'mtime': self.mtime,
+                             'block_size': self.block_size})
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header.encode('utf-8') + b'\n')
+            for weak, strong in zip(self.weak, self.strong):
+                f.write(self.RECORD.pack(weak, strong))
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the signature stored at path, or None. """
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                records = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        signature = cls(header['size'], header['mtime'],
+                        header['block_size'])
+        size = cls.RECORD.size
+        for offset in range(0, len(records) - size + 1, size):
+            weak, strong = cls.RECORD.unpack_from(records, offset)
+            signature.weak.append(weak)
+            signature.strong.append(strong)
+        return signature
+
+
+def delta(f, signature, on_read=None):
+    """
+    Yields the operations that build the content of file object f from the
+    file described by signature: ('copy', basis block index) or
+    ('data', bytes).
+
+    Runs of matching blocks are found with C-level checksums. Data that
+    matches no block is searched one byte at a time in Python, at about
+    3 MB/s on one core, so only the first SEARCH_BLOCKS blocks after a
+    match are searched at every position. Past them the search skips
+    ahead, trying the window at every position over one block in every
+    SEARCH_STRIDE blocks, which still finds a run of more than
+    SEARCH_STRIDE matching blocks at any offset, and only block-aligned
+    windows in between. A file rewritten throughout, such as a compressed
+    or encrypted one, is read at about 45 MB/s (see benchmarks/hashing.py).
+
+    on_read (callable) - Called with each block of data read from f
+    """
+    block_size = signature.block_size
+    table = signature.weak_table()
+    last = len(signature.weak) - 1
+    buf = bytearray()
+    pos = 0
+    # Offset in f of the start of buf
+    offset = 0
+    literal = bytearray()
+    eof = False
+    # Next basis block, tried before anything is hashed so runs of
+    # unchanged blocks cost one strong checksum each
+    expected = 0
+    weak = None
+    # Positions still searched a byte at a time, and block-aligned windows
+    # to try before searching a byte at a time again
+    budget = SEARCH_BLOCKS * block_size
+    skips = 0
+
+    while True:
+        if not eof and len(buf) - pos <= block_size:
+            del buf[:pos]
+            offset += pos
+            pos = 0
+            data = f.read(READ_SIZE)
+            if data:
+                if on_read is not None:
+                    on_read(data)
+                buf += data
+            else:
+                eof = True
+            continue
+
+        remaining = len(buf) - pos
+        if remaining < block_size:
+            # The tail can only match the last, partial basis block
+            tail = buf[pos:]
+            if tail and last >= 0 and signature.block_length(last) == \
+                    len(tail) and signature.strong[last] == \
+                    strong_checksum(tail):
+                if literal:
+                    yield ('data', bytes(literal))
+                yield ('copy', last)
+            else:
+                literal += tail
+                if literal:
+                    yield ('data', bytes(literal))
+            return
+        length = block_size
+
+        index = None
+        window = buf[pos:pos + length]
+        if weak is None:
+            if 0 <= expected <= last and \
+                    signature.block_length(expected) == length and \
+                    signature.strong[expected] == strong_checksum(window):
+                index = expected
+            else:
+                weak = weak_checksum(window)
+        if index is None and weak is not None:
+            index = signature.find(weak, window)
+
+        if index is not None:
+            if literal:
+                yield ('data', bytes(literal))
+                literal = bytearray()
+            yield ('copy', index)
+            pos += length
+            expected = index + 1
+            weak = None
+            budget = SEARCH_BLOCKS * block_size
+            skips = 0
+            continue
+
+        start = pos
+        if skips:
+            # Far from the last match, only the next window aligned with
+            # the blocks of the basis is tried
+            skips -= 1
+            if not skips:
+                budget = block_size
+            pos += block_size - (offset + pos) % block_size
+            weak = None
+            expected = -1
+            literal += buf[start:pos]
+            while len(literal) >= LITERAL_MAX:
+                yield ('data', bytes(literal[:LITERAL_MAX]))
+                del literal[:LITERAL_MAX]
+            continue
+
+        # No block starts here, roll the window on byte by byte until a
+        # block matches, the budget runs out or the window reaches the end
+        # of the buffer. The literal is copied from the buffer once, not
+        # byte by byte.
+        end = min(len(buf) - block_size, pos + budget)
+        a = weak & 0xffff
+        b = weak >> 16
+        while pos < end:
+            out = buf[pos]
+            a = (a - out + buf[pos + block_size]) % ADLER_MOD
+            b = (b - block_size * out + a - 1) % ADLER_MOD
+            pos += 1
+            if (b << 16) | a in table:
+                weak = (b << 16) | a
+                break
+        else:
+            # The next window is not in the buffer yet, or is past the
+            # budget
+            pos += 1
+            weak = None
+            expected = -1
+        budget -= pos - start
+        if budget <= 0:
+            skips = SEARCH_STRIDE - 1
+        literal += buf[start:pos]
+        while len(literal) >= LITERAL_MAX:
+            yield ('data', bytes(literal[:LITERAL_MAX]))
+            del literal[:LITERAL_MAX]
+
+
+class DeltaWriter(object):
+    """
+    DeltaWriter writes delta operations: copies of byte ranges of a basis
+    file and literal data.
+    """
+
+    COPY = struct.Struct('>cQQ')
+    DATA = struct.Struct('>cQ')
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = path + '.tmp'
+        self._file = gzip.open(self._tmp_path, 'wb', 1)
+        # Pending copy, merged with the following adjacent copies
+        self._copy = None
+
+    def copy(self, offset, length):
+        if self._copy is not None and \
+                self._copy[0] + self._copy[1] == offset:
+            self._copy = (self._copy[0], self._copy[1] + length)
+            return
+        self._flush()
+        self._copy = (offset, length)
+
+    def data(self, data):
+        self._flush()
+        self._file.write(self.DATA.pack(b'D', len(data)))
+        self._file.write(data)
+
+    def _flush(self):
+        if self._copy is not None:
+            self._file.write(self.COPY.pack(b'C', *self._copy))
+            self._copy = None
+
+    def close(self):
+        """ Finishes the delta, atomically. """
+        self._flush()
+        self._file.close()
+        os.rename(self._tmp_path, self.path)
+
+
+def patch(basis_path, delta_path, out_path):
+    """ Writes the file that a delta builds from a basis file. """
+    with open(basis_path, 'rb') as basis, \
+            gzip.open(delta_path, 'rb') as ops, \
+            open(out_path, 'wb') as out:
+        while True:
+            kind = ops.read(1)
+            if not kind:
+                break
+            if kind == b'C':
+                offset, length = struct.unpack('>QQ', ops.read(16))
+                basis.seek(offset)
+                while length > 0:
+                    data = basis.read(min(length, READ_SIZE))
+                    if not data:
+                        raise DeltaRestoreException(
+                            "{} is shorter than its delta expects."
+                            .format(basis_path))
+                    out.write(data)
+                    length -= len(data)
+            elif kind == b'D':
+                length, = struct.unpack('>Q', ops.read(8))
+                while length > 0:
+                    data = ops.read(min(length, READ_SIZE))
+                    out.write(data)
+                    length -= len(data)
+            else:
+                raise DeltaRestoreException("{} is corrupt."
+                                            .format(delta_path))
+
+
+def load_metadata(path):
+    """ Returns the entries of a metadata snapshot by relative path. """
+    with gzip.open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def save_metadata(path, entries):
+    """ Writes the entries of a metadata snapshot, atomically. """
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(entries).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+class DeltaBackupEngine(AbstractBackupEngine):
+    """
+    DeltaBackupEngine stores a mirror of the remote directory plus reverse
+    deltas of every version it replaced.
+
+    backup_dir/mirror - Latest version of each file
+    backup_dir/metadata/<time>.json.gz - Files as of the run at time
+    backup_dir/increments/<time>/ - Reverse deltas (.diff) and removed
+        files (.snapshot) that turn the run at time into the run before it
+    backup_dir/signatures/ - Block signatures of the mirrored files
+    """
+
+    def __init__(self, remote_dir, backup_dir, throttle=None, server=None):
+        """
+        remote_dir (str) - Remote directory to backup (mounted locally)
+        backup_dir (str) - Destination directory to store backups
+        throttle (Throttle) - Throttle to limit the I/O rate of the engine
+        server (str) - Server the remote directory is mounted from
+        """
+        self.remote_dir = remote_dir
+        self.backup_dir = backup_dir
+        self.throttle = throttle
+        self.server = server
+
+        self.mirror_dir = os.path.join(backup_dir, 'mirror')
+        self.metadata_dir = os.path.join(backup_dir, 'metadata')
+        self.increments_dir = os.path.join(backup_dir, 'increments')
+        self.signatures_dir = os.path.join(backup_dir, 'signatures')
+        self.cancelled = False
+        self._statistics = {}
+
+    def cancel(self):
+        """ Stops the running backup or restore before its next block. """
+        self.cancelled = True
+
+    def _check_cancelled(self, exception):
+        if self.cancelled:
+            raise exception("Job was terminated.")
+
+    def _charge(self, data):
+        if self.throttle is not None:
+            self.throttle.charge(self.server, len(data))
+
+    def runs(self):
+        """ Returns the times of the runs with metadata, oldest first. """
+        if not os.path.isdir(self.metadata_dir):
+            return []
+        return sorted(int(name.split('.')[0])
+                      for name in os.listdir(self.metadata_dir)
+                      if name.endswith('.json.gz') and
+                      name.split('.')[0].isdigit())
+
+    def _increment_runs(self):
+        if not os.path.isdir(self.increments_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(self.increments_dir)
+                      if name.isdigit())
+
+    def _metadata_path(self, run):
+        return os.path.join(self.metadata_dir, "{}.json.gz".format(run))
+
+    def _signature_path(self, relpath):
+        if isinstance(relpath, type(u'')):
+            relpath = relpath.encode('utf-8')
+        return os.path.join(self.signatures_dir,
+                            hashlib.sha1(relpath).hexdigest())
+
+    def has_backups(self):
+        """ Returns True if at least one run has completed. """
+        return bool(self.runs())
+
+    def backup(self, scan=None):
+        """
+        Backup the remote location. Only files whose size or mtime changed
+        since the last run are read.
+
+        scan (ScanResult) - Changes found by a prescan. When the prescan was
+            compared to the last backup, only changed files are looked at.
+        """
+        self._regress()
+        runs = self.runs()
+        previous = load_metadata(self._metadata_path(runs[-1])) \
+            if runs else {}
+
+        run = max([int(time.time())] + [r + 1 for r in runs])
+        increment_dir = os.path.join(self.increments_dir, str(run))
+        for directory in (self.mirror_dir, self.metadata_dir,
+                          increment_dir, self.signatures_dir):
+            _makedirs(directory)
+
+        changed = None
+        if scan is not None and scan.complete and scan.changed is not None \
+                and previous:
+            changed = set(scan.changed)
+
+        # Entries of the remote location
+        entries = {}
+        errors = []
+        for relpath in self._walk(scan if changed is not None else None):
+            old = previous.get(relpath)
+            if old is not None and changed is not None and \
+                    relpath not in changed and old['t'] == 'f':
+                entries[relpath] = old
+                continue
+            try:
+                entry = self._entry(relpath)
+            except (IOError, OSError) as e:
+                errors.append("{}: {}".format(relpath, e))
+                if old is not None:
+                    entries[relpath] = old
+                continue
+            if entry is not None:
+                entries[relpath] = entry
+
+        # Files that are gone, or no longer files, are moved out of the
+        # mirror whole
+        for relpath, old in sorted(previous.items()):
+            if old['t'] == 'f' and entries.get(relpath, {}).get('t') != 'f':
+                self._remove_file(relpath, increment_dir)
+        for relpath, old in sorted(previous.items(), reverse=True):
+            if old['t'] == 'd' and entries.get(relpath, {}).get('t') != 'd':
+                try:
+                    os.rmdir(os.path.join(self.mirror_dir, relpath))
+                except OSError:
+                    pass
+
+        read_bytes, changed_files, changed_bytes = 0, 0, 0
+        for relpath in sorted(entries):
+            self._check_cancelled(DeltaBackupException)
+            entry = entries[relpath]
+            mirror_path = os.path.join(self.mirror_dir, relpath)
+            if entry['t'] == 'd':
+                _makedirs(mirror_path)
+                continue
+            if entry['t'] != 'f':
+                continue
+
+            old = previous.get(relpath)
+            if old is not None and old['t'] == 'f' and \
+                    old['s'] == entry['s'] and old['mt'] == entry['mt']:
+                if old['m'] != entry['m'] and os.path.exists(mirror_path):
+                    os.chmod(mirror_path, entry['m'])
+                continue
+
+            try:
+                read_bytes += self._update_file(relpath, entry, old,
+                                                increment_dir)
+                changed_files += 1
+                changed_bytes += entry['s']
+            except (IOError, OSError) as e:
+                errors.append("{}: {}".format(relpath, e))
+                if old is not None and old['t'] == 'f':
+                    entries[relpath] = old
+                else:
+                    del entries[relpath]
+
+        # The run is complete once its metadata is written
+        save_metadata(self._metadata_path(run), entries)
+
+        files = [entry for entry in entries.values() if entry['t'] == 'f']
+        self._statistics = {
+            'SourceFiles': len(files),
+            'SourceFileSize': sum(entry['s'] for entry in files),
+            'ChangedFiles': changed_files,
+            'ChangedSourceSize': changed_bytes,
+            'IncrementFileSize': tree_size(increment_dir),
+            'Errors': len(errors),
+        }
+
+        LOGGER.info("Backup: Backed up {} to {} ({} bytes read)."
+                    .format(self.remote_dir, self.backup_dir, read_bytes))
+        if errors:
+            raise DeltaBackupException("Failed to back up {} files: {}"
+                                       .format(len(errors),
+                                               "; ".join(errors[:10])))
+
+    def run_statistics(self):
+        """ Returns the statistics of the last backup. """
+        return dict(self._statistics)
+
+    def _walk(self, scan):
+        """ Yields the relative paths in the remote location. """
+        if scan is not None:
+            # Directories are not part of a scan, so they are derived
+            directories = set()
+            for relpath in scan.entries:
+                parent = os.path.dirname(relpath)
+                while parent and parent not in directories:
+                    directories.add(parent)
+                    parent = os.path.dirname(parent)
+            for relpath in directories:
+                yield relpath
+            for relpath in scan.entries:
+                yield relpath
+            return
+
+        for dirpath, dirnames, filenames in os.walk(self.remote_dir):
+            relative = os.path.relpath(dirpath, self.remote_dir)
+            for name in dirnames + filenames:
+                if relative == '.':
+                    yield name
+                else:
+                    yield os.path.join(relative, name)
+
+    def _entry(self, relpath):
+        """ Returns the metadata of a remote path, None if not backed up. """
+        path = os.path.join(self.remote_dir, relpath)
+        st = os.lstat(path)
+        entry = {'m': stat.S_IMODE(st.st_mode), 'mt': st.st_mtime}
+        if stat.S_ISDIR(st.st_mode):
+            entry['t'] = 'd'
+        elif stat.S_ISLNK(st.st_mode):
+            entry['t'] = 'l'
+            entry['l'] = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            entry['t'] = 'f'
+            entry['s'] = st.st_size
+        else:
+            return None
+        return entry
+
+    def _remove_file(self, relpath, increment_dir):
+        """ Moves a file that is gone from the mirror into the increment. """
+        mirror_path = os.path.join(self.mirror_dir, relpath)
+        if not os.path.isfile(mirror_path):
+            return
+        snapshot_path = os.path.join(increment_dir, relpath + SNAPSHOT_SUFFIX)
+        _makedirs(os.path.dirname(snapshot_path))
+        os.rename(mirror_path, snapshot_path)
+        signature_path = self._signature_path(relpath)
+        if os.path.exists(signature_path):
+            os.remove(signature_path)
+
+    def _update_file(self, relpath, entry, old, increment_dir):
+        """
+        Brings the mirror of a changed file up to date, leaving the reverse
+        delta in the increment. Returns the bytes read from the share.
+        """
+        remote_path = os.path.join(self.remote_dir, relpath)
+        mirror_path = os.path.join(self.mirror_dir, relpath)
+        signature_path = self._signature_path(relpath)
+        tmp_path = mirror_path + '.delta.tmp'
+        _makedirs(os.path.dirname(mirror_path))
+
+        new_signature = Signature(entry['s'], entry['mt'])
+        read = [0]
+
+        def on_read(data):
+            self._check_cancelled(DeltaBackupException)
+            self._charge(data)
+            new_signature.update(data)
+            read[0] += len(data)
+
+        if old is None or old['t'] != 'f' or \
+                not os.path.isfile(mirror_path):
+            # New file, copied whole
+            with open(remote_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                while True:
+                    data = src.read(READ_SIZE)
+                    if not data:
+                        break
+                    on_read(data)
+                    dst.write(data)
+        else:
+            signature = Signature.load(signature_path)
+            if signature is None or \
+                    not signature.matches(old['s'], old['mt']):
+                LOGGER.info("Backup: Computing the missing signature of {}."
+                            .format(mirror_path))
+                signature = Signature.compute(mirror_path, old['s'],
+                                              old['mt'])
+
+            # Offset in the new version of each basis block it reuses
+            reused = {}
+            with open(remote_path, 'rb') as src, \
+                    open(mirror_path, 'rb') as basis, \
+                    open(tmp_path, 'wb') as dst:
+                offset = 0
+                for kind, value in delta(src, signature, on_read):
+                    if kind == 'copy':
+                        length = signature.block_length(value)
+                        basis.seek(value * signature.block_size)
+                        data = basis.read(length)
+                        reused.setdefault(value, offset)
+                    else:
+                        data = value
+                    dst.write(data)
+                    offset += len(data)
+
+            # The reverse delta rebuilds the old version from the new one
+            diff_path = os.path.join(increment_dir, relpath + DIFF_SUFFIX)
+            _makedirs(os.path.dirname(diff_path))
+            writer = DeltaWriter(diff_path)
+            with open(mirror_path, 'rb') as basis:
+                for index in range(len(signature.weak)):
+                    length = signature.block_length(index)
+                    if index in reused:
+                        writer.copy(reused[index], length)
+                    else:
+                        basis.seek(index * signature.block_size)
+                        writer.data(basis.read(length))
+            writer.close()
+
+        os.chmod(tmp_path, entry['m'])
+        os.utime(tmp_path, (entry['mt'], entry['mt']))
+        os.rename(tmp_path, mirror_path)
+        new_signature.finish().save(signature_path)
+        return read[0]
+
+    def _regress(self):
+        """
+        Undoes the changes a run that did not complete made to the mirror.
+        """
+        runs = self.runs()
+        latest = runs[-1] if runs else 0
+        incomplete = [run for run in self._increment_runs() if run > latest]
+        if not incomplete:
+            return
+
+        previous = load_metadata(self._metadata_path(latest)) if runs else {}
+        for run in reversed(incomplete):
+            increment_dir = os.path.join(self.increments_dir, str(run))
+            LOGGER.info("Backup: Regressing the incomplete run {}."
+                        .format(increment_dir))
+            for dirpath, _, filenames in os.walk(increment_dir):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    relpath = os.path.relpath(path, increment_dir)
+                    if name.endswith(SNAPSHOT_SUFFIX):
+                        relpath = relpath[:-len(SNAPSHOT_SUFFIX)]
+                        mirror_path = os.path.join(self.mirror_dir, relpath)
+                        _makedirs(os.path.dirname(mirror_path))
+                        os.rename(path, mirror_path)
+                    elif name.endswith(DIFF_SUFFIX):
+                        relpath = relpath[:-len(DIFF_SUFFIX)]
+                        self._regress_file(relpath, path,
+                                           previous.get(relpath))
+
+            # Anything else in the mirror was added by the incomplete run
+            for dirpath, dirnames, filenames in os.walk(self.mirror_dir,
+                                                        topdown=False):
+                for name in filenames + dirnames:
+                    path = os.path.join(dirpath, name)
+                    relpath = os.path.relpath(path, self.mirror_dir)
+                    if relpath in previous:
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                        signature_path = self._signature_path(relpath)
+                        if os.path.exists(signature_path):
+                            os.remove(signature_path)
+            shutil.rmtree(increment_dir)
+
+    def _regress_file(self, relpath, diff_path, old):
+        """ Restores the previous version of a file in the mirror. """
+        mirror_path = os.path.join(self.mirror_dir, relpath)
+        if old is None or not os.path.isfile(mirror_path):
+            return
+        st = os.stat(mirror_path)
+        if st.st_size == old['s'] and st.st_mtime == old['mt']:
+            # The mirror was not replaced before the run stopped
+            return
+        tmp_path = mirror_path + '.delta.tmp'
+        patch(mirror_path, diff_path, tmp_path)
+        os.chmod(tmp_path, old['m'])
+        os.utime(tmp_path, (old['mt'], old['mt']))
+        os.rename(tmp_path, mirror_path)
+        signature_path = self._signature_path(relpath)
+        if os.path.exists(signature_path):
+            os.remove(signature_path)
+
+    def restore(self, path='/', time_format="1D", workers=1, progress=None):
+        """
+        Restore a path, recursively to the remote location.
+
+        path (str) - Path to restore
+        time_format (str) - Time of the backup to restore, in a format
+            accepted by rdiff-backup
+        workers (int) - Threads restoring files at once
+        progress (callable) - Called with (bytes restored, bytes to restore)
+            as the restore progresses
+        """
+        when = parse_time(time_format, time.time())
+        runs = [run for run in self.runs() if run <= when]
+        if not runs:
+            raise DeltaRestoreException("No backup of {} as of {}."
+                                        .format(self.backup_dir, time_format))
+        run = runs[-1]
+        entries = load_metadata(self._metadata_path(run))
+        # Increments to apply, newest first, to go back from the mirror
+        increments = [os.path.join(self.increments_dir, str(r)) for r
+                      in reversed(self._increment_runs()) if r > run]
+
+        prefix = restore_relpath(path)
+        selected = sorted(relpath for relpath in entries
+                          if not prefix or relpath == prefix or
+                          relpath.startswith(prefix + '/'))
+        if not selected:
+            raise DeltaRestoreException("{} is not in the backup as of {}."
+                                        .format(path, time_format))
+
+        # Directories and links first, so files can be restored in any order
+        directories = []
+        files = []
+        for relpath in selected:
+            self._check_cancelled(DeltaRestoreException)
+            entry = entries[relpath]
+            dest = os.path.join(self.remote_dir, relpath)
+            _makedirs(os.path.dirname(dest))
+
+            if entry['t'] == 'd':
+                _makedirs(dest)
+                directories.append((dest, entry))
+            elif entry['t'] == 'l':
+                if os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.remove(dest)
+                os.symlink(entry['l'], dest)
+            else:
+                files.append((relpath, dest, entry))
+
+        total = sum(entry['s'] for _, _, entry in files) or 1
+        done = [0]
+        lock = threading.Lock()
+
+        def restore_file(item):
+            relpath, dest, entry = item
+            self._restore_file(relpath, increments, dest)
+            os.chmod(dest, entry['m'])
+            os.utime(dest, (entry['mt'], entry['mt']))
+            if progress is not None:
+                with lock:
+                    done[0] += entry['s']
+                    progress(done[0], total)
+
+        parallel_map(restore_file, files, workers)
+
+        # Restoring files changes the times of their directories
+        for dest, entry in reversed(directories):
+            os.chmod(dest, entry['m'])
+            os.utime(dest, (entry['mt'], entry['mt']))
+
+        LOGGER.info("Restore: Restored (time: {}) {} to {} successfully."
+                    .format(time_format, path, self.remote_dir))
+
+    def _restore_file(self, relpath, increments, dest):
+        """ Rebuilds a file from the mirror and increments into dest. """
+        current = os.path.join(self.mirror_dir, relpath)
+        temporary = []
+        try:
+            for increment_dir in increments:
+                snapshot_path = os.path.join(increment_dir,
+                                             relpath + SNAPSHOT_SUFFIX)
+                diff_path = os.path.join(increment_dir, relpath + DIFF_SUFFIX)
+                if os.path.exists(snapshot_path):
+                    current = snapshot_path
+                elif os.path.exists(diff_path):
+                    tmp_path = "{}.{}.tmp".format(dest, len(temporary))
+                    patch(current, diff_path, tmp_path)
+                    temporary.append(tmp_path)
+                    current = tmp_path
+
+            tmp_path = dest + '.restore.tmp'
+            with open(current, 'rb') as src, open(tmp_path, 'wb') as dst:
+                while True:
+                    self._check_cancelled(DeltaRestoreException)
+                    data = src.read(READ_SIZE)
+                    if not data:
+                        break
+                    self._charge(data)
+                    dst.write(data)
+            os.rename(tmp_path, dest)
+        finally:
+            for tmp_path in temporary:
+                os.remove(tmp_path)
+
+    def prune(self, retention, timeout=None):
+        """
+        Removes the runs older than the retention period, always keeping
+        the latest.
+
+        retention (int) - Days of runs to keep
+        timeout (float) - Seconds after which no more increments are
+            removed, None for no limit
+        Returns the bytes freed.
+        """
+        runs = self.runs()
+        if not runs:
+            return 0
+        deadline = time.time() + timeout if timeout is not None else None
+        cutoff = time.time() - retention * 24 * 60 * 60
+        oldest = min([run for run in runs if run >= cutoff] + [runs[-1]])
+
+        freed = 0
+        for run in runs:
+            if run < oldest:
+                path = self._metadata_path(run)
+                freed += os.path.getsize(path)
+                os.remove(path)
+        # Increments of a run lead back to the run before it. The runs they
+        # lead back to are gone, so the ones left are removed next time.
+        for run in self._increment_runs():
+            if deadline is not None and time.time() >= deadline:
+                break
+            if run <= oldest:
+                path = os.path.join(self.increments_dir, str(run))
+                freed += tree_size(path)
+                shutil.rmtree(path)
+
+        LOGGER.info("Prune: Removed runs older than {} days from {}."
+                    .format(retention, self.backup_dir))
+        return freed
+
+    def _latest_files(self):
+        runs = self.runs()
+        if not runs:
+            return {}
+        return dict((relpath, entry) for relpath, entry
+                    in load_metadata(self._metadata_path(runs[-1])).items()
+                    if entry['t'] == 'f')
+
+    def files(self):
+        """
+        Returns the size of each regular file in the latest run, by
+        relative path.
+        """
+        return dict((relpath, entry['s']) for relpath, entry
+                    in self._latest_files().items())
+
+    def increments(self):
+        """ Returns the (time, label) of each run, oldest first. """
+        return [(run, run) for run in self.runs()]
+
+    def listing(self, label):
+        """ Returns the files and directories of the run at label. """
+        path = self._metadata_path(label)
+        if not os.path.isfile(path):
+            return None
+        return [(relpath, entry.get('s'), entry['mt']) for relpath, entry
+                in load_metadata(path).items() if entry['t'] in ('f', 'd')]
+
+    def _check_signature(self, relpath, entry, path):
+        """
+        Returns None if a file matches the stored signature of a mirrored
+        file, else a description of the failure.
+        """
+        signature = Signature.load(self._signature_path(relpath))
+        if signature is None or \
+                not signature.matches(entry['s'], entry['mt']):
+            return "{}: No signature is stored.".format(relpath)
+        if os.path.getsize(path) != entry['s']:
+            return "{}: Size does not match.".format(relpath)
+        actual = Signature.compute(path, entry['s'], entry['mt'])
+        if actual.strong != signature.strong:
+            return "{}: Block checksums do not match.".format(relpath)
+        return None
+
+    def verify(self, workers=None):
+        """
+        Hashes the mirror in parallel and compares each file with its
+        stored block signature. Increments are not checked.
+
+        workers (int) - Threads to hash with, one per core by default
+        Returns (files checked, list of failures).
+        """
+        files = self._latest_files()
+
+        def check(relpath):
+            if self.cancelled:
+                raise DeltaVerifyException("Verify was terminated.")
+            return self._check_signature(
+                relpath, files[relpath],
+                os.path.join(self.mirror_dir, relpath))
+
+        checked, failures = parallel_check(check, sorted(files), workers)
+        LOGGER.info("Verify: Checked {} files in {}, {} failed."
+                    .format(checked, self.backup_dir, len(failures)))
+        return checked, failures
+
+    def check_restored(self, relpath, path):
+        """
+        Returns True if a restored file matches the stored block signature
+        of its latest version.
+        """
+        entry = self._latest_files().get(relpath)
+        if entry is None:
+            return False
+        return self._check_signature(relpath, entry, path) is None
+
+
+class DeltaBackupException(Exception):
+    pass
+
+
+class DeltaRestoreException(Exception):
+    pass
+
+
+class DeltaVerifyException(Exception):
+    pass
@@ -0,0 +1,29 @@
+"""
+Selects the backup engine of a Backup.
+"""
+
+import functools
+
+import sys
+sys.path.append("..")
+
+from app.models import Backup
+from backup import CHUNK_DIR, RdiffBackupWrapper
+from dedup import DedupBackupEngine
+from delta import DeltaBackupEngine
+from shard import ShardedRdiffBackupWrapper
+
+
+def engine_for(backup):
+    """
+    Returns the backup engine type to use for a Backup. Only rdiff-backup
+    backups are sharded.
+    """
+    if backup.engine == Backup.ENGINE.DEDUP:
+        return functools.partial(DedupBackupEngine, chunk_dir=CHUNK_DIR)
+    if backup.engine == Backup.ENGINE.DELTA:
+        return DeltaBackupEngine
+    if backup.shards is not None and backup.shards > 1:
+        return functools.partial(ShardedRdiffBackupWrapper,
+                                 shards=backup.shards)
+    return RdiffBackupWrapper
@@ -3,10 +3,16 @@ This module should be run as root to allow the 'mount' command to work.
 """
 
 import logging
+import os
+import random
+import string
+import threading
+import time
 
-import envoy
 from fs.path import relpath
 
+from process import Process
+
 
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
@@ -20,25 +26,45 @@ Warning:
 """
 
 
+def make_mount_point(mount_dir='/tmp'):
+    """ Creates an empty mount point in mount_dir and returns its path. """
+    # The mount command does not accept mount points with numbers
+    name = ''.join(random.choice(string.ascii_lowercase)
+                   for _ in range(12))
+    local_path = os.path.join(mount_dir, name)
+    os.makedirs(local_path)
+    return local_path
+
+
 class AbstractMountFS(object):
     """
     AbstractMountFS for mounting remote file shares.
     """
 
+    def __init__(self):
+        # ProcessUsage of each mount and umount command run for this FS
+        self.usage = []
+
     def mount(self):
         raise NotImplementedError
 
     def unmount(self):
         raise NotImplementedError
 
+    def is_mounted(self):
+        """ Returns True if the share is still mounted at local_path. """
+        return os.path.ismount(self.local_path)
+
 
 class CIFSMountFS(AbstractMountFS):
     """
-    CIFSMountFS for mounting CIFS remote file shares.
+    CIFSMountFS for mounting CIFS remote file shares. Without a local_path,
+    the share is mounted at a new mount point in /tmp, which is removed
+    when it is unmounted.
     """
 
     def __init__(self, username, password, remote_addr, remote_port,
-                 remote_path, local_path):
+                 remote_path, local_path=None):
         super(CIFSMountFS, self).__init__()
 
         self.username = username
@@ -47,9 +73,24 @@ class CIFSMountFS(AbstractMountFS):
         self.remote_port = remote_port
         self.remote_path = relpath(remote_path)
         self.local_path = local_path
+        # Whether the mount point was made by this FS
+        self.temp_mount_point = False
 
     def mount(self):
         """ Mounts the CIFS share at the specified local_path. """
+        if self.local_path is None:
+            self.local_path = make_mount_point()
+            self.temp_mount_point = True
+        try:
+            self._mount()
+        except Exception:
+            if self.temp_mount_point:
+                os.rmdir(self.local_path)
+                self.local_path = None
+                self.temp_mount_point = False
+            raise
+
+    def _mount(self):
 
         template = """mount -t cifs -o """ \
                    """'user={username},password={password}' """ \
@@ -67,12 +108,18 @@ class CIFSMountFS(AbstractMountFS):
 
         command = template.format(**arguments)
 
-        r = envoy.run(command, timeout=30)
+        process = Process(command, timeout=30)
+        try:
+            status_code, std_out, std_err = process.run()
+        finally:
+            if process.usage is not None:
+                self.usage.append(process.usage)
 
         LOGGER.debug("CIFS command: {}".format(command))
-        LOGGER.debug("CIFS stdout: {}".format(r.std_out))
-        if r.std_err:
-            raise CIFSException(r.std_err)
+        LOGGER.debug("CIFS stdout: {}".format(std_out))
+        if status_code != 0:
+            raise CIFSException(std_err or "Exited with status {}."\
+                .format(status_code))
         
         LOGGER.info("CIFS: Mounted {}/{} to {} successfully."\
             .format(self.remote_addr, self.remote_path, self.local_path))
@@ -88,15 +135,211 @@ class CIFSMountFS(AbstractMountFS):
 
         command = template.format(**arguments)
 
-        r = envoy.run(command, timeout=30)
+        process = Process(command, timeout=30)
+        try:
+            status_code, std_out, std_err = process.run()
+        finally:
+            if process.usage is not None:
+                self.usage.append(process.usage)
 
         LOGGER.debug("CIFS command: {}".format(command))
-        LOGGER.debug("CIFS stdout: {}".format(r.std_out))
-        if r.std_err:
-            raise CIFSException(r.std_err)
+        LOGGER.debug("CIFS stdout: {}".format(std_out))
+        if status_code != 0:
+            raise CIFSException(std_err or "Exited with status {}."\
+                .format(status_code))
         
         LOGGER.info("CIFS: Unmounted {}/{} from {} successfully."\
             .format(self.remote_addr, self.remote_path, self.local_path))
+        if self.temp_mount_point:
+            os.rmdir(self.local_path)
+            self.local_path = None
+            self.temp_mount_point = False
+
+
+class MountPool(object):
+    """
+    MountPool shares mounts between jobs. Jobs for the same share with the
+    same credentials use one mount, which is kept for a while after the last
+    job is done, so jobs that follow each other do not mount it again.
+
+    A MountPool stands in for an AbstractMountFS type: calling it returns
+    a PooledMountFS.
+    """
+
+    def __init__(self, mount_fs=CIFSMountFS, idle_timeout=300,
+                 mount_dir='/tmp', latency=None):
+        """
+        mount_fs (AbstractMountFS type) - FS the shares are mounted with
+        idle_timeout (int) - Seconds an unused mount is kept
+        mount_dir (str) - Directory the mount points are created in
+        latency (Histogram) - Histogram the seconds taken by each mount are
+            observed in, by result
+        """
+        self.mount_fs = mount_fs
+        self.idle_timeout = idle_timeout
+        self.mount_dir = mount_dir
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self._mounts = {}
+
+        self._thread = threading.Thread(target=self._evict,
+                                        name="mount-eviction")
+        self._thread.daemon = True
+
+    def __call__(self, username, password, remote_addr, remote_port,
+                 remote_path, local_path=None):
+        return PooledMountFS(self, (username, password, remote_addr,
+                                    remote_port, remote_path))
+
+    def start(self):
+        """ Starts unmounting idle mounts in the background. """
+        self._thread.start()
+
+    def acquire(self, key, usage=None):
+        """
+        Returns the local path of the mount of a share, mounting it if it
+        is not mounted yet.
+
+        key (tuple) - (username, password, remote address, remote port,
+            remote path) of the share
+        usage (list) - ProcessUsage of the mount commands run for the
+            caller is appended to this list
+        """
+        with self._lock:
+            mount = self._mounts.get(key)
+            if mount is None:
+                mount = self._mounts[key] = _SharedMount()
+            mount.users += 1
+            mount.idle_since = None
+
+        try:
+            # Jobs for other shares are not held up while this one mounts
+            with mount.lock:
+                if mount.fs is not None and not mount.fs.is_mounted():
+                    LOGGER.warning("CIFS: {} is no longer mounted."\
+                        .format(mount.fs.local_path))
+                    try:
+                        os.rmdir(mount.fs.local_path)
+                    except OSError:
+                        pass
+                    mount.fs = None
+                if mount.fs is None:
+                    mount.fs = self._mount(key, usage)
+                return mount.fs.local_path
+        except Exception:
+            self.release(key)
+            raise
+
+    def release(self, key):
+        """ Stops using the mount of a share. """
+        with self._lock:
+            mount = self._mounts[key]
+            mount.users -= 1
+            if mount.users == 0:
+                if mount.fs is None:
+                    # Mounting failed, there is nothing to keep
+                    del self._mounts[key]
+                else:
+                    mount.idle_since = time.time()
+
+    def evict_idle(self, now=None, idle_timeout=None):
+        """
+        Unmounts the mounts that have not been used for idle_timeout
+        seconds. Returns the number of mounts unmounted.
+        """
+        if now is None:
+            now = time.time()
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+
+        with self._lock:
+            idle = [key for key, mount in self._mounts.items()
+                    if mount.users == 0 and
+                    mount.idle_since + idle_timeout <= now]
+            evicted = [self._mounts.pop(key) for key in idle]
+
+        for mount in evicted:
+            try:
+                mount.fs.unmount()
+                os.rmdir(mount.fs.local_path)
+            except Exception:
+                LOGGER.exception("CIFS: Failed to unmount {}."\
+                    .format(mount.fs.local_path))
+        return len(evicted)
+
+    def __len__(self):
+        """ Returns the number of shares mounted or being mounted. """
+        with self._lock:
+            return len(self._mounts)
+
+    def close(self):
+        """ Unmounts every mount that is not in use. """
+        self.evict_idle(idle_timeout=0)
+
+    def _mount(self, key, usage=None):
+        local_path = make_mount_point(self.mount_dir)
+
+        username, password, remote_addr, remote_port, remote_path = key
+        fs = self.mount_fs(username=username, password=password,
+                           remote_addr=remote_addr, remote_port=remote_port,
+                           remote_path=remote_path, local_path=local_path)
+        started = time.time()
+        result = 'error'
+        try:
+            fs.mount()
+            result = 'ok'
+        except Exception:
+            os.rmdir(local_path)
+            raise
+        finally:
+            if usage is not None:
+                usage.extend(fs.usage)
+            if self.latency is not None:
+                self.latency.observe(time.time() - started, result=result)
+        return fs
+
+    def _evict(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout // 4))
+            try:
+                self.evict_idle()
+            except Exception:
+                LOGGER.exception("CIFS: Failed to unmount idle mounts.")
+
+
+class _SharedMount(object):
+    """ A mount shared by the jobs using it. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fs = None
+        self.users = 0
+        self.idle_since = None
+
+
+class PooledMountFS(AbstractMountFS):
+    """
+    PooledMountFS is a job's use of a mount in a MountPool. Its local_path
+    is the pool's mount point once mounted.
+    """
+
+    def __init__(self, pool, key):
+        super(PooledMountFS, self).__init__()
+
+        self.pool = pool
+        self.key = key
+        self.local_path = None
+
+    def mount(self):
+        """ Uses the pool's mount of the share, mounting it if needed. """
+        self.local_path = self.pool.acquire(self.key, self.usage)
+
+    def unmount(self):
+        """ Stops using the mount, which the pool unmounts once idle. """
+        if self.local_path is not None:
+            self.local_path = None
+            self.pool.release(self.key)
 
 
 class CIFSException(Exception):
@@ -0,0 +1,133 @@
+"""
+Leases let several runners share one job table. A runner claims the lease
+of a backup job before it runs it and renews the lease while the job runs.
+If the runner dies, the lease expires and another runner takes the job over.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+import sys
+sys.path.append("..")
+
+from app import db
+from app.models import Backup
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def default_owner():
+    """ Returns a name that identifies this runner process. """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class LeaseKeeper(object):
+    """
+    Claims and releases job leases for this runner and renews the leases it
+    holds from a heartbeat thread.
+    """
+
+    def __init__(self, ttl=60, owner=None, on_lost=None):
+        """
+        ttl (int) - Seconds a lease is held without being renewed
+        owner (str) - Name of this runner, defaults to host:pid
+        on_lost (callable) - Called with the backup id of each lease that
+            was taken over by another runner
+        """
+        self.ttl = ttl
+        self.owner = owner or default_owner()
+        self.on_lost = on_lost
+
+        self._lock = threading.Lock()
+        self._held = set()
+        # Leases being claimed, which are not renewed until claimed
+        self._claiming = set()
+
+        self._thread = threading.Thread(target=self._heartbeat,
+                                        name="lease-heartbeat")
+        self._thread.daemon = True
+
+    def start(self):
+        """ Starts renewing held leases in the background. """
+        self._thread.start()
+
+    def claim(self, backup_id):
+        """
+        Claims the lease of a backup job. Returns True if claimed.
+
+        A lease is held by one job at a time: the claim fails while a
+        backup, restore, verification or prune of this runner holds it.
+        """
+        with self._lock:
+            if backup_id in self._held or backup_id in self._claiming:
+                return False
+            self._claiming.add(backup_id)
+
+        claimed = False
+        try:
+            claimed = Backup.claim(backup_id, self.owner, self.ttl)
+            db.session.commit()
+        finally:
+            with self._lock:
+                self._claiming.discard(backup_id)
+                if claimed:
+                    self._held.add(backup_id)
+
+        if claimed:
+            LOGGER.debug("Lease: {} claimed backup {}."\
+                .format(self.owner, backup_id))
+        return claimed
+
+    def release(self, backup_id):
+        """ Releases the lease of a backup job. """
+        with self._lock:
+            self._held.discard(backup_id)
+        Backup.release(backup_id, self.owner)
+        db.session.commit()
+
+    def holds(self, backup_id):
+        """ Returns True if this runner holds the lease of a backup job. """
+        with self._lock:
+            return backup_id in self._held
+
+    def renew(self):
+        """ Renews all held leases. """
+        with self._lock:
+            held = list(self._held)
+        if not held:
+            return
+
+        renewed = Backup.renew_leases(held, self.owner, self.ttl)
+        db.session.commit()
+
+        if renewed < len(held):
+            LOGGER.warning("Lease: {} lost {} of {} leases."\
+                .format(self.owner, len(held) - renewed, len(held)))
+            self._lost(held)
+
+    def _lost(self, held):
+        """ Stops holding the leases that another runner took over. """
+        owned = set(backup_id for (backup_id,) in
+                    db.session.query(Backup.id)\
+                        .filter(Backup.id.in_(held))\
+                        .filter(Backup.lease_owner == self.owner))
+        for backup_id in set(held) - owned:
+            with self._lock:
+                self._held.discard(backup_id)
+            if self.on_lost is not None:
+                self.on_lost(backup_id)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.ttl / 3.0)
+            try:
+                self.renew()
+            except Exception:
+                LOGGER.exception("Lease: Failed to renew leases.")
+                db.session.rollback()
+            finally:
+                db.session.remove()
@@ -0,0 +1,135 @@
+"""
+Reads the mirror metadata that rdiff-backup keeps in rdiff-backup-data. The
+metadata of each session lists every file in the mirror with its type, size,
+times and, for regular files, the SHA-1 digest of its content.
+"""
+
+import calendar
+import gzip
+import logging
+import os
+import re
+import time
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+MIRROR_METADATA_RE = re.compile(
+    r'^mirror_metadata\.(?P<time>[^.]+)\.(?P<kind>snapshot|diff)(\.gz)?$')
+SESSION_TIME_RE = re.compile(
+    r'^(?P<time>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)'
+    r'(?P<zone>Z|(?P<sign>[+-])(?P<hours>\d\d):(?P<minutes>\d\d))$')
+
+
+def mirror_metadata_files(backup_dir):
+    """
+    Returns the (time, kind, path) of each mirror metadata file of a
+    repository, oldest first. kind is 'snapshot' or 'diff'.
+    """
+    data_dir = os.path.join(backup_dir, 'rdiff-backup-data')
+    if not os.path.isdir(data_dir):
+        return []
+    files = []
+    for name in os.listdir(data_dir):
+        match = MIRROR_METADATA_RE.match(name)
+        if match is not None:
+            files.append((match.group('time'), match.group('kind'),
+                          os.path.join(data_dir, name)))
+    return sorted(files)
+
+
+def latest_mirror_metadata(backup_dir):
+    """
+    Returns the path of the metadata of the current mirror, or None. The
+    current mirror's metadata is always a full snapshot.
+    """
+    snapshots = [path for _, kind, path in mirror_metadata_files(backup_dir)
+                 if kind == 'snapshot']
+    return snapshots[-1] if snapshots else None
+
+
+def session_time(label):
+    """
+    Returns the seconds since the epoch of an rdiff-backup session time,
+    such as 2016-05-01T02:00:03-04:00, or None if it is not one.
+    """
+    # Colons are quoted as ;058 when the repository is on a file system
+    # that does not allow them
+    match = SESSION_TIME_RE.match(label.replace(';058', ':'))
+    if match is None:
+        return None
+    fields = match.groupdict()
+    seconds = calendar.timegm(time.strptime(fields['time'],
+                                            '%Y-%m-%dT%H:%M:%S'))
+    if fields['zone'] != 'Z':
+        offset = int(fields['hours']) * 3600 + int(fields['minutes']) * 60
+        seconds -= offset if fields['sign'] == '+' else -offset
+    return seconds
+
+
+def parse_statistics(lines):
+    """
+    Parses rdiff-backup statistics of "Name value (description)" lines
+    into a dict of numbers. Other lines are skipped.
+    """
+    statistics = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        try:
+            statistics[parts[0]] = float(parts[1]) \
+                if '.' in parts[1] else int(parts[1])
+        except ValueError:
+            continue
+    return statistics
+
+
+def read_statistics(path):
+    """ Reads an rdiff-backup statistics file into a dict of numbers. """
+    try:
+        with open(path) as f:
+            return parse_statistics(f)
+    except (IOError, OSError):
+        LOGGER.warning("Metadata: Could not read {}.".format(path))
+    return {}
+
+
+def session_statistics(backup_dir, label):
+    """
+    Returns the statistics of the rdiff-backup session with the time label,
+    an empty dict if they were not kept.
+    """
+    path = os.path.join(backup_dir, 'rdiff-backup-data',
+                        'session_statistics.{}.data'.format(label))
+    if not os.path.isfile(path):
+        return {}
+    return read_statistics(path)
+
+
+def unquote_path(path):
+    """ Undoes the quoting of newlines and backslashes in file names. """
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                  else m.group(1), path)
+
+
+def read_mirror_metadata(path):
+    """
+    Yields a dict of the fields of each file in a mirror metadata file, with
+    the unquoted relative path under 'File'.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        record = None
+        for line in f:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            if line.startswith('File '):
+                if record is not None:
+                    yield record
+                record = {'File': unquote_path(line[5:])}
+            elif record is not None and line.startswith('  '):
+                name, _, value = line.strip().partition(' ')
+                record[name] = value
+        if record is not None:
+            yield record
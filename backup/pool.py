@@ -0,0 +1,183 @@
+"""
+Worker pool that runs jobs in parallel while limiting how many jobs run at
+once against a single server and a single share.
+"""
+
+from collections import Counter, deque
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+
+import sys
+sys.path.append("..")
+
+from app import db
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class JobPool(object):
+    """
+    JobPool runs each job on its own worker thread, up to a global limit and
+    limits per server and per share. Jobs that would exceed a limit wait in
+    submission order until a running job finishes.
+    """
+
+    def __init__(self, max_jobs=4, max_jobs_per_server=2,
+                 max_jobs_per_share=1):
+        """
+        max_jobs (int) - Maximum number of jobs running at once
+        max_jobs_per_server (int) - Maximum jobs running against one server
+        max_jobs_per_share (int) - Maximum jobs running against one share
+        """
+        self.max_jobs = max_jobs
+        self.max_jobs_per_server = max_jobs_per_server
+        self.max_jobs_per_share = max_jobs_per_share
+
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._running = {}
+        self._servers = Counter()
+        self._shares = Counter()
+
+    def submit(self, key, server, share, target, *args):
+        """
+        Queues target(*args) to run on a worker thread.
+
+        key - Unique key of the job, usually the backup id
+        server (str) - Server the job connects to
+        share (str) - Share on the server the job connects to
+
+        Returns False if a job with the same key is already queued.
+        """
+        task = _Task(key, server, share, target, args)
+        with self._lock:
+            if self._is_queued(key):
+                return False
+            self._pending.append(task)
+            self._dispatch()
+        return True
+
+    def submit_ahead(self, key, server, share, target, *args):
+        """
+        Queues target(*args) like submit, but ahead of every job that was
+        not itself submitted ahead.
+
+        Returns False if a job with the same key is already queued.
+        """
+        task = _Task(key, server, share, target, args, ahead=True)
+        with self._lock:
+            if self._is_queued(key):
+                return False
+            position = 0
+            for position, pending in enumerate(self._pending):
+                if not pending.ahead:
+                    break
+            else:
+                position = len(self._pending)
+            # deque has no insert on Python 2
+            self._pending.rotate(-position)
+            self._pending.appendleft(task)
+            self._pending.rotate(position)
+            self._dispatch()
+        return True
+
+    def is_queued(self, key):
+        """ Returns True if a job is pending or running for the key. """
+        with self._lock:
+            return self._is_queued(key)
+
+    def keys(self):
+        """ Returns the keys of the pending and of the running jobs. """
+        with self._lock:
+            return [task.key for task in self._pending], list(self._running)
+
+    @property
+    def pending(self):
+        """ Returns the number of jobs waiting for a free worker. """
+        return len(self._pending)
+
+    @property
+    def running(self):
+        """ Returns the number of jobs currently running. """
+        return len(self._running)
+
+    def _is_queued(self, key):
+        if key in self._running:
+            return True
+        return any(task.key == key for task in self._pending)
+
+    def _can_start(self, task):
+        if len(self._running) >= self.max_jobs:
+            return False
+        if self._servers[task.server] >= self.max_jobs_per_server:
+            return False
+        if self._shares[task.share] >= self.max_jobs_per_share:
+            return False
+        return True
+
+    def _dispatch(self):
+        """ Starts pending jobs that fit within the limits. """
+        for task in list(self._pending):
+            if len(self._running) >= self.max_jobs:
+                break
+            if not self._can_start(task):
+                continue
+
+            self._pending.remove(task)
+            self._running[task.key] = task
+            self._servers[task.server] += 1
+            self._shares[task.share] += 1
+
+            worker = threading.Thread(target=self._work, args=(task,),
+                                      name="job-{}".format(task.key))
+            worker.daemon = True
+            worker.start()
+
+    def _work(self, task):
+        try:
+            task.target(*task.args)
+        except Exception:
+            LOGGER.exception("Pool: Job {} failed.".format(task.key))
+        finally:
+            # Each worker thread has its own database session
+            db.session.remove()
+
+            with self._lock:
+                del self._running[task.key]
+                self._servers[task.server] -= 1
+                self._shares[task.share] -= 1
+                self._dispatch()
+
+
+class _Task(object):
+    """
+    A job waiting for or running on a worker thread.
+    """
+
+    def __init__(self, key, server, share, target, args, ahead=False):
+        self.key = key
+        self.ahead = ahead
+        self.server = (server or '').lower()
+        self.share = (self.server, (share or '').strip('/\\').lower())
+        self.target = target
+        self.args = args
+
+
+def parallel_map(function, items, workers=1):
+    """
+    Runs function(item) for every item on up to workers threads. Raises the
+    first exception raised by a call, once every call has returned.
+    """
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            function(item)
+        return
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,125 @@
+"""
+Pre-staging of upcoming backups. Shortly before a backup is due, its share
+is mounted through the mount pool and checked, so the backup starts on a
+mount that is already up, and a bad password or an unreachable server is
+reported before the backup window opens rather than when it starts.
+"""
+
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+
+import sys
+sys.path.append("..")
+
+from app import db
+from app.models import Backup
+from scan import ShareScanner
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class Prestager(object):
+    """
+    Prestager mounts the shares of upcoming backups ahead of time and holds
+    the mounts until the backups start.
+    """
+
+    def __init__(self, mounts, lookahead=300, workers=2, scan_workers=4):
+        """
+        mounts (MountPool) - Mount pool the backups mount their shares from
+        lookahead (int) - Seconds before a backup is due that it is staged
+        workers (int) - Shares staged at once
+        scan_workers (int) - Threads walking a staged share to warm the
+            directory metadata cached for it, 0 to skip the walk
+        """
+        self.mounts = mounts
+        self.lookahead = datetime.timedelta(seconds=lookahead)
+        self.scan_workers = scan_workers
+
+        self._lock = threading.Lock()
+        # (mount, deadline) of each staged backup, None while staging. The
+        # mount is None if staging failed, so it is not retried until then.
+        self._staged = {}
+        self._pool = ThreadPool(workers)
+
+    def stage(self, backup_id, deadline):
+        """ Stages a backup due at deadline in the background. """
+        with self._lock:
+            if backup_id in self._staged:
+                return
+            self._staged[backup_id] = None
+        self._pool.apply_async(self._stage, (backup_id, deadline))
+
+    def release(self, backup_id):
+        """
+        Releases the mount held for a backup. A backup that starts within
+        the mount pool's idle timeout still finds the share mounted.
+        """
+        with self._lock:
+            # A backup still staging is released when staging is done
+            staged = self._staged.pop(backup_id, None)
+        if staged is not None and staged[0] is not None:
+            staged[0].unmount()
+
+    def expire(self, now):
+        """ Releases the mounts of backups that did not start in time. """
+        with self._lock:
+            expired = [backup_id for backup_id, staged
+                       in self._staged.items() if staged is not None and
+                       staged[1] + self.lookahead <= now]
+        for backup_id in expired:
+            self.release(backup_id)
+
+    def _stage(self, backup_id, deadline):
+        fs = None
+        try:
+            backup = Backup.query.get(backup_id)
+            if backup is None:
+                with self._lock:
+                    self._staged.pop(backup_id, None)
+                return
+
+            fs = self.mounts(username=backup.username,
+                             password=backup.password,
+                             remote_addr=backup.server,
+                             remote_port=backup.port,
+                             remote_path=backup.location)
+            fs.mount()
+            # The share root must be readable, not only mountable
+            os.listdir(fs.local_path)
+            if self.scan_workers:
+                scan = ShareScanner(fs.local_path,
+                                    workers=self.scan_workers).scan()
+                if scan.errors:
+                    LOGGER.warning("Prestage: {} directories of {} could "
+                                   "not be read.".format(len(scan.errors),
+                                                         backup.location))
+            LOGGER.info("Prestage: Staged {} for backup {}."\
+                .format(backup.location, backup_id))
+        except Exception as e:
+            LOGGER.error("Prestage: Failed to stage backup {}: {}"\
+                .format(backup_id, e))
+            if fs is not None:
+                fs.unmount()
+                fs = None
+            try:
+                backup = Backup.query.get(backup_id)
+                if backup is not None:
+                    backup.error_message = "Pre-staging failed: {}".format(e)
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+        finally:
+            db.session.remove()
+
+        with self._lock:
+            if backup_id in self._staged:
+                self._staged[backup_id] = (fs, deadline)
+                return
+        # Released while staging
+        if fs is not None:
+            fs.unmount()
@@ -0,0 +1,302 @@
+"""
+Runs commands as subprocesses that can be terminated from another thread.
+The output of a command is read line by line as it is written, and only its
+tail is kept, so a command that runs for days and writes a lot of output
+does not grow the memory of the runner.
+
+The resources a command used are recorded once it exits: wall time, CPU
+times and peak RSS from its rusage, and its I/O from /proc/<pid>/io.
+"""
+
+from collections import deque
+import datetime
+import errno
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+from six.moves import queue
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+# Longest line passed on whole, longer lines are split
+LINE_MAX = 64 * 1024
+# Bytes of the end of each output stream kept once a command exits
+TAIL_BYTES = 64 * 1024
+# Lines read but not handled yet. Reading stops while this many are queued,
+# so a command that writes faster than its output is handled waits.
+QUEUED_LINES = 1024
+# Seconds between samples of the I/O counters of a running command. The
+# counters are read once more as it exits where os.waitid is available.
+USAGE_INTERVAL = 5
+
+
+class OutputTail(object):
+    """ The last lines of an output stream, no more than max_bytes long. """
+
+    def __init__(self, max_bytes=TAIL_BYTES):
+        self.max_bytes = max_bytes
+        self._lines = deque()
+        self._size = 0
+
+    def append(self, line):
+        self._lines.append(line)
+        self._size += len(line)
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            self._size -= len(self._lines.popleft())
+
+    def __str__(self):
+        return ''.join(self._lines)
+
+
+class ProcessUsage(object):
+    """
+    Resources used by a command.
+
+    The CPU times and the peak RSS include the children the command waited
+    for, while the I/O counters only count the command itself. read_chars
+    and write_chars count all bytes read and written, including network
+    file system I/O, whereas read_bytes and write_bytes only count the I/O
+    of block devices.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.started_at = datetime.datetime.now()
+        self.exit_code = None
+        # Seconds
+        self.wall_time = None
+        self.user_time = None
+        self.system_time = None
+        # Bytes
+        self.max_rss = None
+        self.read_chars = None
+        self.write_chars = None
+        self.read_bytes = None
+        self.write_bytes = None
+
+    def sample_io(self, pid):
+        """ Updates the I/O counters from /proc/<pid>/io. """
+        counters = {}
+        try:
+            with open('/proc/{}/io'.format(pid)) as io:
+                for line in io:
+                    name, value = line.split(':', 1)
+                    counters[name] = int(value)
+        except (IOError, OSError, ValueError):
+            return
+        self.read_chars = counters.get('rchar')
+        self.write_chars = counters.get('wchar')
+        self.read_bytes = counters.get('read_bytes')
+        self.write_bytes = counters.get('write_bytes')
+
+    def exited(self, status, rusage, wall_time):
+        """ Records the exit status and rusage returned by os.wait4. """
+        if os.WIFSIGNALED(status):
+            self.exit_code = -os.WTERMSIG(status)
+        else:
+            self.exit_code = os.WEXITSTATUS(status)
+        self.wall_time = wall_time
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        # Linux reports ru_maxrss in kilobytes
+        self.max_rss = rusage.ru_maxrss * 1024
+
+    def __str__(self):
+        return "{} exited with {} after {:.1f}s (user {:.1f}s, system " \
+               "{:.1f}s, peak RSS {} KB, read {}, written {})".format(
+                   self.program, self.exit_code, self.wall_time or 0,
+                   self.user_time or 0, self.system_time or 0,
+                   (self.max_rss or 0) // 1024, self.read_chars,
+                   self.write_chars)
+
+
+class Process(object):
+    """
+    Process runs a command to completion and allows it to be terminated
+    while it runs, either by a timeout or by another thread.
+    """
+
+    def __init__(self, command, timeout=None, kill_timeout=30, throttle=None,
+                 server=None, direction='read'):
+        """
+        command (str) - Command line to run
+        timeout (int) - Seconds after which the command is terminated
+        kill_timeout (int) - Seconds a terminated command has to exit before
+            it is killed
+        throttle (Throttle) - Throttle to limit the I/O rate of the command
+        server (str) - Server the command reads from or writes to
+        direction (str) - 'read' or 'write', the direction of the server I/O
+        """
+        self.command = command
+        self.timeout = timeout
+        self.kill_timeout = kill_timeout
+        self.throttle = throttle
+        self.server = server
+        self.direction = direction
+
+        self.terminated = False
+        # Resources used by the command, recorded as it runs
+        self.usage = None
+        self._lock = threading.Lock()
+        self._process = None
+
+    def run(self, on_line=None):
+        """
+        Runs the command and waits for it to exit.
+
+        on_line (callable) - Called with ('stdout' or 'stderr', line) for
+            each line the command writes, on the calling thread
+        Returns a tuple of (status_code, std_out, std_err), where the output
+        is the last TAIL_BYTES of each stream.
+        """
+        args = shlex.split(self.command)
+        with self._lock:
+            if self.terminated:
+                raise ProcessTerminated(self.command)
+            # Only the program is recorded, its arguments may hold passwords
+            self.usage = ProcessUsage(os.path.basename(args[0]))
+            started = time.time()
+            # The command runs in its own process group, so terminating it
+            # also terminates the children it started
+            self._process = subprocess.Popen(args,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.PIPE,
+                                             universal_newlines=True,
+                                             preexec_fn=os.setsid)
+        if self.throttle is not None:
+            self.throttle.register(self._process.pid, self.server,
+                                   self.direction)
+
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self.terminate)
+            timer.daemon = True
+            timer.start()
+
+        sampler = threading.Thread(target=self._sample_io,
+                                   args=(self._process, self.usage))
+        sampler.daemon = True
+        sampler.start()
+
+        tails = {'stdout': OutputTail(), 'stderr': OutputTail()}
+        try:
+            lines = queue.Queue(QUEUED_LINES)
+            readers = [threading.Thread(target=_read_lines,
+                                        args=(stream, pipe, lines))
+                       for stream, pipe in (('stdout', self._process.stdout),
+                                            ('stderr', self._process.stderr))]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+
+            # Each reader queues None once its stream is closed
+            open_streams = len(readers)
+            while open_streams:
+                item = lines.get()
+                if item is None:
+                    open_streams -= 1
+                    continue
+                stream, line = item
+                tails[stream].append(line)
+                if on_line is not None:
+                    on_line(stream, line)
+            self._wait(started)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if self.throttle is not None:
+                self.throttle.unregister(self._process.pid)
+
+        return self._process.returncode, str(tails['stdout']), \
+            str(tails['stderr'])
+
+    def _wait(self, started):
+        """ Waits for the command to exit and records its resource usage. """
+        process = self._process
+        if hasattr(os, 'waitid') and hasattr(os, 'WNOWAIT'):
+            # The exited command is left a zombie, whose I/O counters can
+            # still be read, until it is reaped below
+            _retry(os.waitid, os.P_PID, process.pid,
+                   os.WEXITED | os.WNOWAIT)
+            with self._lock:
+                self.usage.sample_io(process.pid)
+
+        _, status, rusage = _retry(os.wait4, process.pid, 0)
+        with self._lock:
+            self.usage.exited(status, rusage, time.time() - started)
+            # Popen did not reap the command itself, so it is told how it
+            # exited
+            process.returncode = self.usage.exit_code
+        LOGGER.debug("Process: {}".format(self.usage))
+
+    def _sample_io(self, process, usage):
+        while True:
+            time.sleep(USAGE_INTERVAL)
+            with self._lock:
+                # Once reaped, the pid may belong to another process
+                if process.returncode is not None:
+                    return
+                usage.sample_io(process.pid)
+
+    def terminate(self):
+        """
+        Asks the command to exit, and kills it if it is still running after
+        kill_timeout seconds.
+        """
+        with self._lock:
+            self.terminated = True
+            process = self._process
+        if process is None or process.returncode is not None:
+            return
+
+        LOGGER.info("Process: Terminating {}.".format(process.pid))
+        self._signal(process, signal.SIGTERM)
+        # A process paused by the throttle only handles SIGTERM once resumed
+        self._signal(process, signal.SIGCONT)
+
+        timer = threading.Timer(self.kill_timeout, self._kill, args=(process,))
+        timer.daemon = True
+        timer.start()
+
+    def _kill(self, process):
+        if process.returncode is None:
+            LOGGER.warning("Process: Killing {}.".format(process.pid))
+            self._signal(process, signal.SIGKILL)
+
+    def _signal(self, process, signum):
+        try:
+            os.killpg(process.pid, signum)
+        except OSError:
+            # The process group has already exited
+            pass
+
+
+def _read_lines(stream, pipe, lines):
+    """ Queues (stream, line) for each line read from a pipe. """
+    try:
+        for line in iter(lambda: pipe.readline(LINE_MAX), ''):
+            lines.put((stream, line))
+    finally:
+        pipe.close()
+        lines.put(None)
+
+
+def _retry(function, *args):
+    """ Calls a system call wrapper, again if interrupted by a signal. """
+    while True:
+        try:
+            return function(*args)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+class ProcessTerminated(Exception):
+    pass
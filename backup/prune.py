@@ -0,0 +1,151 @@
+"""
+Enforces the retention of each backup by removing old increments from its
+repository. Pruning runs in small batches whenever the runner has a free
+job slot, and each batch stops at a deadline, so it never holds the disk
+for long while backups wait.
+"""
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import or_
+
+import sys
+sys.path.append("..")
+
+from app import db
+from app.catalog import update_catalog
+from app.models import Backup
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class Pruner(object):
+    """
+    Pruner removes increments older than Backup.retention from the
+    repositories that have not been pruned within the prune interval.
+    """
+
+    def __init__(self, backups_dir, engine_for, leases, has_free_slot,
+                 interval=86400, batch_size=5, batch_pause=60,
+                 batch_timeout=900, on_pruned=None):
+        """
+        backups_dir (str) - Directory holding the backup repositories
+        engine_for (callable) - Returns the backup engine type to use for
+            a Backup
+        leases (LeaseKeeper) - Leases of this runner. A repository is only
+            pruned while its backup's lease is held, so no backup, restore
+            or verification uses it meanwhile.
+        has_free_slot (callable) - Returns True while the runner could
+            start another job
+        interval (int) - Seconds between prunes of a repository
+        batch_size (int) - Repositories pruned per batch
+        batch_pause (int) - Seconds to pause between batches
+        batch_timeout (int) - Seconds a batch may take. A prune still
+            running at the deadline is stopped.
+        on_pruned (callable) - Called with the id of each backup pruned,
+            while its lease is held
+        """
+        self.backups_dir = backups_dir
+        self.engine_for = engine_for
+        self.leases = leases
+        self.has_free_slot = has_free_slot
+        self.interval = datetime.timedelta(seconds=interval)
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.batch_timeout = batch_timeout
+        self.on_pruned = on_pruned
+
+        self._thread = threading.Thread(target=self._prune, name="pruner")
+        self._thread.daemon = True
+
+    def start(self):
+        """ Starts pruning in the background. """
+        self._thread.start()
+
+    def due(self, now):
+        """ Returns the ids of the next batch of backups to prune. """
+        rows = db.session.query(Backup.id)\
+            .filter(Backup.retention != None)\
+            .filter(or_(Backup.last_pruned == None,
+                        Backup.last_pruned <= now - self.interval))\
+            .order_by(Backup.last_pruned)\
+            .limit(self.batch_size)
+        return [backup_id for (backup_id,) in rows]
+
+    def prune_batch(self):
+        """
+        Prunes the next batch of repositories, stopping early if the job
+        slots fill up or the batch runs out of time. Returns the number of
+        repositories pruned.
+        """
+        deadline = time.time() + self.batch_timeout
+        pruned = 0
+        for backup_id in self.due(datetime.datetime.now()):
+            if not self.has_free_slot() or time.time() >= deadline:
+                break
+            # The backup's own job may be running. The lease is what keeps
+            # it out of the repository while it is pruned.
+            if not self.leases.claim(backup_id):
+                continue
+            try:
+                if self.prune(backup_id, timeout=deadline - time.time()):
+                    pruned += 1
+            finally:
+                self.leases.release(backup_id)
+        return pruned
+
+    def prune(self, backup_id, timeout=None):
+        """
+        Prunes the repository of a backup. Returns True if pruned.
+
+        timeout (float) - Seconds the engine may take, None for no limit
+        """
+        backup = Backup.query.get(backup_id)
+        if backup is None:
+            return False
+
+        repository = os.path.join(self.backups_dir, str(backup.id))
+        wrapper = self.engine_for(backup)(remote_dir=None,
+                                          backup_dir=repository)
+        if not wrapper.has_backups():
+            # Nothing has been backed up yet
+            backup.pruned(0)
+            db.session.commit()
+            return False
+
+        try:
+            reclaimed = wrapper.prune(backup.retention, timeout=timeout)
+        except Exception as e:
+            LOGGER.error("Prune: Failed to prune {}: {}"\
+                .format(repository, e))
+            # Try again after the prune interval, not in every batch
+            backup.last_pruned = datetime.datetime.now()
+            db.session.commit()
+            return False
+
+        backup.pruned(reclaimed)
+        db.session.commit()
+        update_catalog(backup.id, wrapper)
+        if self.on_pruned is not None:
+            self.on_pruned(backup.id)
+        LOGGER.info("Prune: Reclaimed {} MB from {}."\
+            .format(reclaimed // 2 ** 20, repository))
+        return True
+
+    def _prune(self):
+        while True:
+            time.sleep(self.batch_pause)
+            if not self.has_free_slot():
+                continue
+            try:
+                self.prune_batch()
+            except Exception:
+                LOGGER.exception("Prune: Failed to prune repositories.")
+                db.session.rollback()
+            finally:
+                db.session.remove()
@@ -1,36 +1,411 @@
+import datetime
+import logging
+import os
+import threading
 import time
 
+from sqlalchemy import or_
+
 import sys
 sys.path.append("..")
 
-from app import db
-from app.models import Backup
-from backup import BackupJob, RdiffBackupWrapper
-from fs_mount import CIFSMountFS
+from app import app, db, metrics
+from app.models import Backup, BackupRun, Restore
+from app.wakeup import WakeupListener
+from admission import AdmissionController
+from backup import BACKUPS_DIR, BackupJob, RestoreJob, tree_size
+from engines import engine_for
+from fs_mount import CIFSMountFS, MountPool
+from lease import LeaseKeeper
+from pool import JobPool
+from prestage import Prestager
+from prune import Pruner
+from scheduler import Scheduler
+from throttle import Throttle
+from verify import VerifyJob
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class RunningJobs(object):
+    """
+    Jobs running on this runner, by backup id, so they can be cancelled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def add(self, backup_id, job):
+        """
+        Adds the job of a backup. A backup has one job at a time, as the
+        job holds the backup's lease, so another job is never replaced.
+        """
+        with self._lock:
+            if backup_id in self._jobs:
+                raise ValueError("Backup {} already has a running job."\
+                    .format(backup_id))
+            self._jobs[backup_id] = (job, datetime.datetime.now())
+
+    def remove(self, backup_id):
+        with self._lock:
+            self._jobs.pop(backup_id, None)
+
+    def cancel(self, backup_id, reason):
+        """ Cancels the job of a backup if it runs on this runner. """
+        with self._lock:
+            entry = self._jobs.get(backup_id)
+        if entry is not None:
+            entry[0].cancel(reason)
+
+    def started_before(self, when):
+        """ Returns the ids of jobs that started before a given time. """
+        with self._lock:
+            return [backup_id for backup_id, (job, started)
+                    in self._jobs.items() if started < when]
+
+    def __contains__(self, backup_id):
+        with self._lock:
+            return backup_id in self._jobs
+
+
+class Runner(object):
+    """
+    Runner starts backup jobs as they become due and runs them on a pool of
+    worker threads.
+    """
+
+    def __init__(self, config):
+        """
+        config (dict) - App config holding the runner settings
+        """
+        self.config = config
 
+        self.scheduler = Scheduler(
+            poll_interval=config['SCHEDULER_POLL_INTERVAL'],
+            horizon=config['SCHEDULER_HORIZON'])
+        self.pool = JobPool(
+            max_jobs=config['RUNNER_MAX_JOBS'],
+            max_jobs_per_server=config['RUNNER_MAX_JOBS_PER_SERVER'],
+            max_jobs_per_share=config['RUNNER_MAX_JOBS_PER_SHARE'])
+        self.jobs = RunningJobs()
+        self.leases = LeaseKeeper(ttl=config['RUNNER_LEASE_TTL'],
+                                  on_lost=self.lease_lost)
+        self.throttle = Throttle(config['THROTTLE_SCHEDULE'])
+        self.mounts = MountPool(CIFSMountFS,
+                                idle_timeout=config['MOUNT_IDLE_TIMEOUT'],
+                                latency=metrics.mount_seconds)
+        self.prestager = Prestager(
+            self.mounts, lookahead=config['PRESTAGE_LOOKAHEAD'],
+            workers=config['PRESTAGE_WORKERS'],
+            scan_workers=config['PRESTAGE_SCAN_WORKERS'])
+        self.admission = AdmissionController(
+            BACKUPS_DIR,
+            min_free_bytes=config['ADMISSION_MIN_FREE_BYTES'],
+            growth_factor=config['ADMISSION_GROWTH_FACTOR'],
+            max_load=config['ADMISSION_MAX_LOAD'],
+            max_io_pressure=config['ADMISSION_MAX_IO_PRESSURE'])
+        self.pruner = Pruner(BACKUPS_DIR, engine_for, self.leases,
+                             has_free_slot=self.has_free_slot,
+                             interval=config['PRUNE_INTERVAL'],
+                             batch_size=config['PRUNE_BATCH_SIZE'],
+                             batch_pause=config['PRUNE_BATCH_PAUSE'],
+                             batch_timeout=config['PRUNE_BATCH_TIMEOUT'],
+                             on_pruned=self.observe_repository)
+        # Time each backup that is due but has not started yet was due at
+        self.due = {}
+        self.metrics = metrics.MetricsWriter(
+            metrics.runner, config['RUNNER_METRICS_FILE'],
+            interval=config['METRICS_INTERVAL'], collect=self.collect_metrics)
 
-def run():
-    """ Runs all backup jobs. """
-    while True:
-        db.session.expire_all()
+    def is_idle(self):
+        """ Returns True if no jobs are running or waiting to run. """
+        return self.pool.running == 0 and self.pool.pending == 0
+
+    def has_free_slot(self):
+        """ Returns True if another job could start without waiting. """
+        return self.pool.running + self.pool.pending < self.pool.max_jobs
+
+    def lease_lost(self, backup_id):
+        """ Preempts a job whose lease was taken over by another runner. """
+        self.jobs.cancel(backup_id, "Taken over by another runner.")
+
+    def run_backup(self, backup_id):
+        """ Runs a single backup job. Called on a pool worker thread. """
+        # Another runner may have claimed the job first
+        if not self.leases.claim(backup_id):
+            self.due.pop(backup_id, None)
+            return
+
+        deferred = False
         try:
-            backups = Backup.query.all()
-        except:
-            time.sleep(1)
-            continue
-
-        for backup in backups:
-            if backup.should_start:
-                try:
-                    job = BackupJob(backup=backup, mount_fs=CIFSMountFS,
-                                    backup_wrapper=RdiffBackupWrapper)
-                except Exception as e:
-                    print(e)
-                    backup.failed(e.message)
-                    db.session.commit()
-                else:
-                    job.run()
-
-        time.sleep(1)
-
-run()
+            backup = Backup.query.get(backup_id)
+            if backup is None or not backup.is_due(datetime.datetime.now()):
+                return
+
+            if backup.cancel_requested:
+                backup.cancelled("Cancelled before the backup started.")
+                db.session.commit()
+                return
+
+            # Deferred jobs stay due and are tried again on the next refresh
+            repository = os.path.join(BACKUPS_DIR, str(backup.id))
+            reason = self.admission.admit(backup.id, repository)
+            if reason is not None:
+                LOGGER.info("Runner: Deferred backup {}: {}"\
+                    .format(backup.id, reason))
+                backup.error_message = "Deferred: {}".format(reason)
+                db.session.commit()
+                deferred = True
+                return
+
+            due_at = self.due.get(backup_id)
+            if due_at is not None:
+                metrics.scheduler_lag_seconds.observe(
+                    max(0, (datetime.datetime.now() - due_at).total_seconds()))
+            try:
+                self._run_backup_job(backup)
+            finally:
+                self.admission.release(backup.id)
+        finally:
+            # Deferred jobs are still due
+            if not deferred:
+                self.due.pop(backup_id, None)
+            # The job held its own use of the staged mount while it ran
+            self.prestager.release(backup_id)
+            self.leases.release(backup_id)
+
+    def _run_backup_job(self, backup):
+        try:
+            job = BackupJob(backup=backup, mount_fs=self.mounts,
+                            backup_wrapper=engine_for(backup),
+                            throttle=self.throttle,
+                            prescan_workers=self.config['PRESCAN_WORKERS'])
+        except Exception as e:
+            LOGGER.exception("Runner: Failed to start backup {}."\
+                .format(backup.id))
+            backup.failed(str(e))
+            db.session.commit()
+        else:
+            self.jobs.add(backup.id, job)
+            try:
+                job.run()
+            finally:
+                self.jobs.remove(backup.id)
+            self.observe_run(job.run_record)
+            self.observe_repository(backup.id)
+
+    def observe_run(self, run):
+        """ Observes the duration and throughput of a backup run. """
+        status = {BackupRun.STATUS.FINISHED: 'finished',
+                  BackupRun.STATUS.ERROR: 'error',
+                  BackupRun.STATUS.CANCELLED: 'cancelled'}.get(run.status)
+        if status is None or run.duration is None:
+            return
+        metrics.backup_duration_seconds.observe(
+            run.duration, backup=run.backup_id, status=status)
+        if status == 'finished' and run.throughput is not None:
+            metrics.backup_throughput_bytes.observe(run.throughput)
+
+    def observe_repository(self, backup_id):
+        """
+        Measures the repository of a backup. Called after it changed, while
+        the backup's lease is held, as walking it every time the metrics are
+        written would take too long.
+        """
+        repository = os.path.join(BACKUPS_DIR, str(backup_id))
+        metrics.repository_bytes.set(tree_size(repository), backup=backup_id)
+
+    def collect_metrics(self):
+        """ Updates the gauges of the runner's metrics. """
+        pending, running = self.pool.keys()
+        for gauge, keys in ((metrics.jobs_queued, pending),
+                            (metrics.jobs_running, running)):
+            # Backups are keyed by their id, other jobs by (kind, id)
+            kinds = {'backup': 0, 'restore': 0, 'verify': 0}
+            for key in keys:
+                kind = key[0] if isinstance(key, tuple) else 'backup'
+                kinds[kind] = kinds.get(kind, 0) + 1
+            for kind, count in kinds.items():
+                gauge.set(count, kind=kind)
+
+        metrics.backups_due.set(len(self.due))
+        metrics.mounts_active.set(len(self.mounts))
+
+    def run_restore(self, restore_id):
+        """ Runs a single restore job. Called on a pool worker thread. """
+        restore = Restore.query.get(restore_id)
+        if restore is None or restore.status != Restore.STATUS.QUEUED:
+            return
+
+        # The repository must not change while it is restored from. A
+        # restore that cannot claim it stays queued for the next refresh.
+        backup_id = restore.backup_id
+        if not self.leases.claim(backup_id):
+            return
+
+        try:
+            # Another runner may have run the restore before the claim
+            db.session.refresh(restore)
+            if restore.status != Restore.STATUS.QUEUED:
+                return
+
+            try:
+                job = RestoreJob(restore=restore, mount_fs=self.mounts,
+                                 backup_wrapper=engine_for(restore.backup),
+                                 throttle=self.throttle,
+                                 workers=self.config['RESTORE_WORKERS'])
+            except Exception as e:
+                LOGGER.exception("Runner: Failed to start restore {}."\
+                    .format(restore.id))
+                restore.failed(str(e))
+                db.session.commit()
+                return
+
+            self.jobs.add(backup_id, job)
+            try:
+                job.run()
+            finally:
+                self.jobs.remove(backup_id)
+        finally:
+            self.leases.release(backup_id)
+
+    def submit_restores(self):
+        """ Queues requested restores ahead of any queued backups. """
+        queued = Restore.query\
+            .filter(Restore.status == Restore.STATUS.QUEUED)\
+            .order_by(Restore.requested_at)
+        for restore in queued:
+            self.pool.submit_ahead(('restore', restore.id),
+                                   restore.backup.server,
+                                   restore.backup.location,
+                                   self.run_restore, restore.id)
+
+    def run_verify(self, backup_id):
+        """ Verifies a backup's stored data. Called on a pool worker thread. """
+        # Backups and other runners hold the lease while they use the
+        # repository
+        if not self.leases.claim(backup_id):
+            return
+
+        try:
+            backup = Backup.query.get(backup_id)
+            if backup is None or \
+                    not backup.verify_due(datetime.datetime.now()):
+                return
+
+            job = VerifyJob(backup=backup, backup_wrapper=engine_for(backup),
+                            interval=self.config['VERIFY_INTERVAL'],
+                            workers=self.config['VERIFY_WORKERS'],
+                            sample_size=self.config['VERIFY_SAMPLE_SIZE'],
+                            sample_bytes=self.config['VERIFY_SAMPLE_BYTES'])
+            self.jobs.add(backup.id, job)
+            try:
+                job.run()
+            finally:
+                self.jobs.remove(backup.id)
+        finally:
+            self.leases.release(backup_id)
+
+    def submit_verifications(self, now):
+        """
+        Queues verifications that are due, but only while no backups are
+        waiting for a worker. Verifications do not connect to file servers,
+        so they share a pseudo server and run one at a time.
+        """
+        if self.pool.pending:
+            return
+        due = db.session.query(Backup.id)\
+            .filter(or_(Backup.next_verify_at == None,
+                        Backup.next_verify_at <= now))\
+            .order_by(Backup.next_verify_at)\
+            .limit(self.pool.max_jobs)
+        for (backup_id,) in due:
+            self.pool.submit(('verify', backup_id), None, None,
+                             self.run_verify, backup_id)
+
+    def prestage(self, now):
+        """ Stages the backups that are due soon, ahead of their start. """
+        self.prestager.expire(now)
+        for backup_id, deadline in self.scheduler.upcoming(
+                now, self.config['PRESTAGE_LOOKAHEAD']):
+            if backup_id not in self.jobs and \
+                    not self.pool.is_queued(backup_id):
+                self.prestager.stage(backup_id, deadline)
+
+    def cancel_jobs(self):
+        """
+        Cancels running jobs that were cancelled from the web app, and
+        preempts jobs that have been running for too long.
+        """
+        cancelled = db.session.query(Backup.id)\
+            .filter(Backup.cancel_requested == True)
+        for (backup_id,) in cancelled:
+            self.jobs.cancel(backup_id, "Cancelled by user.")
+
+        max_runtime = self.config['RUNNER_MAX_JOB_RUNTIME']
+        if max_runtime is not None:
+            started = datetime.datetime.now() - \
+                datetime.timedelta(seconds=max_runtime)
+            for backup_id in self.jobs.started_before(started):
+                self.jobs.cancel(backup_id, "Preempted after running for "
+                                 "more than {} hours."\
+                                     .format(max_runtime // 3600))
+
+    def run(self):
+        """ Runs backup jobs as they become due. """
+        self.leases.start()
+        self.throttle.start()
+        self.pruner.start()
+        self.mounts.start()
+        self.metrics.start()
+        wakeup = WakeupListener(self.config['RUNNER_SOCKET'])
+
+        while True:
+            timeout = self.tick(datetime.datetime.now())
+            if wakeup.wait(timeout):
+                # A job was changed from the web app
+                self.scheduler.invalidate()
+
+    def tick(self, now):
+        """
+        Reloads upcoming jobs if needed, stages the jobs due soon and submits
+        the jobs that are due. Returns the seconds until the next tick is
+        needed.
+        """
+        if self.scheduler.needs_refresh(now):
+            db.session.expire_all()
+            try:
+                self.scheduler.refresh(now)
+                self.cancel_jobs()
+                self.submit_restores()
+                self.submit_verifications(now)
+            except:
+                time.sleep(1)
+                return 0
+
+        self.prestage(now)
+
+        for backup_id in self.scheduler.pop_due(now):
+            # Due jobs stay due until a worker starts them
+            if self.pool.is_queued(backup_id):
+                continue
+
+            db.session.expire_all()
+            backup = Backup.query.get(backup_id)
+            if backup is None or not backup.is_due(now):
+                continue
+
+            self.due.setdefault(backup.id, now if backup.start_now
+                                else backup.next_run_at or now)
+            self.pool.submit(backup.id, backup.server, backup.location,
+                             self.run_backup, backup.id)
+
+        # Release the rows loaded by this thread, workers use their own
+        db.session.remove()
+        return self.scheduler.seconds_until_next(datetime.datetime.now())
+
+
+if __name__ == '__main__':
+    Runner(app.config).run()
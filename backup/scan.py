@@ -0,0 +1,182 @@
+"""
+Change detection for shares. Before a backup, the mounted share is walked
+in parallel and the size and mtime of every entry is compared with the index
+saved by the last successful backup. Shares without changes are not backed
+up again.
+"""
+
+import gzip
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+
+from six.moves import queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class ShareScanner(object):
+    """
+    ShareScanner walks a directory tree with a pool of threads, listing one
+    directory per task. On a network file system each stat is a round trip
+    to the server, so listing directories in parallel hides the latency.
+    """
+
+    def __init__(self, root, workers=16):
+        """
+        root (str) - Directory to scan, usually the mounted share
+        workers (int) - Number of directories listed in parallel
+        """
+        self.root = root
+        self.workers = workers
+
+    def scan(self):
+        """ Scans the tree and returns a ScanResult. """
+        results = queue.Queue()
+        pool = ThreadPool(self.workers)
+
+        entries = {}
+        errors = []
+        pending = 1
+        pool.apply_async(self._list, ('',), callback=results.put)
+        try:
+            while pending:
+                path, listed, subdirs, error = results.get()
+                pending -= 1
+
+                if error is not None:
+                    errors.append((path, error))
+                entries.update(listed)
+                for subdir in subdirs:
+                    pending += 1
+                    pool.apply_async(self._list, (subdir,),
+                                     callback=results.put)
+        finally:
+            pool.close()
+            pool.join()
+
+        LOGGER.info("Scan: Scanned {} entries in {} ({} errors)."\
+            .format(len(entries), self.root, len(errors)))
+        return ScanResult(entries, errors)
+
+    def _list(self, path):
+        """
+        Lists one directory, relative to the root.
+
+        Returns a tuple of (path, {path: (size, mtime)}, subdirectories,
+        error).
+        """
+        listed = {}
+        subdirs = []
+        try:
+            for name, st in _lstat_entries(os.path.join(self.root, path)):
+                entry_path = os.path.join(path, name)
+                listed[entry_path] = (st.st_size, st.st_mtime)
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(entry_path)
+        except Exception as e:
+            # Any error must be returned, as scan() waits for every listing
+            return path, listed, subdirs, str(e)
+        return path, listed, subdirs, None
+
+
+def _lstat_entries(directory):
+    """ Yields (name, lstat result) for each entry of a directory. """
+    if scandir is not None:
+        for entry in scandir(directory):
+            yield entry.name, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(directory):
+            yield name, os.lstat(os.path.join(directory, name))
+
+
+class ScanResult(object):
+    """
+    The entries found by a scan and their changes since a previous scan.
+    """
+
+    def __init__(self, entries, errors):
+        """
+        entries (dict) - (size, mtime) of each path relative to the root
+        errors (list) - (path, error) of each directory that failed to list
+        """
+        self.entries = entries
+        self.errors = errors
+        self.changed = None
+        self.deleted = None
+
+    def compare(self, previous):
+        """
+        Finds the paths that were added, modified or deleted since a
+        previous scan.
+
+        previous (dict) - Entries of the previous scan
+        """
+        self.changed = sorted(path for path, metadata in self.entries.items()
+                              if previous.get(path) != metadata)
+        self.deleted = sorted(path for path in previous
+                              if path not in self.entries)
+
+    @property
+    def complete(self):
+        """ Returns True if every directory was listed. """
+        return not self.errors
+
+    @property
+    def unchanged(self):
+        """
+        Returns True if the tree is known to be identical to the previous
+        scan.
+        """
+        return self.complete and self.changed == [] and self.deleted == []
+
+
+class ScanIndex(object):
+    """
+    ScanIndex stores the entries of the last successful backup's scan.
+    """
+
+    def __init__(self, path):
+        """
+        path (str) - File to store the index in
+        """
+        self.path = path
+
+    def load(self):
+        """ Returns the stored entries, or None if there are none. """
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                entries = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        # JSON has no tuples
+        return dict((path, tuple(metadata))
+                    for path, metadata in entries.items())
+
+    def save(self, entries):
+        """ Stores entries, replacing the stored index atomically. """
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        temp_path = self.path + '.tmp'
+        with gzip.open(temp_path, 'wb') as f:
+            f.write(json.dumps(entries).encode('utf-8'))
+        os.rename(temp_path, self.path)
+
+    def delete(self):
+        """ Removes the stored index. """
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,123 @@
+"""
+Keeps upcoming backup jobs in a min-heap ordered by their next run time, so
+the runner only has to wake up when a job is due.
+"""
+
+import datetime
+import heapq
+import logging
+
+from sqlalchemy import and_, or_
+
+import sys
+sys.path.append("..")
+
+from app import db
+from app.models import Backup
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Scheduler for backup jobs that are due within a look-ahead horizon.
+
+    Only the id and next run time of upcoming jobs are loaded from the
+    database. Full Backup rows are loaded once a job is actually due.
+    """
+
+    def __init__(self, poll_interval=5, horizon=300):
+        """
+        poll_interval (int) - Seconds between refreshes from the database
+        horizon (int) - Seconds ahead of now to load upcoming jobs for
+        """
+        self.poll_interval = poll_interval
+        self.horizon = datetime.timedelta(seconds=horizon)
+
+        self._heap = []
+        # Current deadline of each queued backup id. Heap entries that do
+        # not match are stale and skipped when popped.
+        self._deadlines = {}
+        self._last_refresh = None
+
+    def push(self, backup_id, deadline):
+        """ Queues a backup job to run at the given deadline. """
+        self._deadlines[backup_id] = deadline
+        heapq.heappush(self._heap, (deadline, backup_id))
+
+    def discard(self, backup_id):
+        """ Removes a backup job from the queue. """
+        self._deadlines.pop(backup_id, None)
+
+    def invalidate(self):
+        """ Forces upcoming jobs to be reloaded on the next refresh. """
+        self._last_refresh = None
+
+    def needs_refresh(self, now):
+        """ Returns True if upcoming jobs should be reloaded. """
+        if self._last_refresh is None:
+            return True
+        elapsed = (now - self._last_refresh).total_seconds()
+        return elapsed >= self.poll_interval
+
+    def refresh(self, now):
+        """ Reloads the ids and run times of upcoming jobs. """
+        until = now + self.horizon
+        rows = db.session.query(Backup.id, Backup.next_run_at,
+                                Backup.start_now, Backup.status,
+                                Backup.lease_expires)\
+            .filter(Backup.enabled == True)\
+            .filter(or_(Backup.start_now == True,
+                        Backup.next_run_at <= until,
+                        and_(Backup.status == Backup.STATUS.RUNNING,
+                             Backup.lease_expires <= until)))
+
+        self._heap = []
+        self._deadlines = {}
+        for backup_id, next_run_at, start_now, status, lease_expires in rows:
+            deadlines = [now if start_now else next_run_at]
+            if status == Backup.STATUS.RUNNING and lease_expires is not None:
+                # Taken over from another runner once its lease expires
+                deadlines.append(lease_expires)
+            self.push(backup_id, min(d for d in deadlines if d is not None))
+
+        self._last_refresh = now
+        LOGGER.debug("Scheduler: {} upcoming jobs.".format(len(self)))
+
+    def pop_due(self, now):
+        """ Pops and returns the ids of all jobs that are due. """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, backup_id = heapq.heappop(self._heap)
+            if self._deadlines.get(backup_id) != deadline:
+                continue
+            del self._deadlines[backup_id]
+            due.append(backup_id)
+        return due
+
+    def upcoming(self, now, within):
+        """
+        Returns the (backup id, deadline) of the queued jobs that are due
+        after now and within the given seconds.
+        """
+        until = now + datetime.timedelta(seconds=within)
+        return [(backup_id, deadline) for backup_id, deadline
+                in self._deadlines.items() if now < deadline <= until]
+
+    def seconds_until_next(self, now):
+        """ Returns the seconds to sleep until the next deadline. """
+        timeout = self.poll_interval
+        if self._last_refresh is not None:
+            timeout -= (now - self._last_refresh).total_seconds()
+
+        while self._heap and \
+                self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if self._heap:
+            timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+
+        return max(0, timeout)
+
+    def __len__(self):
+        return len(self._deadlines)
@@ -0,0 +1,257 @@
+"""
+Sharded backups of large shares. The top-level entries of a share are split
+into a fixed number of shards, and each shard is backed up by its own
+rdiff-backup process into its own repository, all shards at the same time.
+"""
+
+import functools
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from backup import AbstractBackupEngine, RdiffBackupException, \
+    RdiffBackupWrapper, RdiffRestoreException, restore_relpath
+from metadata import session_time
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+# Most seconds between the start of the first and the last shard of a run
+SHARD_SKEW = 60
+
+
+class ShardedRdiffBackupWrapper(AbstractBackupEngine):
+    """
+    ShardedRdiffBackupWrapper backs up a share as several rdiff-backup
+    repositories, shard-0 to shard-N in the backup directory.
+
+    A top-level entry always belongs to the same shard, chosen by a hash of
+    its name, so it is only ever backed up into one repository. Changing the
+    number of shards moves entries between repositories.
+    """
+
+    def __init__(self, remote_dir, backup_dir, throttle=None, server=None,
+                 shards=2):
+        """
+        remote_dir (str) - Remote directory to backup (mounted locally)
+        backup_dir (str) - Directory to store the shard repositories in
+        throttle (Throttle) - Throttle to limit the I/O rate of rdiff-backup
+        server (str) - Server the remote directory is mounted from
+        shards (int) - Number of shards
+        """
+        self.remote_dir = remote_dir
+        self.backup_dir = backup_dir
+
+        self.shards = [RdiffBackupWrapper(
+            remote_dir=remote_dir,
+            backup_dir=os.path.join(backup_dir, 'shard-{}'.format(shard)),
+            throttle=throttle, server=server) for shard in range(shards)]
+
+    def shard_of(self, name):
+        """ Returns the shard that a top-level entry belongs to. """
+        if isinstance(name, type(u'')):
+            name = name.encode('utf-8')
+        return (zlib.crc32(name) & 0xffffffff) % len(self.shards)
+
+    def cancel(self):
+        """ Terminates the running backup or restore of every shard. """
+        for shard in self.shards:
+            shard.cancel()
+
+    def has_backups(self):
+        """ Returns True if any shard holds a repository. """
+        return any(shard.has_backups() for shard in self.shards)
+
+    def backup(self, scan=None):
+        """ Backup the remote location, all shards in parallel. """
+        entries = [[] for _ in self.shards]
+        for name in os.listdir(self.remote_dir):
+            entries[self.shard_of(name)].append(name)
+
+        # Shards without entries still run, so that entries deleted from
+        # the share are recorded as deleted in their repository
+        filelists = []
+        try:
+            for names in entries:
+                with tempfile.NamedTemporaryFile('w', suffix='.filelist',
+                                                 delete=False) as filelist:
+                    for name in names:
+                        filelist.write(os.path.join(self.remote_dir, name))
+                        filelist.write('\n')
+                filelists.append(filelist.name)
+
+            errors = self._parallel([
+                functools.partial(shard.backup, include_filelist=filelist)
+                for shard, filelist in zip(self.shards, filelists)])
+        finally:
+            for filelist in filelists:
+                os.remove(filelist)
+
+        if errors:
+            raise RdiffBackupException("\n".join(errors))
+
+        LOGGER.info("Backup: Backed up {} to {} in {} shards successfully."\
+            .format(self.remote_dir, self.backup_dir, len(self.shards)))
+
+    def restore(self, path='/', time_format="1D", workers=1, progress=None):
+        """
+        Restore a path, recursively to the remote location, from the shard
+        that holds it. Restoring the root restores every shard in parallel.
+
+        path (str) - Path to restore
+        time_format (str) - Time format passed into rdiff-backup to specify
+            version of backup to restore.
+        workers (int) - rdiff-backup processes to restore a directory with
+            in each shard
+        progress (callable) - Called with (bytes restored, bytes to restore)
+            across all shards as the restore progresses
+        """
+        parts = [part for part in restore_relpath(path).split('/') if part]
+        if parts:
+            shards = [self.shards[self.shard_of(parts[0])]]
+        else:
+            shards = self.shards
+        shards = [shard for shard in shards if shard.has_backups()]
+        if not shards:
+            raise RdiffRestoreException(
+                "No shard of {} holds a backup of {}."\
+                    .format(self.backup_dir, path))
+
+        # Progress of each shard, summed up for the whole restore
+        shard_progress = dict((index, (0, 0)) for index in range(len(shards)))
+        lock = threading.Lock()
+
+        def report(index, done, total):
+            with lock:
+                shard_progress[index] = (done, total)
+                progress(sum(done for done, _ in shard_progress.values()),
+                         sum(total for _, total in shard_progress.values()))
+
+        errors = self._parallel([
+            functools.partial(shard.restore, path=path,
+                              time_format=time_format, workers=workers,
+                              progress=functools.partial(report, index)
+                              if progress is not None else None)
+            for index, shard in enumerate(shards)])
+        if errors:
+            raise RdiffRestoreException("\n".join(errors))
+
+    def prune(self, retention, timeout=None):
+        """
+        Removes increments older than retention days from every shard, one
+        shard after the other within the timeout. Returns the bytes freed.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        freed = 0
+        for shard in self.shards:
+            if not shard.has_backups():
+                continue
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            freed += shard.prune(retention, timeout=remaining)
+        return freed
+
+    def files(self):
+        """ Returns the size of each regular file in every shard. """
+        files = {}
+        for shard in self.shards:
+            files.update(shard.files())
+        return files
+
+    def increments(self):
+        """
+        Returns the (time, label) of each run, oldest first. The shards of a
+        run start together, so the sessions of the first shard stand for
+        the runs.
+        """
+        for shard in self.shards:
+            if shard.has_backups():
+                return shard.increments()
+        return []
+
+    def _sessions_at(self, label):
+        """ Returns the (shard, label) of each shard's session in a run. """
+        when = session_time(label)
+        sessions = []
+        for shard in self.shards:
+            labels = [shard_label for time, shard_label in shard.increments()
+                      if time <= when + SHARD_SKEW]
+            if labels:
+                sessions.append((shard, labels[-1]))
+        return sessions
+
+    def listing(self, label):
+        """
+        Returns the files and directories of a run across all shards, or
+        None if the listing of a shard was not kept.
+        """
+        files = []
+        for shard, shard_label in self._sessions_at(label):
+            listing = shard.listing(shard_label)
+            if listing is None:
+                return None
+            files.extend(listing)
+        return files
+
+    def statistics(self, label):
+        """ Returns the statistics of a run, summed across all shards. """
+        statistics = {}
+        for shard, shard_label in self._sessions_at(label):
+            for name, value in shard.statistics(shard_label).items():
+                statistics[name] = statistics.get(name, 0) + value
+        return statistics
+
+    def run_statistics(self):
+        """ Returns the statistics of the last backup, summed across shards. """
+        statistics = {}
+        for shard in self.shards:
+            for name, value in shard.run_statistics().items():
+                # Times of the shards' sessions do not add up
+                if not name.endswith('Time'):
+                    statistics[name] = statistics.get(name, 0) + value
+        return statistics
+
+    def process_usage(self):
+        """ Returns the ProcessUsage of the last backup of every shard. """
+        return [usage for shard in self.shards
+                for usage in shard.process_usage()]
+
+    def verify(self, workers=None):
+        """ Verifies every shard, one after the other. """
+        checked, failures = 0, []
+        for shard in self.shards:
+            shard_checked, shard_failures = shard.verify(workers)
+            checked += shard_checked
+            failures.extend(shard_failures)
+        return checked, failures
+
+    def check_restored(self, relpath, path):
+        """ Checks a restored file against the shard that holds it. """
+        parts = [part for part in relpath.split('/') if part]
+        shard = self.shards[self.shard_of(parts[0])]
+        return shard.check_restored(relpath, path)
+
+    def _parallel(self, calls):
+        """ Runs calls on one thread each. Returns the errors raised. """
+        errors = []
+
+        def call(function):
+            try:
+                function()
+            except Exception as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=call, args=(function,))
+                   for function in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
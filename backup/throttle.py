@@ -0,0 +1,241 @@
+"""
+Byte-rate throttling of the processes that read from and write to file
+servers.
+
+rdiff-backup has no bandwidth limit of its own, so the throttle samples the
+I/O counters of each registered process in /proc/<pid>/io and charges them
+to token buckets, one for all processes and one per server. A process whose
+buckets run out of tokens is paused with SIGSTOP and resumed with SIGCONT
+once the buckets have refilled. Engines that do their I/O in-process charge
+the buckets directly and sleep off any debt.
+"""
+
+import datetime
+import logging
+import os
+import signal
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    TokenBucket refills at rate bytes per second up to one second of burst.
+    Consuming more than is available leaves the bucket in debt.
+    """
+
+    def __init__(self, rate, now):
+        """
+        rate (int) - Bytes per second, None for unlimited
+        now (float) - Current time in seconds
+        """
+        self.rate = rate
+        self.tokens = rate or 0
+        self._updated = now
+
+    def refill(self, now):
+        """ Adds the tokens accumulated since the last refill. """
+        if self.rate is not None:
+            elapsed = now - self._updated
+            self.tokens = min(self.rate, self.tokens + elapsed * self.rate)
+        self._updated = now
+
+    def consume(self, count):
+        """ Takes count bytes worth of tokens from the bucket. """
+        if self.rate is not None:
+            self.tokens -= count
+
+    @property
+    def exhausted(self):
+        """ Returns True if the bucket is in debt. """
+        return self.rate is not None and self.tokens < 0
+
+
+class Throttle(object):
+    """
+    Throttle pauses registered processes whenever their byte rate, in total
+    or per server, goes over the limits of the schedule.
+    """
+
+    def __init__(self, schedule, interval=0.25):
+        """
+        schedule (list) - Entries of (first hour, last hour, total rate,
+            rate per server), see THROTTLE_SCHEDULE in config.py
+        interval (float) - Seconds between samples of the I/O counters
+        """
+        self.schedule = schedule
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._processes = {}
+        now = time.time()
+        self._total = TokenBucket(None, now)
+        self._servers = {}
+
+        self._thread = threading.Thread(target=self._sample, name="throttle")
+        self._thread.daemon = True
+
+    def start(self):
+        """ Starts sampling registered processes in the background. """
+        self._thread.start()
+
+    def limits(self, when):
+        """
+        Returns the (total rate, rate per server) that apply at when, or
+        (None, None) if no entry of the schedule covers it.
+        """
+        for first_hour, last_hour, total_rate, server_rate in self.schedule:
+            if first_hour <= last_hour:
+                covered = first_hour <= when.hour <= last_hour
+            else:
+                # The entry spans midnight, such as 22 to 6
+                covered = when.hour >= first_hour or when.hour <= last_hour
+            if covered:
+                return total_rate, server_rate
+        return None, None
+
+    def register(self, pid, server, direction='read'):
+        """
+        Starts throttling a process group.
+
+        pid (int) - Process group leader to throttle
+        server (str) - Server the process reads from or writes to
+        direction (str) - 'read' for backups, 'write' for restores
+        """
+        process = _ThrottledProcess(pid, (server or '').lower(), direction)
+        process.sample()
+        with self._lock:
+            self._processes[pid] = process
+
+    def unregister(self, pid):
+        """ Stops throttling a process group, resuming it if paused. """
+        with self._lock:
+            process = self._processes.pop(pid, None)
+        if process is not None:
+            process.resume()
+
+    def charge(self, server, count):
+        """
+        Charges count bytes transferred in-process and sleeps until the
+        buckets are out of debt again.
+
+        server (str) - Server the bytes were read from or written to
+        count (int) - Bytes transferred
+        """
+        server = (server or '').lower()
+        total_rate, server_rate = self.limits(datetime.datetime.now())
+        now = time.time()
+
+        with self._lock:
+            self._total.rate = total_rate
+            self._total.refill(now)
+            bucket = self._servers.setdefault(server,
+                                              TokenBucket(server_rate, now))
+            bucket.rate = server_rate
+            bucket.refill(now)
+
+            self._total.consume(count)
+            bucket.consume(count)
+
+            delay = 0
+            for bucket in (self._total, bucket):
+                if bucket.exhausted:
+                    delay = max(delay, -bucket.tokens / float(bucket.rate))
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tick(time.time())
+            except Exception:
+                LOGGER.exception("Throttle: Failed to sample processes.")
+
+    def tick(self, now):
+        """ Charges the I/O of each process and pauses or resumes it. """
+        total_rate, server_rate = self.limits(datetime.datetime.now())
+
+        with self._lock:
+            processes = list(self._processes.values())
+
+            self._total.rate = total_rate
+            self._total.refill(now)
+            for server in set(p.server for p in processes):
+                bucket = self._servers.setdefault(server,
+                                                  TokenBucket(server_rate, now))
+                bucket.rate = server_rate
+                bucket.refill(now)
+
+            for process in processes:
+                count = process.sample()
+                self._total.consume(count)
+                self._servers[process.server].consume(count)
+
+            for process in processes:
+                if self._total.exhausted or \
+                        self._servers[process.server].exhausted:
+                    process.pause()
+                else:
+                    process.resume()
+
+            # Forget servers that no longer have running processes, nor
+            # in-process transfers charged within the last second
+            for server in set(self._servers) - \
+                    set(p.server for p in processes):
+                if now - self._servers[server]._updated > 1:
+                    del self._servers[server]
+
+
+class _ThrottledProcess(object):
+    """
+    A process group whose I/O is charged to the throttle.
+    """
+
+    def __init__(self, pid, server, direction):
+        self.pid = pid
+        self.server = server
+        # rchar and wchar count all bytes read and written, including the
+        # network file system I/O that read_bytes and write_bytes miss
+        self.counter = 'rchar' if direction == 'read' else 'wchar'
+        self.paused = False
+        self._last = None
+
+    def sample(self):
+        """ Returns the bytes transferred since the last sample. """
+        try:
+            with open('/proc/{}/io'.format(self.pid)) as io:
+                for line in io:
+                    name, value = line.split(':', 1)
+                    if name == self.counter:
+                        current = int(value)
+                        break
+                else:
+                    return 0
+        except (IOError, OSError, ValueError):
+            return 0
+
+        last, self._last = self._last, current
+        if last is None:
+            return 0
+        return max(0, current - last)
+
+    def pause(self):
+        if not self.paused:
+            self._signal(signal.SIGSTOP)
+            self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self._signal(signal.SIGCONT)
+            self.paused = False
+
+    def _signal(self, signum):
+        try:
+            os.killpg(self.pid, signum)
+        except OSError:
+            pass
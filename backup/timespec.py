@@ -0,0 +1,56 @@
+"""
+Parses the time formats accepted by rdiff-backup --restore-as-of, so every
+backup engine selects restore points the same way.
+"""
+
+import datetime
+import re
+import time
+
+
+# Seconds in each unit of an interval such as "1D" or "2W3D"
+UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'D': 24 * 60 * 60,
+    'W': 7 * 24 * 60 * 60,
+    'M': 30 * 24 * 60 * 60,
+    'Y': 365 * 24 * 60 * 60,
+}
+
+INTERVAL_RE = re.compile(r'^(\d+[smhDWMY])+$')
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d',
+                '%Y/%m/%d', '%m/%d/%Y']
+
+
+def parse_time(time_format, now):
+    """
+    Returns the time described by time_format as seconds since the epoch.
+
+    time_format (str) - "now", seconds since the epoch, an interval before
+        now such as "1D" or "2W3D", or a local date and time such as
+        "2015-03-18" or "2015-03-18T01:00:00"
+    now (float) - Current time in seconds since the epoch
+    """
+    time_format = time_format.strip()
+    if time_format == 'now':
+        return now
+    if time_format.isdigit():
+        return int(time_format)
+
+    if INTERVAL_RE.match(time_format):
+        seconds = sum(int(count) * UNITS[unit] for count, unit
+                      in re.findall(r'(\d+)([smhDWMY])', time_format))
+        return now - seconds
+
+    # The time zone of full rdiff-backup timestamps is the local one
+    date = re.sub(r'([+-]\d\d:\d\d|Z)$', '', time_format)
+    for date_format in DATE_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(date, date_format)
+        except ValueError:
+            continue
+        return time.mktime(parsed.timetuple())
+
+    raise ValueError("Invalid time format: {}".format(time_format))
@@ -0,0 +1,132 @@
+"""
+Verification of stored backups. A verification hashes the stored data in
+parallel and compares it with the checksums stored with it, then restores a
+random sample of files into scratch space and compares them too, the way an
+actual restore would.
+"""
+
+import logging
+import os
+import random
+import shutil
+
+import sys
+sys.path.append("..")
+
+from app import db
+from backup import BACKUPS_DIR, VERIFY_DIR
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+class VerifyJob(object):
+    """
+    VerifyJob verifies the stored backups of a Backup and records the
+    result on it. It does not connect to the file server.
+    """
+
+    def __init__(self, backup, backup_wrapper, interval, workers=None,
+                 sample_size=20, sample_bytes=1024 * 1024 * 1024):
+        """
+        backup (Backup object) - Backup to verify
+        backup_wrapper (AbstractBackupEngine type) - Backup engine to use
+        interval (int) - Seconds until the next verification
+        workers (int) - Threads to hash with, one per core by default
+        sample_size (int) - Files to restore and compare
+        sample_bytes (int) - Most bytes to restore
+        """
+        self.backup = backup
+        self.interval = interval
+        self.workers = workers
+        self.sample_size = sample_size
+        self.sample_bytes = sample_bytes
+        # Reason the job was cancelled, None unless cancelled
+        self.cancel_reason = None
+
+        self.scratch_dir = os.path.join(VERIFY_DIR, str(self.backup.id))
+        self.local_backup_path = os.path.join(BACKUPS_DIR,
+                                              str(self.backup.id))
+        # Restores of the sample go to the scratch space
+        self.backup_job = backup_wrapper(remote_dir=self.scratch_dir,
+                                         backup_dir=self.local_backup_path)
+
+    def cancel(self, reason):
+        """
+        Cancels the job, stopping the verification.
+
+        reason (str) - Reason recorded for the cancellation
+        """
+        self.cancel_reason = reason
+        self.backup_job.cancel()
+
+    def sample(self):
+        """
+        Returns a random sample of the files in the latest backup, no
+        larger in total than sample_bytes.
+        """
+        files = list(self.backup_job.files().items())
+        random.shuffle(files)
+        sample, total = [], 0
+        for relpath, size in files:
+            if len(sample) >= self.sample_size:
+                break
+            if total + size > self.sample_bytes:
+                continue
+            sample.append(relpath)
+            total += size
+        return sample
+
+    def drill(self):
+        """
+        Restores the sample into scratch space and compares each file.
+        Returns (files restored, list of failures).
+        """
+        failures = []
+        sample = self.sample()
+        for relpath in sample:
+            if self.cancel_reason is not None:
+                break
+            path = os.path.join(self.scratch_dir, relpath)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            try:
+                self.backup_job.restore(path=relpath, time_format='now')
+                if not self.backup_job.check_restored(relpath, path):
+                    failures.append("{}: Restored file does not match."\
+                        .format(relpath))
+            except Exception as e:
+                failures.append("{}: Restore failed: {}".format(relpath, e))
+        return len(sample), failures
+
+    def run(self):
+        if not self.backup_job.has_backups():
+            # Nothing has been backed up yet
+            self.backup.verified(0, 0, [], self.interval)
+            db.session.commit()
+            return
+
+        try:
+            checked, failures = self.backup_job.verify(self.workers)
+            sampled, drill_failures = self.drill()
+        except Exception as e:
+            checked, sampled, failures, drill_failures = 0, 0, [str(e)], []
+        finally:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+        if self.cancel_reason is not None:
+            # Verified again at the next opportunity
+            LOGGER.info("Verify: Cancelled verifying {}: {}"\
+                .format(self.local_backup_path, self.cancel_reason))
+            return
+
+        failures = failures + drill_failures
+        self.backup.verified(checked, sampled, failures, self.interval)
+        db.session.commit()
+        if failures:
+            LOGGER.error("Verify: {} failures in {}: {}".format(
+                len(failures), self.local_backup_path, "; ".join(failures)))
+        else:
+            LOGGER.info("Verify: Verified {} successfully."\
+                .format(self.local_backup_path))
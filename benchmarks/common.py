@@ -0,0 +1,71 @@
+"""
+Helpers shared by the benchmarks: import paths, a scratch database and
+repository, and measurements of time and memory.
+"""
+from __future__ import absolute_import
+import os
+import resource
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The backup modules import each other as top-level modules
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'backup'))
+
+from app import app
+import backup as backup_module
+import engines as engines_module
+
+
+def use_scratch(scratch):
+    """
+    Points the app's database, catalogs and backup repositories into a
+    scratch directory, so a benchmark never touches the appliance's data.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(scratch, 'bench.db')
+    app.config['CATALOG_DIR'] = os.path.join(scratch, 'catalog')
+    backup_module.BACKUPS_DIR = os.path.join(scratch, 'backups')
+    backup_module.SCAN_INDEX_DIR = os.path.join(scratch, 'backups', '.scan')
+    backup_module.CHUNK_DIR = os.path.join(scratch, 'backups', '.chunks')
+    engines_module.CHUNK_DIR = backup_module.CHUNK_DIR
+
+
+def percentiles(values):
+    """ Returns the median, 95th percentile and maximum of values. """
+    if not values:
+        return {'median': None, 'p95': None, 'max': None}
+    values = sorted(values)
+    return {'median': values[len(values) // 2],
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'max': values[-1]}
+
+
+def cpu_seconds():
+    """ Returns the user and system CPU time of this process. """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def rss_bytes():
+    """ Returns the resident memory of this process. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * \
+                os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # Peak rather than current memory where /proc is missing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def disk_usage(path):
+    """ Returns the bytes allocated to the files under path. """
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_blocks \
+                    * 512
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,138 @@
+"""
+Benchmark of the block matching of the delta engine and the chunking of
+the dedup engine.
+
+Builds a basis file and versions of it with a given share of the file
+changed, then times delta() over each version against the signature of the
+basis. For each version it reports:
+
+- the wall time and throughput of delta()
+- the share of the version copied from the basis rather than stored
+
+Blocks that match are found with C-level checksums, so an unchanged file is
+limited by its reads. Data that matches no block is searched a byte at a
+time in Python only near the last match, and sparsely past it, which sets
+the floor for a file rewritten throughout. The replaced version, whose
+first quarter is new data of another length, shows that the blocks after a
+long run of new data are still found.
+
+It then times chunks() over the basis, which translates and searches every
+byte with C-level bytes methods whether or not the file changed. Run from
+the root of the repository:
+
+    python benchmarks/hashing.py --size 16777216
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import hashlib
+import io
+import json
+import logging
+import struct
+import time
+
+# Sets up the import paths of the app and the backup modules
+import common  # noqa
+
+from dedup import chunks
+from delta import Signature, delta
+
+
+def random_bytes(size, seed):
+    """ Returns size bytes that look random and are the same for a seed. """
+    blocks = [hashlib.sha512(struct.pack('>QQ', seed, counter)).digest()
+              for counter in range(size // 64 + 1)]
+    return b''.join(blocks)[:size]
+
+
+def versions(basis, seed):
+    """ Returns the changed versions of basis to time, by name. """
+    size = len(basis)
+    spots = [size * n // 11 for n in range(1, 11)]
+    edited = bytearray(basis)
+    for n, offset in enumerate(spots):
+        edited[offset:offset + 4096] = random_bytes(4096, seed + n + 1)
+    inserted = []
+    start = 0
+    for n, offset in enumerate(spots):
+        inserted.append(basis[start:offset])
+        inserted.append(random_bytes(100, seed + n + 1))
+        start = offset
+    inserted.append(basis[start:])
+    replaced = random_bytes(size // 4 + 100, seed + 200) + basis[size // 4:]
+    return [('unchanged', basis),
+            ('edited', bytes(edited)),
+            ('inserted', b''.join(inserted)),
+            ('replaced', replaced),
+            ('rewritten', random_bytes(size, seed + 100))]
+
+
+def time_delta(signature, data):
+    """ Runs delta() over data. Returns its results. """
+    copied = 0
+    started = time.time()
+    for kind, value in delta(io.BytesIO(data), signature):
+        if kind == 'copy':
+            copied += signature.block_length(value)
+    seconds = time.time() - started
+    return {'seconds': seconds,
+            'throughput': len(data) / seconds if seconds else None,
+            'copied_share': copied / float(len(data))}
+
+
+def time_chunks(data):
+    """ Runs chunks() over data. Returns its results. """
+    count = 0
+    started = time.time()
+    for chunk in chunks(io.BytesIO(data)):
+        count += 1
+    seconds = time.time() - started
+    return {'seconds': seconds,
+            'throughput': len(data) / seconds if seconds else None,
+            'chunks': count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024,
+                        help="Size of the file in bytes")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed of the generated file and its changes")
+    parser.add_argument('--json', help="File to write the results to")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    mb = float(2 ** 20)
+    basis = random_bytes(args.size, args.seed)
+    signature = Signature(len(basis), 0)
+    signature.update(basis)
+    signature.finish()
+    print("delta of a {:.1f} MB file, {} KB blocks".format(
+        len(basis) / mb, signature.block_size // 1024))
+
+    results = {'size': args.size, 'block_size': signature.block_size,
+               'delta': {}}
+    for name, data in versions(basis, args.seed):
+        result = time_delta(signature, data)
+        results['delta'][name] = result
+        print("  {:<10} {:8.2f} s  {:8.1f} MB/s  {:5.1f}% copied".format(
+            name, result['seconds'],
+            result['throughput'] / mb if result['throughput'] else 0,
+            result['copied_share'] * 100))
+
+    result = time_chunks(basis)
+    results['chunks'] = result
+    print("chunks of the file")
+    print("  {:<10} {:8.2f} s  {:8.1f} MB/s  {} chunks".format(
+        'basis', result['seconds'],
+        result['throughput'] / mb if result['throughput'] else 0,
+        result['chunks']))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+"""
+End-to-end benchmark of backups and restores over a synthetic share.
+
+Generates a share with a given number of files, size distribution and tree
+depth, then runs real BackupJob cycles over it for a number of simulated
+nights, changing a share of its files before each night. Every few nights
+the latest backup is restored with a real RestoreJob. For each night it
+reports:
+
+- the files and bytes changed in the share
+- the wall time and throughput of the backup
+- the size of the repository and its growth
+- the wall time and throughput of the restore, and whether the restored
+  files match the share
+
+CIFS mounts are replaced by local directories, or by bind mounts with
+--bind when run as root, so the scanners, engines, catalog and database run
+as they would on the appliance without a file server. Run from the root of
+the repository:
+
+    python benchmarks/pipeline.py --files 20000 --nights 7 --engine dedup
+"""
+from __future__ import absolute_import, print_function
+from distutils.spawn import find_executable
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# Sets up the import paths of the app and the backup modules
+from common import disk_usage, use_scratch
+
+from app import app, db
+from app.models import Backup, BackupRun, Restore
+import backup as backup_module
+from backup import BackupJob, RestoreJob
+from engines import engine_for
+from fs_mount import AbstractMountFS, make_mount_point
+from fs.path import relpath
+from process import Process
+from shares import SyntheticShare
+
+
+ENGINES = {'rdiff': Backup.ENGINE.RDIFF, 'dedup': Backup.ENGINE.DEDUP,
+           'delta': Backup.ENGINE.DELTA}
+
+
+class LocalMountFS(AbstractMountFS):
+    """
+    Stands in for CIFSMountFS. The share //server/path is the local
+    directory root/server/path, used in place or bind mounted at
+    local_path, or at a temporary mount point without one.
+    """
+
+    root = None
+    # Bind mount the share like a real mount, which requires root
+    bind = False
+
+    def __init__(self, username, password, remote_addr, remote_port,
+                 remote_path, local_path=None, root=None):
+        super(LocalMountFS, self).__init__()
+        self.source = os.path.join(root or self.root, remote_addr,
+                                   relpath(remote_path))
+        self.mount_point = local_path
+        self.temp_mount_point = False
+        self.local_path = local_path if self.bind else self.source
+
+    def mount(self):
+        if not self.bind:
+            return
+        if self.mount_point is None:
+            self.mount_point = make_mount_point()
+            self.temp_mount_point = True
+        try:
+            self._run("mount --bind '{}' '{}'".format(self.source,
+                                                     self.mount_point))
+        except Exception:
+            self._remove_mount_point()
+            raise
+        self.local_path = self.mount_point
+
+    def unmount(self):
+        if self.bind:
+            self._run("umount '{}'".format(self.mount_point))
+            self._remove_mount_point()
+
+    def _remove_mount_point(self):
+        if self.temp_mount_point:
+            os.rmdir(self.mount_point)
+            self.mount_point = self.local_path = None
+            self.temp_mount_point = False
+
+    def _run(self, command):
+        process = Process(command, timeout=30)
+        try:
+            status_code, std_out, std_err = process.run()
+        finally:
+            if process.usage is not None:
+                self.usage.append(process.usage)
+        if status_code != 0:
+            raise RuntimeError(std_err or "{} exited with status {}."\
+                .format(command, status_code))
+
+
+def tree_size(path):
+    """ Returns the number of files under path and their total size. """
+    files = 0
+    size = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.lstat(os.path.join(directory, name)).st_size
+    return files, size
+
+
+def repository_bytes(backup):
+    """ Returns the bytes stored on disk for a backup's repository. """
+    size = disk_usage(os.path.join(backup_module.BACKUPS_DIR,
+                                   str(backup.id)))
+    if backup.engine == Backup.ENGINE.DEDUP:
+        # Only the benchmarked backup stores chunks in the scratch directory
+        size += disk_usage(backup_module.CHUNK_DIR)
+    return size
+
+
+def run_backup(backup, args):
+    """ Runs a night's backup. Returns its results. """
+    started = time.time()
+    job = BackupJob(backup, mount_fs=LocalMountFS,
+                    backup_wrapper=engine_for(backup),
+                    prescan_workers=args.prescan_workers)
+    job.run()
+    seconds = time.time() - started
+
+    run = job.run_record
+    return {'status': run.status,
+            'error': run.error_message or None,
+            'seconds': seconds,
+            'engine_seconds': run.duration,
+            'changed_files': run.changed_files,
+            'changed_bytes': run.changed_bytes,
+            'throughput': run.throughput,
+            'cpu_seconds': run.cpu_time}
+
+
+def run_restore(backup, share, restore_root, workers):
+    """
+    Restores the latest backup of the whole share into restore_root.
+    Returns its results.
+    """
+    target = os.path.join(restore_root, backup.server,
+                          relpath(backup.location))
+    os.makedirs(target)
+    try:
+        # Backups in the benchmark are seconds apart, so only the latest
+        # one can be told apart by time
+        restore = Restore(backup, '/', 'now')
+        db.session.add(restore)
+        db.session.commit()
+
+        started = time.time()
+        job = RestoreJob(restore,
+                         mount_fs=functools.partial(LocalMountFS,
+                                                    root=restore_root),
+                         backup_wrapper=engine_for(backup), workers=workers)
+        job.run()
+        seconds = time.time() - started
+
+        files, size = tree_size(target)
+        return {'status': restore.status,
+                'error': restore.error_message or None,
+                'seconds': seconds,
+                'files': files,
+                'bytes': size,
+                'throughput': size / seconds if seconds else None,
+                'matches': (files, size) == (share.file_count,
+                                             share.total_bytes)}
+    finally:
+        shutil.rmtree(restore_root, ignore_errors=True)
+
+
+def run(share, backup, restore_root, args):
+    started = time.time()
+    share.generate()
+    results = {'files': share.file_count, 'bytes': share.total_bytes,
+               'engine': args.engine, 'shards': args.shards,
+               'generate_seconds': time.time() - started, 'nights': []}
+
+    repository = repository_bytes(backup)
+    for night in range(1, args.nights + 1):
+        changes = None
+        if night > 1:
+            changes = share.change()
+        result = {'night': night, 'changes': changes,
+                  'share_files': share.file_count,
+                  'share_bytes': share.total_bytes,
+                  'backup': run_backup(backup, args)}
+
+        size = repository_bytes(backup)
+        result['repository_bytes'] = size
+        result['repository_growth_bytes'] = size - repository
+        repository = size
+
+        if args.restore_every and night % args.restore_every == 0:
+            result['restore'] = run_restore(backup, share, restore_root,
+                                            args.restore_workers)
+        results['nights'].append(result)
+        report_night(result)
+    return results
+
+
+def report_night(result):
+    mb = float(2 ** 20)
+    status = {BackupRun.STATUS.FINISHED: 'ok', BackupRun.STATUS.ERROR: 'error',
+              BackupRun.STATUS.CANCELLED: 'cancelled'}
+    backup = result['backup']
+    changes = result['changes']
+    if changes is None:
+        changed = "initial {} files, {:.1f} MB".format(
+            result['share_files'], result['share_bytes'] / mb)
+    else:
+        changed = "{} edited, {} added, {} deleted, {:.1f} MB written".format(
+            changes['edited'], changes['added'], changes['deleted'],
+            changes['bytes_written'] / mb)
+    print("night {:3d}: {}".format(result['night'], changed))
+    # The dedup and delta engines run in this process, so only the CPU
+    # time of rdiff-backup and mount processes is known
+    print("  backup {:<9} {:8.1f} s  {:.1f} MB changed  {}  CPU {}".format(
+        status.get(backup['status'], backup['status']), backup['seconds'],
+        (backup['changed_bytes'] or 0) / mb,
+        "{:.1f} MB/s".format(backup['throughput'] / mb)
+        if backup['throughput'] is not None else "- MB/s",
+        "{:.1f} s".format(backup['cpu_seconds'])
+        if backup['cpu_seconds'] is not None else "-"))
+    if backup['error']:
+        print("    {}".format(backup['error']))
+    print("  repository {:.1f} MB ({:+.1f} MB)".format(
+        result['repository_bytes'] / mb,
+        result['repository_growth_bytes'] / mb))
+    restore = result.get('restore')
+    if restore is not None:
+        print("  restore {:8.1f} s  {} files, {:.1f} MB  {}  {}".format(
+            restore['seconds'], restore['files'], restore['bytes'] / mb,
+            "{:.1f} MB/s".format(restore['throughput'] / mb)
+            if restore['throughput'] is not None else "- MB/s",
+            "matches the share" if restore['matches']
+            else "DOES NOT MATCH the share"))
+        if restore['error']:
+            print("    {}".format(restore['error']))
+
+
+def report(results):
+    mb = float(2 ** 20)
+    nights = results['nights']
+    finished = [night['backup'] for night in nights
+                if night['backup']['status'] == BackupRun.STATUS.FINISHED]
+    print("{} engine, {} files, {:.1f} MB, {} nights".format(
+        results['engine'], results['files'], results['bytes'] / mb,
+        len(nights)))
+    if len(finished) > 1:
+        incremental = [backup['seconds'] for backup in finished[1:]]
+        print("  initial backup {:.1f} s, incremental backups {:.1f} s on "
+              "average".format(finished[0]['seconds'],
+                               sum(incremental) / len(incremental)))
+    if nights:
+        print("  repository {:.1f} MB for a share of {:.1f} MB".format(
+            nights[-1]['repository_bytes'] / mb,
+            nights[-1]['share_bytes'] / mb))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=10000,
+                        help="Files in the share")
+    parser.add_argument('--size-median', type=int, default=64 * 1024,
+                        help="Median file size in bytes")
+    parser.add_argument('--size-sigma', type=float, default=2.0,
+                        help="Spread of the log-normal file sizes")
+    parser.add_argument('--max-size', type=int, default=256 * 1024 * 1024,
+                        help="Largest file size in bytes")
+    parser.add_argument('--depth', type=int, default=4,
+                        help="Levels of directories in the share")
+    parser.add_argument('--fanout', type=int, default=5,
+                        help="Subdirectories of each directory")
+    parser.add_argument('--change-rate', type=float, default=0.02,
+                        help="Share of the files edited each night")
+    parser.add_argument('--new-rate', type=float, default=0.005,
+                        help="Share of the files added each night")
+    parser.add_argument('--delete-rate', type=float, default=0.002,
+                        help="Share of the files deleted each night")
+    parser.add_argument('--nights', type=int, default=7,
+                        help="Simulated nights of backups")
+    parser.add_argument('--restore-every', type=int, default=3,
+                        help="Nights between restores, 0 for none")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='rdiff',
+                        help="Backup engine")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Shards of an rdiff-backup backup")
+    parser.add_argument('--prescan-workers', type=int,
+                        default=app.config['PRESCAN_WORKERS'],
+                        help="Threads scanning the share, 0 for no prescan")
+    parser.add_argument('--restore-workers', type=int,
+                        default=app.config['RESTORE_WORKERS'],
+                        help="Workers restoring a directory")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed of the generated share and its changes")
+    parser.add_argument('--bind', action='store_true',
+                        help="Bind mount the share, which requires root")
+    parser.add_argument('--scratch',
+                        help="Directory to run in, a temporary directory by "
+                             "default. Kept after the benchmark.")
+    parser.add_argument('--json', help="File to write the results to")
+    args = parser.parse_args()
+
+    if args.engine == 'rdiff' and find_executable('rdiff-backup') is None:
+        parser.error("rdiff-backup is not installed, choose another engine.")
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scratch = args.scratch or tempfile.mkdtemp(prefix='pipeline-bench-')
+    try:
+        use_scratch(scratch)
+        db.drop_all()
+        db.create_all()
+
+        LocalMountFS.root = os.path.join(scratch, 'shares')
+        LocalMountFS.bind = args.bind
+        backup = Backup(name='Pipeline', server='fileserver', port=445,
+                        protocol=Backup.PROTOCOL.SMB, location='share',
+                        username='backup', password='password',
+                        start_day=Backup.DAY.SUNDAY, start_time=0,
+                        interval=Backup.INTERVAL.DAILY,
+                        retention=args.nights + 1, shards=args.shards,
+                        engine=ENGINES[args.engine])
+        db.session.add(backup)
+        db.session.commit()
+
+        share = SyntheticShare(
+            os.path.join(LocalMountFS.root, backup.server, backup.location),
+            files=args.files, size_median=args.size_median,
+            size_sigma=args.size_sigma, max_size=args.max_size,
+            depth=args.depth, fanout=args.fanout,
+            change_rate=args.change_rate, new_rate=args.new_rate,
+            delete_rate=args.delete_rate, seed=args.seed)
+        results = run(share, backup, os.path.join(scratch, 'restores'), args)
+        report(results)
+
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump(results, output, indent=2)
+    finally:
+        if not args.scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
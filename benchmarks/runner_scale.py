@@ -0,0 +1,410 @@
+"""
+Scale benchmark of the scheduler and the runner loop.
+
+Fills a scratch database with thousands of Backup rows on realistic
+schedules and measures:
+
+- the time the scheduler takes to find upcoming and due jobs at the quietest
+  and the busiest hour of the schedule
+- the CPU time of an idle runner tick, with and without a refresh from the
+  database
+- the latency from a job becoming due to its backup starting
+- the memory of the runner over hours of ticks and jobs
+
+Mounts and backups are replaced by in-process fakes, so only the cost of
+the scheduler, the runner and the database is measured. Run from the root
+of the repository:
+
+    python benchmarks/runner_scale.py --backups 10000 100000
+"""
+from __future__ import absolute_import, print_function
+import argparse
+from collections import Counter
+import datetime
+import gc
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# Sets up the import paths of the app and the backup modules
+from common import cpu_seconds, percentiles, rss_bytes, use_scratch
+
+from sqlalchemy import bindparam
+
+from app import app, db
+from app.models import Backup
+import backup as backup_module
+from backup import AbstractBackupEngine
+from fs_mount import AbstractMountFS
+from prestage import Prestager
+import runner as runner_module
+from scheduler import Scheduler
+
+
+# Share of backups by interval, and of start hours in the night window
+INTERVALS = [(Backup.INTERVAL.DAILY, 0.70), (Backup.INTERVAL.WEEKLY, 0.25),
+             (Backup.INTERVAL.MONTHLY, 0.05)]
+NIGHT_HOURS = [18, 19, 20, 21, 22, 23, 0, 1, 2, 3, 4, 5]
+NIGHT_SHARE = 0.9
+# Backups per file server
+BACKUPS_PER_SERVER = 50
+
+
+class FakeMountFS(AbstractMountFS):
+    """ Stands in for CIFSMountFS. Every share is one empty directory. """
+
+    share_dir = None
+
+    def __init__(self, username, password, remote_addr, remote_port,
+                 remote_path, local_path=None):
+        super(FakeMountFS, self).__init__()
+        self.local_path = FakeMountFS.share_dir
+
+    def mount(self):
+        pass
+
+    def unmount(self):
+        pass
+
+
+class FakeEngine(AbstractBackupEngine):
+    """ Stands in for RdiffBackupWrapper. Records when each backup starts. """
+
+    # Seconds a backup takes
+    duration = 0
+    # Time each backup started, by backup id
+    started = {}
+
+    def __init__(self, remote_dir, backup_dir, throttle=None, server=None):
+        self.remote_dir = remote_dir
+        self.backup_dir = backup_dir
+
+    def has_backups(self):
+        return False
+
+    def backup(self, scan=None):
+        FakeEngine.started[int(os.path.basename(self.backup_dir))] = \
+            time.time()
+        time.sleep(FakeEngine.duration)
+
+    def increments(self):
+        return []
+
+    def cancel(self):
+        pass
+
+
+def populate(count, rng):
+    """ Inserts count backups on realistic schedules. """
+    db.drop_all()
+    db.create_all()
+
+    now = datetime.datetime.now()
+    intervals = [interval for interval, share in INTERVALS
+                 for _ in range(int(share * 100))]
+    table = Backup.__table__
+    rows = []
+    for index in range(count):
+        if rng.random() < NIGHT_SHARE:
+            hour = rng.choice(NIGHT_HOURS)
+        else:
+            hour = rng.randrange(24)
+        server = 'fileserver{:04d}'.format(index // BACKUPS_PER_SERVER)
+        backup = Backup(name='Backup {}'.format(index), server=server,
+                        port=445, protocol=Backup.PROTOCOL.SMB,
+                        location='D:/shares/share{}'.format(index),
+                        username='backup', password='password',
+                        start_day=rng.randint(Backup.DAY.SUNDAY,
+                                              Backup.DAY.SATURDAY),
+                        start_time=hour, interval=rng.choice(intervals),
+                        retention=rng.choice([7, 14, 30, 90]))
+        rows.append({
+            'name': backup.name, 'enabled': True, 'start_now': False,
+            'cancel_requested': False, 'server': backup.server,
+            'port': backup.port, 'protocol': backup.protocol,
+            'location': backup.location, 'username': backup.username,
+            'password': backup.password, 'start_day': backup.start_day,
+            'start_time': backup.start_time, 'interval': backup.interval,
+            'next_run_at': backup.next_run_at,
+            'retention': backup.retention, 'shards': 1,
+            'engine': Backup.ENGINE.RDIFF, 'status': backup.status,
+            'error_message': '',
+            # Verified weekly, so verifications do not run during the
+            # benchmark
+            'next_verify_at': now + datetime.timedelta(
+                days=1 + rng.random() * 6),
+        })
+        if len(rows) == 5000:
+            db.session.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+
+
+def reschedule(reference):
+    """
+    Sets the next run of every backup to its first start after reference,
+    as if every backup had run on schedule until then.
+    """
+    probe = Backup(name='probe', server=None, port=None, protocol=None,
+                   location=None, username=None, password=None,
+                   start_day=None, start_time=None, interval=None,
+                   retention=None)
+    updates = []
+    for backup_id, start_day, start_time, interval in db.session.query(
+            Backup.id, Backup.start_day, Backup.start_time, Backup.interval):
+        probe.start_day = start_day
+        probe.start_time = start_time
+        probe.interval = interval
+        updates.append({'b_id': backup_id,
+                        'b_next': probe.next_run_after(reference)})
+
+    table = Backup.__table__
+    db.session.execute(table.update()
+                       .where(table.c.id == bindparam('b_id'))
+                       .values(next_run_at=bindparam('b_next'),
+                               start_now=False),
+                       updates)
+    db.session.commit()
+    db.session.remove()
+
+
+def bench_find_due(config, repeat):
+    """
+    Times refreshing the scheduler and popping the due jobs at the quietest
+    and the busiest start hour, and looking up each due job as the runner
+    does.
+    """
+    hours = Counter(hour for (hour,) in db.session.query(Backup.start_time))
+    quiet = min(range(24), key=lambda hour: hours[hour])
+    peak = max(range(24), key=lambda hour: hours[hour])
+    day = (datetime.datetime.now() + datetime.timedelta(days=1))\
+        .replace(minute=0, second=0, microsecond=0)
+
+    scenarios = [
+        ('quiet', day.replace(hour=quiet, minute=30), 1),
+        ('peak-upcoming', day.replace(hour=peak) -
+         datetime.timedelta(minutes=1), 120),
+        ('peak-due', day.replace(hour=peak) +
+         datetime.timedelta(minutes=1), 180),
+    ]
+
+    results = {}
+    for name, now, before in scenarios:
+        reschedule(now - datetime.timedelta(seconds=before))
+        scheduler = Scheduler(poll_interval=config['SCHEDULER_POLL_INTERVAL'],
+                              horizon=config['SCHEDULER_HORIZON'])
+        timings = []
+        due = []
+        for _ in range(repeat):
+            started = time.time()
+            scheduler.refresh(now)
+            due = scheduler.pop_due(now)
+            timings.append(time.time() - started)
+            loaded = len(scheduler) + len(due)
+            db.session.remove()
+
+        # The runner loads each due job to check it is still due
+        started = time.time()
+        for backup_id in due:
+            db.session.expire_all()
+            backup = Backup.query.get(backup_id)
+            backup.is_due(now)
+        lookup = time.time() - started
+        db.session.remove()
+
+        results[name] = {'loaded': loaded, 'due': len(due),
+                         'refresh_seconds': percentiles(timings),
+                         'lookup_seconds': lookup}
+    return results
+
+
+def make_runner(config):
+    """ Returns a Runner with its mounts and engines replaced by fakes. """
+    runner_module.engine_for = lambda backup: FakeEngine
+    runner = runner_module.Runner(config)
+    runner.mounts = FakeMountFS
+    runner.prestager = Prestager(FakeMountFS,
+                                 lookahead=config['PRESTAGE_LOOKAHEAD'],
+                                 workers=config['PRESTAGE_WORKERS'],
+                                 scan_workers=0)
+    return runner
+
+
+def wait_idle(runner, timeout=600):
+    deadline = time.time() + timeout
+    while not runner.is_idle() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def bench_idle_tick(runner, ticks):
+    """ Times runner ticks while no job is due or upcoming. """
+    # Nothing starts within the next hour
+    reschedule(datetime.datetime.now() + datetime.timedelta(hours=1))
+    results = {}
+    for name, refresh in (('refresh', True), ('no-refresh', False)):
+        runner.scheduler.invalidate()
+        runner.tick(datetime.datetime.now())
+        cpu, wall = cpu_seconds(), time.time()
+        for _ in range(ticks):
+            if refresh:
+                runner.scheduler.invalidate()
+            runner.tick(datetime.datetime.now())
+        results[name] = {'cpu_seconds': (cpu_seconds() - cpu) / ticks,
+                         'wall_seconds': (time.time() - wall) / ticks}
+    return results
+
+
+def start_now(backup_ids):
+    table = Backup.__table__
+    db.session.execute(table.update().where(table.c.id.in_(backup_ids))
+                       .values(start_now=True))
+    db.session.commit()
+    db.session.remove()
+
+
+def bench_dispatch(runner, jobs, rng):
+    """
+    Starts jobs as the web app does, and times each from the tick that finds
+    it due to its backup starting.
+    """
+    backup_ids = rng.sample(range(1, db.session.query(Backup.id).count() + 1),
+                            jobs)
+    start_now(backup_ids)
+    FakeEngine.started.clear()
+
+    runner.scheduler.invalidate()
+    started = time.time()
+    runner.tick(datetime.datetime.now())
+    wait_idle(runner)
+    elapsed = time.time() - started
+
+    latencies = [FakeEngine.started[backup_id] - started
+                 for backup_id in backup_ids
+                 if backup_id in FakeEngine.started]
+    return {'jobs': jobs, 'started': len(latencies),
+            'latency_seconds': percentiles(latencies),
+            'jobs_per_second': len(latencies) / elapsed if elapsed else None}
+
+
+def bench_memory(runner, config, hours, jobs_per_hour, rng):
+    """
+    Runs an hour of idle ticks, each refreshing the scheduler, and a batch
+    of jobs for every simulated hour, and samples the memory in between.
+    """
+    count = db.session.query(Backup.id).count()
+    ticks_per_hour = max(1, 3600 // config['SCHEDULER_POLL_INTERVAL'])
+    gc.collect()
+    samples = [rss_bytes()]
+    for _ in range(hours):
+        start_now(rng.sample(range(1, count + 1), jobs_per_hour))
+        runner.scheduler.invalidate()
+        runner.tick(datetime.datetime.now())
+        wait_idle(runner)
+
+        for _ in range(ticks_per_hour):
+            runner.scheduler.invalidate()
+            runner.tick(datetime.datetime.now())
+        gc.collect()
+        samples.append(rss_bytes())
+    return {'hours': hours, 'ticks_per_hour': ticks_per_hour,
+            'rss_bytes': samples, 'growth_bytes': samples[-1] - samples[0]}
+
+
+def run(count, args):
+    rng = random.Random(args.seed)
+    started = time.time()
+    populate(count, rng)
+    results = {'backups': count, 'populate_seconds': time.time() - started}
+
+    config = dict(app.config)
+    config.update(PRESCAN_WORKERS=0, PRESTAGE_SCAN_WORKERS=0,
+                  ADMISSION_MIN_FREE_BYTES=0, ADMISSION_MAX_LOAD=None,
+                  ADMISSION_MAX_IO_PRESSURE=None)
+
+    results['find_due'] = bench_find_due(config, args.repeat)
+    runner = make_runner(config)
+    results['idle_tick'] = bench_idle_tick(runner, args.ticks)
+    results['dispatch'] = bench_dispatch(runner, args.jobs, rng)
+    results['memory'] = bench_memory(runner, config, args.hours,
+                                     args.jobs_per_hour, rng)
+    return results
+
+
+def report(results):
+    mb = float(2 ** 20)
+    print("{} backups (populated in {:.1f}s)".format(
+        results['backups'], results['populate_seconds']))
+    for name, scenario in sorted(results['find_due'].items()):
+        refresh = scenario['refresh_seconds']
+        print("  find due, {:<14} {:6d} loaded {:6d} due  refresh median "
+              "{:.1f} ms, p95 {:.1f} ms  lookups {:.1f} ms".format(
+                  name, scenario['loaded'], scenario['due'],
+                  refresh['median'] * 1000, refresh['p95'] * 1000,
+                  scenario['lookup_seconds'] * 1000))
+    for name, tick in sorted(results['idle_tick'].items()):
+        print("  idle tick, {:<11} CPU {:.2f} ms, wall {:.2f} ms".format(
+            name, tick['cpu_seconds'] * 1000, tick['wall_seconds'] * 1000))
+    dispatch = results['dispatch']
+    latency = dispatch['latency_seconds']
+    if latency['median'] is not None:
+        print("  dispatch, {} of {} started  latency median {:.0f} ms, p95 "
+              "{:.0f} ms, max {:.0f} ms  {:.1f} jobs/s".format(
+                  dispatch['started'], dispatch['jobs'],
+                  latency['median'] * 1000, latency['p95'] * 1000,
+                  latency['max'] * 1000, dispatch['jobs_per_second']))
+    memory = results['memory']
+    print("  memory over {} hours: {:.1f} MB to {:.1f} MB ({:+.1f} MB)".format(
+        memory['hours'], memory['rss_bytes'][0] / mb,
+        memory['rss_bytes'][-1] / mb, memory['growth_bytes'] / mb))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backups', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help="Numbers of backups to benchmark with")
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="Scheduler refreshes timed per scenario")
+    parser.add_argument('--ticks', type=int, default=100,
+                        help="Idle ticks timed")
+    parser.add_argument('--jobs', type=int, default=200,
+                        help="Jobs started for the dispatch latency")
+    parser.add_argument('--hours', type=int, default=6,
+                        help="Simulated hours for the memory growth")
+    parser.add_argument('--jobs-per-hour', type=int, default=20,
+                        help="Jobs run in each simulated hour")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed of the generated schedules")
+    parser.add_argument('--json', help="File to write the results to")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scratch = tempfile.mkdtemp(prefix='runner-bench-')
+    try:
+        use_scratch(scratch)
+        runner_module.BACKUPS_DIR = backup_module.BACKUPS_DIR
+        FakeMountFS.share_dir = os.path.join(scratch, 'share')
+        os.makedirs(FakeMountFS.share_dir)
+
+        all_results = []
+        for count in args.backups:
+            results = run(count, args)
+            report(results)
+            all_results.append(results)
+
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump(all_results, output, indent=2)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Synthetic file shares for the benchmarks. A share is a directory tree with a
+given number of files, file sizes drawn from a log-normal distribution and
+a given depth, which changes every simulated night: some files are edited,
+some added and some deleted.
+
+The layout, sizes and changes are drawn from a seeded generator, so the
+same arguments give the same share. File contents are random bytes, so
+they neither compress nor deduplicate.
+"""
+from __future__ import absolute_import
+import math
+import os
+import random
+import time
+
+
+# Largest block written at once
+BLOCK_SIZE = 1024 * 1024
+
+
+class SyntheticShare(object):
+    """
+    SyntheticShare generates a share in a local directory and applies a
+    night of changes to it at a time.
+    """
+
+    def __init__(self, path, files=10000, size_median=64 * 1024,
+                 size_sigma=2.0, max_size=256 * 1024 * 1024, depth=4,
+                 fanout=5, change_rate=0.02, new_rate=0.005,
+                 delete_rate=0.002, seed=1):
+        """
+        path (str) - Directory to generate the share in
+        files (int) - Files in the share
+        size_median (int) - Median file size in bytes
+        size_sigma (float) - Spread of the log-normal file sizes, 0 for
+            every file to be size_median bytes
+        max_size (int) - Largest file size in bytes
+        depth (int) - Levels of directories below the share root
+        fanout (int) - Subdirectories of each directory
+        change_rate (float) - Share of the files edited each night
+        new_rate (float) - Files added each night, as a share of the files
+        delete_rate (float) - Files deleted each night, as a share of the
+            files
+        seed (int) - Seed of the layout, sizes and changes
+        """
+        self.path = path
+        self.files = files
+        self.size_median = size_median
+        self.size_sigma = size_sigma
+        self.max_size = max_size
+        self.depth = depth
+        self.fanout = fanout
+        self.change_rate = change_rate
+        self.new_rate = new_rate
+        self.delete_rate = delete_rate
+
+        self._random = random.Random(seed)
+        self._directories = []
+        # Size of each file, by relative path
+        self._sizes = {}
+        self._next_file = 0
+
+    @property
+    def file_count(self):
+        return len(self._sizes)
+
+    @property
+    def total_bytes(self):
+        return sum(self._sizes.values())
+
+    def generate(self):
+        """ Creates the directories and files of the share. """
+        self._directories = ['']
+        level = ['']
+        for _ in range(self.depth):
+            level = [os.path.join(parent, 'dir{}'.format(index))
+                     for parent in level for index in range(self.fanout)]
+            self._directories.extend(level)
+        for directory in self._directories:
+            os.makedirs(os.path.join(self.path, directory))
+
+        for _ in range(self.files):
+            self._add()
+
+    def change(self):
+        """
+        Applies a night of changes. Returns a dict with the files edited,
+        added and deleted, and the bytes written.
+        """
+        count = len(self._sizes)
+        paths = sorted(self._sizes)
+        edited = self._random.sample(paths, int(count * self.change_rate))
+        deleted = self._random.sample(
+            sorted(set(paths) - set(edited)), int(count * self.delete_rate))
+
+        written = 0
+        for relpath in edited:
+            written += self._edit(relpath)
+        for relpath in deleted:
+            os.remove(os.path.join(self.path, relpath))
+            del self._sizes[relpath]
+        added = int(count * self.new_rate)
+        for _ in range(added):
+            written += self._add()
+
+        return {'edited': len(edited), 'added': added,
+                'deleted': len(deleted), 'bytes_written': written}
+
+    def _size(self):
+        if self.size_sigma <= 0:
+            return self.size_median
+        size = self._random.lognormvariate(math.log(self.size_median),
+                                           self.size_sigma)
+        return int(min(self.max_size, size))
+
+    def _add(self):
+        """ Adds a file. Returns its size. """
+        directory = self._random.choice(self._directories)
+        relpath = os.path.join(directory, 'file{}.dat'.format(self._next_file))
+        self._next_file += 1
+
+        size = self._size()
+        with open(os.path.join(self.path, relpath), 'wb') as f:
+            _write_random(f, size)
+        self._sizes[relpath] = size
+        return size
+
+    def _edit(self, relpath):
+        """
+        Rewrites a part of a file, or appends to it, as a user saving a
+        document would. Returns the bytes written.
+        """
+        size = self._sizes[relpath]
+        path = os.path.join(self.path, relpath)
+        mtime = os.stat(path).st_mtime
+        with open(path, 'r+b') as f:
+            if size == 0 or self._random.random() < 0.3:
+                length = max(1, self._size() // 10)
+                f.seek(0, os.SEEK_END)
+                self._sizes[relpath] = size + length
+            else:
+                offset = self._random.randrange(size)
+                length = min(size - offset, max(4096, size // 10))
+                f.seek(offset)
+            _write_random(f, length)
+        # An edit within the second of the last backup would keep the
+        # mtime, and look unchanged to a backup comparing mtimes and sizes
+        mtime = max(int(time.time()), int(mtime) + 1)
+        os.utime(path, (mtime, mtime))
+        return length
+
+
+def _write_random(f, size):
+    while size > 0:
+        block = min(size, BLOCK_SIZE)
+        f.write(os.urandom(block))
+        size -= block
@@ -8,3 +8,96 @@ SECRET_KEY = 'super-mario-brothers'
 
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
 
+
+# Log the time, template render time and SQL queries of every request, and
+# the requests taking SLOW_REQUEST_SECONDS or more with their statements to
+# SLOW_REQUEST_LOG
+PROFILE_REQUESTS = False
+SLOW_REQUEST_SECONDS = 1.0
+SLOW_REQUEST_LOG = os.path.join(basedir, 'slow-requests.log')
+
+
+# backup runner
+# Seconds between scheduler refreshes of upcoming jobs from the database. The
+# web app wakes the runner up through RUNNER_SOCKET when a job changes, so
+# this only picks up changes made by other appliances.
+SCHEDULER_POLL_INTERVAL = 60
+# Seconds ahead of now that upcoming jobs are loaded into the scheduler
+SCHEDULER_HORIZON = 300
+# Unix domain socket the web app uses to wake the runner up
+RUNNER_SOCKET = os.path.join(basedir, 'runner.sock')
+# File the runner writes its metrics to for the web app's /metrics endpoint,
+# and seconds between writes
+RUNNER_METRICS_FILE = os.path.join(basedir, 'runner.metrics')
+METRICS_INTERVAL = 15
+# Maximum number of jobs running at once, in total, per server and per share
+RUNNER_MAX_JOBS = 4
+RUNNER_MAX_JOBS_PER_SERVER = 2
+RUNNER_MAX_JOBS_PER_SHARE = 1
+# Seconds a runner holds a job without renewing its lease
+RUNNER_LEASE_TTL = 60
+# Seconds a job may run before the runner preempts it
+RUNNER_MAX_JOB_RUNTIME = 3 * 24 * 60 * 60
+# Byte-rate limits shared by all running backups and restores, by hour of
+# the day. Each entry is (first hour, last hour, total bytes per second,
+# bytes per second per server). The first entry that covers the current hour
+# applies, None means unlimited. An entry whose first hour is after its last
+# hour spans midnight, and hours no entry covers are unlimited.
+THROTTLE_SCHEDULE = [
+    # Business hours
+    (8, 17, 100 * 1024 * 1024, 25 * 1024 * 1024),
+    # Off-hours
+    (18, 7, 400 * 1024 * 1024, 100 * 1024 * 1024),
+]
+# Jobs are deferred, not started, if the backup repository would be left with
+# less free space than this, in bytes
+ADMISSION_MIN_FREE_BYTES = 10 * 1024 * 1024 * 1024
+# Jobs are expected to grow their repository by this factor times the most
+# they grew it in recent runs
+ADMISSION_GROWTH_FACTOR = 1.5
+# Jobs are deferred while the 1 minute load average per CPU is above this
+ADMISSION_MAX_LOAD = 2.0
+# Jobs are deferred while tasks were stalled on I/O more than this percent
+# of the last 10 seconds (Linux pressure stall information)
+ADMISSION_MAX_IO_PRESSURE = 60.0
+# Seconds between retention prunes of each backup repository
+PRUNE_INTERVAL = 24 * 60 * 60
+# Repositories pruned per batch, seconds to pause between batches, and
+# seconds a batch may take. Batches run while the runner has a free job slot.
+PRUNE_BATCH_SIZE = 5
+PRUNE_BATCH_PAUSE = 60
+PRUNE_BATCH_TIMEOUT = 15 * 60
+# Threads that scan a share for changes before it is backed up, 0 disables
+# the scan. Shares without changes since the last backup are skipped.
+PRESCAN_WORKERS = 16
+# Seconds between verifications of each backup's stored data
+VERIFY_INTERVAL = 7 * 24 * 60 * 60
+# Threads that hash stored data during a verification, None for one per core
+VERIFY_WORKERS = None
+# Files restored into scratch space and compared by each verification, and
+# the most bytes restored
+VERIFY_SAMPLE_SIZE = 20
+VERIFY_SAMPLE_BYTES = 1024 * 1024 * 1024
+# rdiff-backup processes, or threads for the other engines, that restore a
+# directory at once
+RESTORE_WORKERS = 8
+# Directory holding the file catalog of each backup, which maps the files
+# backed up to the increments they are in
+CATALOG_DIR = '/var/backups/.catalog'
+# Entries per page when browsing the contents of a backup, and directory
+# pages kept in memory by the web app
+BROWSE_PAGE_SIZE = 200
+BROWSE_CACHE_SIZE = 256
+# Most paths listed from each backup when searching the catalogs
+SEARCH_RESULTS = 50
+# Seconds a share stays mounted after the last job using it, so jobs that
+# follow each other on the same share reuse the mount
+MOUNT_IDLE_TIMEOUT = 300
+# Seconds before a backup is due that its share is mounted and checked, 0
+# disables pre-staging. At most SCHEDULER_HORIZON, as only jobs loaded into
+# the scheduler are staged.
+PRESTAGE_LOOKAHEAD = 300
+# Shares staged at once, and threads walking a staged share to warm its
+# directory metadata, 0 to only mount and check it
+PRESTAGE_WORKERS = 2
+PRESTAGE_SCAN_WORKERS = 4
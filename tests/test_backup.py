@@ -0,0 +1,1475 @@
+import datetime
+import fcntl
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from app import app, db
+from app.models import Backup
+
+# The backup modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'backup'))
+
+import admission
+from admission import AdmissionController, expected_growth, io_pressure
+from backup import RdiffRestoreException, restore_relpath
+from dedup import CHUNK_MAX, CHUNK_MIN, ChunkStore, DedupBackupEngine, \
+    DedupRestoreException, chunks, save_snapshot
+from delta import SEARCH_STRIDE, DeltaBackupEngine, DeltaBackupException, \
+    DeltaRestoreException, DeltaWriter, Signature, delta, patch
+from fs_mount import AbstractMountFS, MountPool
+from lease import LeaseKeeper
+from pool import JobPool, parallel_map
+from prestage import Prestager
+from process import LINE_MAX, TAIL_BYTES, OutputTail, Process, \
+    ProcessTerminated
+from prune import Pruner
+from runner import RunningJobs
+import scan
+from scan import ScanIndex, ShareScanner
+from scheduler import Scheduler
+from shard import ShardedRdiffBackupWrapper
+from throttle import Throttle, TokenBucket
+
+
+class BaseTestCase(unittest.TestCase):
+    """
+    Abstract base test class for the backup runner.
+    """
+    def setUp(self):
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        db.create_all()
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(app.config['DATABASE'])
+
+
+class LeaseKeeperTestCase(BaseTestCase):
+    """
+    Test the leases held by a runner.
+    """
+    def setUp(self):
+        super(LeaseKeeperTestCase, self).setUp()
+        self.backup = Backup(name='Teachers Backup', server='winshare01',
+                             port=445, protocol=Backup.PROTOCOL.SMB,
+                             location='F:/teachers', username='testuser',
+                             password='testpassword', start_time=1,
+                             start_day=Backup.DAY.SUNDAY,
+                             interval=Backup.INTERVAL.DAILY, retention=14)
+        db.session.add(self.backup)
+        db.session.commit()
+        self.leases = LeaseKeeper(ttl=60, owner='runner-a')
+
+    def tearDown(self):
+        super(LeaseKeeperTestCase, self).tearDown()
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_claim_is_exclusive(self):
+        assert self.leases.claim(self.backup.id)
+        # A verification or prune cannot join a running backup
+        assert not self.leases.claim(self.backup.id)
+        assert self.leases.holds(self.backup.id)
+
+    def test_claim_after_release(self):
+        assert self.leases.claim(self.backup.id)
+        self.leases.release(self.backup.id)
+        assert not self.leases.holds(self.backup.id)
+        assert self.leases.claim(self.backup.id)
+
+    def test_running_jobs_are_not_replaced(self):
+        jobs = RunningJobs()
+        jobs.add(self.backup.id, object())
+        self.assertRaises(ValueError, jobs.add, self.backup.id, object())
+        jobs.remove(self.backup.id)
+        assert self.backup.id not in jobs
+
+
+class PrunerTestCase(BaseTestCase):
+    """
+    Test pruning repositories around running jobs.
+    """
+    def setUp(self):
+        super(PrunerTestCase, self).setUp()
+        self.backup = Backup(name='Teachers Backup', server='winshare01',
+                             port=445, protocol=Backup.PROTOCOL.SMB,
+                             location='F:/teachers', username='testuser',
+                             password='testpassword', start_time=1,
+                             start_day=Backup.DAY.SUNDAY,
+                             interval=Backup.INTERVAL.DAILY, retention=14)
+        db.session.add(self.backup)
+        db.session.commit()
+
+        self.pruned = []
+        pruned = self.pruned
+
+        class Engine(object):
+            def __init__(self, remote_dir, backup_dir):
+                self.backup_dir = backup_dir
+
+            def has_backups(self):
+                return True
+
+            def prune(self, retention, timeout=None):
+                pruned.append((self.backup_dir, timeout))
+                return 1024
+
+            def increments(self):
+                return []
+
+        self.scratch = tempfile.mkdtemp()
+        self.catalog_dir = app.config['CATALOG_DIR']
+        app.config['CATALOG_DIR'] = os.path.join(self.scratch, 'catalog')
+        self.leases = LeaseKeeper(ttl=60, owner='runner-a')
+        self.free_slot = True
+        self.pruner = Pruner(self.scratch, lambda backup: Engine,
+                             self.leases,
+                             has_free_slot=lambda: self.free_slot,
+                             batch_timeout=600)
+
+    def tearDown(self):
+        super(PrunerTestCase, self).tearDown()
+        app.config['CATALOG_DIR'] = self.catalog_dir
+        shutil.rmtree(self.scratch)
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_prune_skips_leased_backup(self):
+        # The backup's own job is running
+        assert self.leases.claim(self.backup.id)
+        assert self.pruner.prune_batch() == 0
+        assert self.pruned == []
+
+    def test_prune_releases_lease(self):
+        assert self.pruner.prune_batch() == 1
+        assert len(self.pruned) == 1
+        assert not self.leases.holds(self.backup.id)
+
+    def test_prune_records_bytes_freed(self):
+        assert self.pruner.prune_batch() == 1
+        backup = Backup.query.get(self.backup.id)
+        assert backup.pruned_bytes == 1024
+        assert backup.last_pruned is not None
+
+    def test_prune_within_batch_timeout(self):
+        assert self.pruner.prune_batch() == 1
+        _, timeout = self.pruned[0]
+        assert 0 < timeout <= 600
+
+    def test_prune_reports_pruned_backup(self):
+        observed = []
+        self.pruner.on_pruned = lambda backup_id: observed.append(
+            (backup_id, self.leases.holds(backup_id)))
+        assert self.pruner.prune_batch() == 1
+        assert observed == [(self.backup.id, True)]
+
+    def test_prune_waits_for_free_slot(self):
+        self.free_slot = False
+        assert self.pruner.prune_batch() == 0
+        assert self.pruned == []
+
+
+class RestorePathTestCase(unittest.TestCase):
+    """
+    Test the paths that restores accept.
+    """
+    def test_restore_relpath(self):
+        assert restore_relpath('/') == ''
+        assert restore_relpath('/math/grades/') == 'math/grades'
+        assert restore_relpath('math//./grades') == 'math/grades'
+        assert restore_relpath('/math/../art') == 'art'
+
+    def test_restore_relpath_outside_share(self):
+        for path in ('..', '/../2', '/math/../../2/secrets'):
+            self.assertRaises(ValueError, restore_relpath, path)
+
+
+class ShardedRdiffBackupWrapperTestCase(unittest.TestCase):
+    """
+    Test restoring from the shards of a backup.
+    """
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp()
+        self.wrapper = ShardedRdiffBackupWrapper(
+            remote_dir='/mnt/teachers', backup_dir=self.backup_dir, shards=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.backup_dir)
+
+    def test_restore_without_backups(self):
+        self.assertRaises(RdiffRestoreException, self.wrapper.restore, '/')
+
+    def test_restore_from_shard_without_backups(self):
+        # Only the shard that math does not belong to holds a repository
+        other = self.wrapper.shards[1 - self.wrapper.shard_of('math')]
+        os.makedirs(os.path.join(other.backup_dir, 'rdiff-backup-data'))
+        self.assertRaises(RdiffRestoreException, self.wrapper.restore,
+                          '/math/grades.xls')
+
+
+def random_bytes(size, seed):
+    """ Returns size random bytes that are the same for a seed. """
+    rng = random.Random(seed)
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+class DeltaTestCase(unittest.TestCase):
+    """
+    Test signatures, deltas and patches of the delta engine.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.basis = random_bytes(100000, 1)
+        self.signature = Signature(len(self.basis), 1.0, block_size=1024)
+        self.signature.update(self.basis)
+        self.signature.finish()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def rebuild(self, data):
+        """ Returns data rebuilt from the basis and its delta. """
+        basis_path = os.path.join(self.scratch, 'basis')
+        with open(basis_path, 'wb') as f:
+            f.write(self.basis)
+        delta_path = os.path.join(self.scratch, 'delta')
+        writer = DeltaWriter(delta_path)
+        copied = 0
+        for kind, value in delta(io.BytesIO(data), self.signature):
+            if kind == 'copy':
+                length = self.signature.block_length(value)
+                writer.copy(value * self.signature.block_size, length)
+                copied += length
+            else:
+                writer.data(value)
+        writer.close()
+        out_path = os.path.join(self.scratch, 'out')
+        patch(basis_path, delta_path, out_path)
+        with open(out_path, 'rb') as f:
+            return f.read(), copied
+
+    def test_signature_save_load(self):
+        path = os.path.join(self.scratch, 'signature')
+        self.signature.save(path)
+        loaded = Signature.load(path)
+        assert loaded.matches(len(self.basis), 1.0)
+        assert loaded.block_size == 1024
+        assert loaded.weak == self.signature.weak
+        assert loaded.strong == self.signature.strong
+        assert Signature.load(os.path.join(self.scratch, 'missing')) is None
+
+    def test_signature_compute(self):
+        path = os.path.join(self.scratch, 'basis')
+        with open(path, 'wb') as f:
+            f.write(self.basis)
+        computed = Signature.compute(path, len(self.basis), 1.0)
+        assert computed.block_size == 8 * 1024
+        assert len(computed.weak) == 13
+        assert computed.matches(len(self.basis), 1.0)
+        assert not computed.matches(len(self.basis), 2.0)
+
+    def test_unchanged(self):
+        data, copied = self.rebuild(self.basis)
+        assert data == self.basis
+        assert copied == len(self.basis)
+
+    def test_edited(self):
+        edited = self.basis[:5000] + random_bytes(300, 2) + \
+            self.basis[5300:]
+        data, copied = self.rebuild(edited)
+        assert data == edited
+        assert copied >= len(self.basis) - 2 * 1024
+
+    def test_inserted(self):
+        # Blocks after an insertion are found again by the rolling checksum
+        inserted = self.basis[:50000] + b'inserted' + self.basis[50000:] + \
+            b'appended'
+        data, copied = self.rebuild(inserted)
+        assert data == inserted
+        # Only the block with the insertion and the last, partial block
+        # followed by the appended data are stored
+        assert copied >= len(self.basis) - 2 * 1024
+
+    def test_rewritten(self):
+        rewritten = random_bytes(80000, 3)
+        data, copied = self.rebuild(rewritten)
+        assert data == rewritten
+        assert copied == 0
+
+    def test_rewritten_in_place(self):
+        # Far from the last match, block-aligned windows are still tried
+        rewritten = self.basis[:10240] + random_bytes(40960, 3) + \
+            self.basis[51200:]
+        data, copied = self.rebuild(rewritten)
+        assert data == rewritten
+        assert copied == len(self.basis) - 40960
+
+    def test_replaced_head(self):
+        # Blocks after a long run of new data are found at any offset,
+        # after at most SEARCH_STRIDE of them
+        replaced = random_bytes(20000, 3) + self.basis[30000:]
+        data, copied = self.rebuild(replaced)
+        assert data == replaced
+        assert copied >= len(self.basis) - 30000 - (SEARCH_STRIDE + 2) * 1024
+
+    def test_empty(self):
+        data, copied = self.rebuild(b'')
+        assert data == b''
+        assert copied == 0
+
+
+class DeltaBackupEngineTestCase(unittest.TestCase):
+    """
+    Test backups, restores and prunes of the delta engine.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.share = os.path.join(self.scratch, 'share')
+        os.makedirs(self.share)
+        self.engine = DeltaBackupEngine(self.share,
+                                        os.path.join(self.scratch, 'backup'))
+        self.mtime = 1000000000
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def write(self, files):
+        """ Makes the share hold exactly files, by relative path. """
+        shutil.rmtree(self.share)
+        os.makedirs(self.share)
+        for relpath, data in files.items():
+            path = os.path.join(self.share, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+            # Changes are found by size and mtime
+            self.mtime += 1
+            os.utime(path, (self.mtime, self.mtime))
+
+    def backup(self, files):
+        self.write(files)
+        self.engine.backup()
+        return self.engine.runs()[-1]
+
+    def restored(self, time_format):
+        """ Returns the files restored as of time_format, by path. """
+        target = tempfile.mkdtemp(dir=self.scratch)
+        engine = DeltaBackupEngine(target, self.engine.backup_dir)
+        engine.restore(path='/', time_format=time_format)
+        files = {}
+        for directory, _, names in os.walk(target):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, target)] = f.read()
+        return files
+
+    def versions(self):
+        first = {'a.bin': random_bytes(50000, 1),
+                 'b.bin': random_bytes(20000, 2),
+                 os.path.join('math', 'c.bin'): random_bytes(30000, 3)}
+        second = dict(first)
+        second['a.bin'] = first['a.bin'][:10000] + b'inserted' + \
+            first['a.bin'][10000:]
+        del second['b.bin']
+        second[os.path.join('math', 'd.bin')] = random_bytes(1000, 4)
+        third = dict(second)
+        third['a.bin'] = second['a.bin'][:40000] + random_bytes(500, 5)
+        third['b.bin'] = random_bytes(25000, 6)
+        return [first, second, third]
+
+    def test_restore_every_run(self):
+        versions = self.versions()
+        runs = [self.backup(files) for files in versions]
+        assert self.engine.runs() == runs
+        for run, files in zip(runs, versions):
+            assert self.restored(str(run)) == files
+
+    def test_restore_before_first_run(self):
+        run = self.backup(self.versions()[0])
+        self.assertRaises(DeltaRestoreException, self.restored,
+                          str(run - 1))
+
+    def test_regress_interrupted_run(self):
+        first, second, _ = self.versions()
+        run = self.backup(first)
+
+        engine = self.engine
+        charged = []
+
+        class StoppingThrottle(object):
+            def charge(self, server, size):
+                charged.append(size)
+                # Stop while math/d.bin is copied, after a.bin and
+                # math/c.bin were replaced and b.bin was removed
+                if len(charged) == 3:
+                    raise DeltaBackupException("Job was terminated.")
+
+        second[os.path.join('math', 'c.bin')] = random_bytes(30000, 7)
+        self.write(second)
+        engine.throttle = StoppingThrottle()
+        self.assertRaises(DeltaBackupException, engine.backup)
+        engine.throttle = None
+        assert engine.runs() == [run]
+
+        engine._regress()
+        assert os.listdir(engine.increments_dir) == [str(run)]
+        assert self.restored(str(run)) == first
+        with open(os.path.join(engine.mirror_dir, 'a.bin'), 'rb') as f:
+            assert f.read() == first['a.bin']
+
+        # The next run backs up the share as if the interrupted one had
+        # never started
+        latest = self.backup(second)
+        assert self.restored(str(run)) == first
+        assert self.restored(str(latest)) == second
+
+    def test_prune(self):
+        versions = self.versions()
+        runs = [self.backup(files) for files in versions]
+        assert self.engine.prune(0) > 0
+        assert self.engine.runs()[-1] == runs[-1]
+        assert runs[0] not in self.engine.runs()
+        assert self.engine.has_backups()
+        assert self.restored(str(runs[-1])) == versions[-1]
+        self.assertRaises(DeltaRestoreException, self.restored,
+                          str(runs[0]))
+
+
+class ChunksTestCase(unittest.TestCase):
+    """
+    Test content-defined chunking.
+    """
+    def setUp(self):
+        self.data = random_bytes(CHUNK_MAX * 3, 1)
+
+    def chunks(self, data):
+        return list(chunks(io.BytesIO(data)))
+
+    def test_chunks_join(self):
+        split = self.chunks(self.data)
+        assert b''.join(split) == self.data
+        assert len(split) > 1
+        for chunk in split[:-1]:
+            assert CHUNK_MIN < len(chunk) <= CHUNK_MAX
+
+    def test_small_file(self):
+        assert self.chunks(b'') == []
+        assert self.chunks(b'small') == [b'small']
+
+    def test_unchanged_chunks_after_insertion(self):
+        # Boundaries depend on content, so an insertion only changes the
+        # chunk it falls in
+        before = self.chunks(self.data)
+        offset = len(before[0]) + 1000
+        after = self.chunks(self.data[:offset] + b'inserted' +
+                            self.data[offset:])
+        assert after[0] == before[0]
+        assert len(set(before) - set(after)) == 1
+
+    def test_chunks_of_short_reads(self):
+        # Boundaries do not depend on where the reads of the file end
+        class ShortReads(io.BytesIO):
+            def read(self, size=-1):
+                return super(ShortReads, self).read(min(size, 4099))
+
+        assert list(chunks(ShortReads(self.data))) == self.chunks(self.data)
+
+
+class ChunkStoreTestCase(unittest.TestCase):
+    """
+    Test storing chunks and collecting the unused ones.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.store = ChunkStore(self.scratch)
+        self.snapshot = os.path.join(self.scratch, 'snapshot.json.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def age(self, digest, seconds):
+        past = time.time() - seconds
+        os.utime(self.store.path(digest), (past, past))
+
+    def test_put_get(self):
+        digest, new = self.store.put(b'chunk')
+        assert new
+        assert self.store.get(digest) == b'chunk'
+        assert self.store.put(b'chunk') == (digest, False)
+
+    def test_collect_unreferenced(self):
+        used, _ = self.store.put(b'used')
+        unused, _ = self.store.put(b'unused')
+        young, _ = self.store.put(b'young')
+        self.age(used, 3600)
+        self.age(unused, 3600)
+        save_snapshot(self.snapshot, {'a': {'t': 'f', 'c': [used]}})
+
+        removed, _ = self.store.collect_garbage([self.snapshot],
+                                                grace_period=60)
+        assert removed == 1
+        assert os.path.exists(self.store.path(used))
+        assert not os.path.exists(self.store.path(unused))
+        assert os.path.exists(self.store.path(young))
+
+    def test_collect_spares_reused_chunk(self):
+        digest, _ = self.store.put(b'reused')
+        self.age(digest, 3600)
+        # A running backup reuses the chunk before writing its snapshot
+        self.store.put(b'reused')
+        assert self.store.collect_garbage([], grace_period=60) == (0, 0)
+
+    def test_collect_waits_for_reuse(self):
+        digest, _ = self.store.put(b'reused')
+        self.age(digest, 3600)
+        collected = []
+        with self.store.locked(fcntl.LOCK_SH):
+            collector = threading.Thread(target=lambda: collected.append(
+                self.store.collect_garbage([], grace_period=60)))
+            collector.start()
+            collector.join(0.2)
+            # The chunk cannot go while a backup is reusing it
+            assert collector.is_alive()
+            os.utime(self.store.path(digest), None)
+        collector.join()
+        assert collected == [(0, 0)]
+        assert os.path.exists(self.store.path(digest))
+
+
+class DedupBackupEngineTestCase(unittest.TestCase):
+    """
+    Test backups, restores and prunes of the dedup engine.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.share = os.path.join(self.scratch, 'share')
+        os.makedirs(self.share)
+        self.backups_dir = os.path.join(self.scratch, 'backups')
+        self.chunk_dir = os.path.join(self.backups_dir, '.chunks')
+        self.engine = DedupBackupEngine(self.share,
+                                        os.path.join(self.backups_dir, '1'),
+                                        chunk_dir=self.chunk_dir)
+        self.mtime = 1000000000
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def backup(self, files):
+        """ Backs up a share holding exactly files, by relative path. """
+        shutil.rmtree(self.share)
+        os.makedirs(self.share)
+        for relpath, data in files.items():
+            path = os.path.join(self.share, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+            # Changes are found by size and mtime
+            self.mtime += 1
+            os.utime(path, (self.mtime, self.mtime))
+        self.engine.backup()
+        return self.engine.snapshots()[-1][0]
+
+    def restored(self, time_format, path='/'):
+        """ Returns the files restored as of time_format, by path. """
+        target = tempfile.mkdtemp(dir=self.scratch)
+        engine = DedupBackupEngine(target, self.engine.backup_dir,
+                                   chunk_dir=self.chunk_dir)
+        engine.restore(path=path, time_format=time_format)
+        files = {}
+        for directory, _, names in os.walk(target):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, target)] = f.read()
+        return files
+
+    def chunk_names(self):
+        return set(name for _, _, names in os.walk(self.chunk_dir)
+                   for name in names if not name.startswith('.'))
+
+    def versions(self):
+        big = random_bytes(CHUNK_MAX + CHUNK_MIN, 1)
+        first = {'big.bin': big, 'b.bin': random_bytes(20000, 2),
+                 os.path.join('math', 'c.bin'): random_bytes(30000, 3)}
+        second = dict(first)
+        second['big.bin'] = big[:CHUNK_MIN] + b'inserted' + big[CHUNK_MIN:]
+        del second['b.bin']
+        second[os.path.join('math', 'copy.bin')] = first['b.bin']
+        return [first, second]
+
+    def test_restore_every_snapshot(self):
+        versions = self.versions()
+        taken = [self.backup(files) for files in versions]
+        for when, files in zip(taken, versions):
+            assert self.restored(str(when)) == files
+        math = os.path.join('math', 'c.bin')
+        assert self.restored(str(taken[0]), '/math/c.bin') == \
+            {math: versions[0][math]}
+
+    def test_restore_before_first_snapshot(self):
+        when = self.backup(self.versions()[0])
+        self.assertRaises(DedupRestoreException, self.restored,
+                          str(when - 1))
+
+    def test_backup_reuses_chunks(self):
+        first, second = self.versions()
+        self.backup(first)
+        self.backup(second)
+        statistics = self.engine.run_statistics()
+        # Every file was written again, but only the chunk with the
+        # insertion is new
+        assert statistics['ChangedSourceSize'] == \
+            sum(len(data) for data in second.values())
+        assert 0 < statistics['IncrementFileSize'] < CHUNK_MAX
+
+    def test_prune_collects_chunks(self):
+        first, second = self.versions()
+        taken = [self.backup(first), self.backup(second)]
+        names = self.chunk_names()
+        past = time.time() - 8 * 24 * 60 * 60
+        for name in names:
+            os.utime(self.engine.store.path(name), (past, past))
+
+        # The snapshot of the first version, and the chunk only it used
+        freed = self.engine.prune(0)
+        assert freed >= CHUNK_MIN
+        assert [when for when, _ in self.engine.snapshots()] == [taken[-1]]
+        # Only the chunk of the first version of big.bin is unused, b.bin
+        # lives on as math/copy.bin
+        assert len(names - self.chunk_names()) == 1
+        assert self.restored(str(taken[-1])) == second
+        self.assertRaises(DedupRestoreException, self.restored,
+                          str(taken[0]))
+
+
+class SchedulerTestCase(BaseTestCase):
+    """
+    Test the heap of upcoming backup jobs.
+    """
+    def setUp(self):
+        super(SchedulerTestCase, self).setUp()
+        self.now = datetime.datetime.now().replace(microsecond=0)
+        self.scheduler = Scheduler(poll_interval=5, horizon=300)
+
+    def tearDown(self):
+        super(SchedulerTestCase, self).tearDown()
+        Backup.query.delete()
+        db.session.commit()
+
+    def add_backup(self, seconds, **kwargs):
+        """ Adds a backup next run in seconds from now. """
+        backup = Backup(name='Teachers Backup', server='winshare01',
+                        port=445, protocol=Backup.PROTOCOL.SMB,
+                        location='F:/teachers', username='testuser',
+                        password='testpassword', start_time=1,
+                        start_day=Backup.DAY.SUNDAY,
+                        interval=Backup.INTERVAL.DAILY, retention=14)
+        backup.next_run_at = self.now + datetime.timedelta(seconds=seconds)
+        for name, value in kwargs.items():
+            setattr(backup, name, value)
+        db.session.add(backup)
+        db.session.commit()
+        return backup
+
+    def at(self, seconds):
+        return self.now + datetime.timedelta(seconds=seconds)
+
+    def test_refresh_within_horizon(self):
+        soon = self.add_backup(60)
+        later = self.add_backup(30)
+        self.add_backup(3600)
+        self.add_backup(60, enabled=False)
+        started = self.add_backup(3600, start_now=True)
+        self.scheduler.refresh(self.now)
+        assert len(self.scheduler) == 3
+
+        assert self.scheduler.pop_due(self.now) == [started.id]
+        assert self.scheduler.pop_due(self.at(59)) == [later.id]
+        assert self.scheduler.pop_due(self.at(120)) == [soon.id]
+        assert self.scheduler.pop_due(self.at(120)) == []
+        assert len(self.scheduler) == 0
+
+    def test_expired_lease_is_taken_over(self):
+        backup = self.add_backup(3600, status=Backup.STATUS.RUNNING,
+                                 lease_owner='runner-b',
+                                 lease_expires=self.at(90))
+        self.scheduler.refresh(self.now)
+        assert self.scheduler.upcoming(self.now, 300) == \
+            [(backup.id, self.at(90))]
+
+    def test_refresh_after_edit(self):
+        backup = self.add_backup(60)
+        self.scheduler.refresh(self.now)
+        backup.next_run_at = self.at(200)
+        db.session.commit()
+        self.scheduler.refresh(self.now)
+        assert self.scheduler.pop_due(self.at(100)) == []
+        assert self.scheduler.pop_due(self.at(200)) == [backup.id]
+
+    def test_refresh_after_delete(self):
+        backup = self.add_backup(60)
+        self.scheduler.refresh(self.now)
+        db.session.delete(backup)
+        db.session.commit()
+        self.scheduler.refresh(self.now)
+        assert self.scheduler.pop_due(self.at(120)) == []
+
+    def test_stale_entries(self):
+        self.scheduler.push(1, self.at(10))
+        self.scheduler.push(1, self.at(30))
+        self.scheduler.push(2, self.at(20))
+        self.scheduler.discard(2)
+        assert len(self.scheduler) == 1
+        # Neither the replaced deadline of 1 nor the discarded 2 wake up
+        # the runner
+        assert self.scheduler.seconds_until_next(self.now) == 5
+        assert self.scheduler.seconds_until_next(self.at(28)) == 2
+        assert self.scheduler.pop_due(self.at(25)) == []
+        assert self.scheduler.pop_due(self.at(30)) == [1]
+
+    def test_needs_refresh(self):
+        assert self.scheduler.needs_refresh(self.now)
+        self.scheduler.refresh(self.now)
+        assert not self.scheduler.needs_refresh(self.at(4))
+        assert self.scheduler.seconds_until_next(self.at(4)) == 1
+        assert self.scheduler.needs_refresh(self.at(5))
+        self.scheduler.invalidate()
+        assert self.scheduler.needs_refresh(self.now)
+
+
+def wait_until(condition, timeout=5):
+    """ Returns True once condition() is true, False after timeout. """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class JobPoolTestCase(unittest.TestCase):
+    """
+    Test the limits on jobs running at once.
+    """
+    def setUp(self):
+        self.started = []
+        self.finish = {}
+
+    def tearDown(self):
+        for event in self.finish.values():
+            event.set()
+
+    def job(self, key):
+        self.started.append(key)
+        self.finish[key].wait(10)
+
+    def submit(self, pool, key, server, share, ahead=False):
+        self.finish[key] = threading.Event()
+        submit = pool.submit_ahead if ahead else pool.submit
+        return submit(key, server, share, self.job, key)
+
+    def done(self, pool, key):
+        """ Lets a running job finish and waits for its slot to free. """
+        self.finish[key].set()
+        assert wait_until(lambda: key not in pool.keys()[1])
+
+    def test_global_cap(self):
+        pool = JobPool(max_jobs=2)
+        for key, server in ((1, 'a'), (2, 'b'), (3, 'c')):
+            self.submit(pool, key, server, 'share')
+        assert wait_until(lambda: len(self.started) == 2)
+        assert pool.running == 2 and pool.pending == 1
+        self.done(pool, 1)
+        assert wait_until(lambda: self.started == [1, 2, 3])
+
+    def test_server_cap(self):
+        pool = JobPool(max_jobs=4, max_jobs_per_server=2)
+        for key, server, share in ((1, 'WinShare01', 'math'),
+                                   (2, 'winshare01', 'art'),
+                                   (3, 'winshare01', 'music'),
+                                   (4, 'winshare02', 'math')):
+            self.submit(pool, key, server, share)
+        # A job for another server passes the one waiting for its server
+        assert wait_until(lambda: sorted(self.started) == [1, 2, 4])
+        assert pool.keys()[0] == [3]
+        self.done(pool, 2)
+        assert wait_until(lambda: 3 in self.started)
+
+    def test_share_cap(self):
+        pool = JobPool(max_jobs=4, max_jobs_per_server=4,
+                       max_jobs_per_share=1)
+        self.submit(pool, 1, 'winshare01', 'F:/teachers')
+        self.submit(pool, 2, 'WINSHARE01', 'f:/Teachers/')
+        self.submit(pool, 3, 'winshare01', 'F:/students')
+        assert wait_until(lambda: sorted(self.started) == [1, 3])
+        assert pool.keys()[0] == [2]
+        self.done(pool, 1)
+        assert wait_until(lambda: 2 in self.started)
+
+    def test_duplicate_key(self):
+        pool = JobPool(max_jobs=1)
+        assert self.submit(pool, 1, 'a', 'share')
+        assert not pool.submit(1, 'a', 'share', self.job, 1)
+        assert pool.is_queued(1)
+        self.done(pool, 1)
+        assert not pool.is_queued(1)
+
+    def test_submit_ahead(self):
+        pool = JobPool(max_jobs=1)
+        self.submit(pool, 1, 'a', 'share')
+        assert wait_until(lambda: self.started == [1])
+        self.submit(pool, 2, 'b', 'share')
+        self.submit(pool, 3, 'c', 'share')
+        self.submit(pool, 4, 'd', 'share', ahead=True)
+        self.submit(pool, 5, 'e', 'share', ahead=True)
+        assert pool.keys()[0] == [4, 5, 2, 3]
+        for key in (1, 4, 5, 2):
+            self.done(pool, key)
+        assert wait_until(lambda: self.started == [1, 4, 5, 2, 3])
+
+    def test_failed_job_frees_slot(self):
+        pool = JobPool(max_jobs=1)
+
+        def fail():
+            raise RuntimeError("Something has gone wrong.")
+
+        pool.submit(1, 'a', 'share', fail)
+        self.submit(pool, 2, 'a', 'share')
+        assert wait_until(lambda: self.started == [2])
+
+    def test_parallel_map(self):
+        running = [0]
+        most = [0]
+        lock = threading.Lock()
+
+        def work(item):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            if item == 2:
+                raise ValueError(item)
+
+        self.assertRaises(ValueError, parallel_map, work, list(range(8)), 3)
+        assert most[0] == 3
+        assert running[0] == 0
+
+        done = []
+        parallel_map(done.append, [1, 2, 3], workers=1)
+        assert done == [1, 2, 3]
+
+
+class FakeMountFS(AbstractMountFS):
+    """ Stands in for CIFSMountFS, recording mounts and unmounts. """
+
+    mounted = []
+    unmounted = []
+    fail = False
+    # Event that mounts wait for, if set
+    gate = None
+
+    def __init__(self, username, password, remote_addr, remote_port,
+                 remote_path, local_path):
+        super(FakeMountFS, self).__init__()
+        self.local_path = local_path
+        self.attached = False
+
+    def mount(self):
+        if FakeMountFS.gate is not None:
+            FakeMountFS.gate.wait(10)
+        if FakeMountFS.fail:
+            raise IOError("Host is down.")
+        self.attached = True
+        FakeMountFS.mounted.append(self.local_path)
+
+    def unmount(self):
+        self.attached = False
+        FakeMountFS.unmounted.append(self.local_path)
+
+    def is_mounted(self):
+        return self.attached
+
+
+class MountPoolTestCase(unittest.TestCase):
+    """
+    Test sharing mounts between jobs.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        FakeMountFS.mounted = []
+        FakeMountFS.unmounted = []
+        FakeMountFS.fail = False
+        FakeMountFS.gate = None
+        self.pool = MountPool(FakeMountFS, idle_timeout=300,
+                              mount_dir=self.scratch)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def fs(self, username='testuser'):
+        return self.pool(username=username, password='testpassword',
+                         remote_addr='winshare01', remote_port=445,
+                         remote_path='F:/teachers')
+
+    def test_shared_mount(self):
+        first, second = self.fs(), self.fs()
+        first.mount()
+        second.mount()
+        assert first.local_path == second.local_path
+        assert os.path.isdir(first.local_path)
+        assert len(FakeMountFS.mounted) == 1
+
+        local_path = first.local_path
+        first.unmount()
+        first.unmount()
+        # Still used by the second job
+        assert self.pool.evict_idle(time.time() + 3600) == 0
+        second.unmount()
+        assert self.pool.evict_idle(time.time() + 3600) == 1
+        assert FakeMountFS.unmounted == [local_path]
+        assert not os.path.exists(local_path)
+        assert len(self.pool) == 0
+
+    def test_credentials_are_not_shared(self):
+        first, second = self.fs(), self.fs(username='otheruser')
+        first.mount()
+        second.mount()
+        assert first.local_path != second.local_path
+        assert len(self.pool) == 2
+
+    def test_idle_mount_is_reused(self):
+        fs = self.fs()
+        fs.mount()
+        fs.unmount()
+        assert self.pool.evict_idle(time.time() + 10) == 0
+        fs.mount()
+        assert len(FakeMountFS.mounted) == 1
+        fs.unmount()
+        self.pool.close()
+        assert len(FakeMountFS.unmounted) == 1
+
+    def test_stale_mount_is_remounted(self):
+        fs = self.fs()
+        fs.mount()
+        stale = fs.local_path
+        self.pool._mounts[fs.key].fs.attached = False
+        other = self.fs()
+        other.mount()
+        assert other.local_path != stale
+        assert not os.path.exists(stale)
+        assert len(FakeMountFS.mounted) == 2
+
+    def test_failed_mount(self):
+        FakeMountFS.fail = True
+        fs = self.fs()
+        self.assertRaises(IOError, fs.mount)
+        assert fs.local_path is None
+        assert len(self.pool) == 0
+        assert os.listdir(self.scratch) == []
+        # Unmounting a job that never mounted changes nothing
+        fs.unmount()
+
+        FakeMountFS.fail = False
+        fs.mount()
+        assert len(FakeMountFS.mounted) == 1
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    """
+    Test deferring jobs the repository or the host has no room for.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.io_pressure = admission.io_pressure
+
+    def tearDown(self):
+        admission.io_pressure = self.io_pressure
+        shutil.rmtree(self.scratch)
+
+    def write(self, relpath, content):
+        path = os.path.join(self.scratch, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def session(self, repository, label, growth):
+        self.write(os.path.join(repository, 'rdiff-backup-data',
+                                'session_statistics.{}.data'.format(label)),
+                   "StartTime {}.00 (Wed Mar 18 01:00:00 2015)\n"
+                   "TotalDestinationSizeChange {} ({} bytes)\n"
+                   .format(label, growth, growth))
+
+    def test_expected_growth(self):
+        assert expected_growth(os.path.join(self.scratch, 'none')) == 0
+        for label, growth in enumerate([500, 100, 200, 300, 400, 50]):
+            self.session('1', 1000 + label, growth)
+        # The largest of the last five sessions
+        assert expected_growth(os.path.join(self.scratch, '1')) == 400
+
+        self.session(os.path.join('2', 'shard-0'), 1000, 100)
+        self.session(os.path.join('2', 'shard-1'), 1000, 250)
+        assert expected_growth(os.path.join(self.scratch, '2')) == 350
+
+    def test_admit_reserves_space(self):
+        gb = 2 ** 30
+        for backup_id in ('1', '2', '3'):
+            self.session(backup_id, 1000, gb)
+        free = admission.free_bytes(self.scratch)
+        # Room for two jobs, with half a job to spare for other writes
+        controller = AdmissionController(self.scratch,
+                                         min_free_bytes=free - 5 * gb // 2,
+                                         growth_factor=1)
+        for backup_id in ('1', '2'):
+            assert controller.admit(backup_id, os.path.join(
+                self.scratch, backup_id)) is None
+        repository = os.path.join(self.scratch, '3')
+        assert controller.admit('3', repository).startswith(
+            "Not enough free space")
+        controller.release('1')
+        controller.release('1')
+        assert controller.admit('3', repository) is None
+
+    def test_io_pressure(self):
+        path = self.write('io', "some avg10=12.50 avg60=3.00 avg300=1.00 "
+                                "total=100\n"
+                                "full avg10=2.00 avg60=1.00 avg300=0.50 "
+                                "total=50\n")
+        assert io_pressure(path) == 12.5
+        assert io_pressure(os.path.join(self.scratch, 'missing')) is None
+        assert io_pressure(self.write('bad', "some avg10\n")) is None
+
+    def test_admit_without_io_pressure(self):
+        controller = AdmissionController(self.scratch, max_io_pressure=10)
+        repository = os.path.join(self.scratch, '1')
+        # Kernels without pressure stall information never defer a job
+        admission.io_pressure = lambda: None
+        assert controller.admit('1', repository) is None
+        controller.release('1')
+        admission.io_pressure = lambda: 50.0
+        assert controller.admit('1', repository).startswith(
+            "Host I/O pressure is too high")
+
+
+class PrestagerTestCase(BaseTestCase):
+    """
+    Test mounting the shares of upcoming backups ahead of time.
+    """
+    def setUp(self):
+        super(PrestagerTestCase, self).setUp()
+        self.scratch = tempfile.mkdtemp()
+        FakeMountFS.mounted = []
+        FakeMountFS.unmounted = []
+        FakeMountFS.fail = False
+        FakeMountFS.gate = None
+        self.mounts = MountPool(FakeMountFS, idle_timeout=300,
+                                mount_dir=self.scratch)
+        self.prestager = Prestager(self.mounts, lookahead=300)
+        self.backup = Backup(name='Teachers Backup', server='winshare01',
+                             port=445, protocol=Backup.PROTOCOL.SMB,
+                             location='F:/teachers', username='testuser',
+                             password='testpassword', start_time=1,
+                             start_day=Backup.DAY.SUNDAY,
+                             interval=Backup.INTERVAL.DAILY, retention=14)
+        db.session.add(self.backup)
+        db.session.commit()
+        self.key = ('testuser', 'testpassword', 'winshare01', 445,
+                    'F:/teachers')
+        self.deadline = datetime.datetime.now() + \
+            datetime.timedelta(seconds=60)
+
+    def tearDown(self):
+        super(PrestagerTestCase, self).tearDown()
+        if FakeMountFS.gate is not None:
+            FakeMountFS.gate.set()
+        shutil.rmtree(self.scratch)
+        Backup.query.delete()
+        db.session.commit()
+
+    def staged(self):
+        return wait_until(
+            lambda: self.prestager._staged.get(self.backup.id) is not None)
+
+    def users(self):
+        mount = self.mounts._mounts.get(self.key)
+        return mount.users if mount is not None else 0
+
+    def test_stage_overlaps_running_job(self):
+        # The previous backup of the share is still running
+        running = self.mounts(*self.key)
+        running.mount()
+        self.prestager.stage(self.backup.id, self.deadline)
+        assert self.staged()
+        assert self.users() == 2
+        assert len(FakeMountFS.mounted) == 1
+
+        # The share stays mounted between the two backups
+        running.unmount()
+        assert self.mounts.evict_idle(time.time() + 3600) == 0
+        self.prestager.release(self.backup.id)
+        assert self.users() == 0
+
+    def test_release_while_staging(self):
+        FakeMountFS.gate = threading.Event()
+        self.prestager.stage(self.backup.id, self.deadline)
+        assert wait_until(lambda: self.users() == 1)
+        # The backup was dropped before its share was mounted
+        self.prestager.release(self.backup.id)
+        FakeMountFS.gate.set()
+        assert wait_until(lambda: FakeMountFS.mounted)
+        assert wait_until(lambda: self.users() == 0)
+        assert self.backup.id not in self.prestager._staged
+
+    def test_expire(self):
+        self.prestager.stage(self.backup.id, self.deadline)
+        assert self.staged()
+        self.prestager.expire(self.deadline)
+        assert self.users() == 1
+        self.prestager.expire(self.deadline + datetime.timedelta(seconds=300))
+        assert self.users() == 0
+        assert self.backup.id not in self.prestager._staged
+
+    def test_failed_staging(self):
+        FakeMountFS.fail = True
+        self.prestager.stage(self.backup.id, self.deadline)
+        assert self.staged()
+        assert self.prestager._staged[self.backup.id][0] is None
+        assert len(self.mounts) == 0
+        db.session.refresh(self.backup)
+        assert self.backup.error_message.startswith("Pre-staging failed")
+        # Not retried until the backup is released
+        FakeMountFS.fail = False
+        self.prestager.stage(self.backup.id, self.deadline)
+        assert FakeMountFS.mounted == []
+
+
+class OutputTailTestCase(unittest.TestCase):
+    """
+    Test keeping the end of the output of a command.
+    """
+    def test_tail(self):
+        tail = OutputTail(max_bytes=10)
+        for line in ('first\n', 'second\n', 'third\n'):
+            tail.append(line)
+        assert str(tail) == 'third\n'
+        tail.append('x')
+        assert str(tail) == 'third\nx'
+
+    def test_long_line(self):
+        tail = OutputTail(max_bytes=10)
+        tail.append('short\n')
+        tail.append('a line longer than the tail\n')
+        # The last line is kept whole
+        assert str(tail) == 'a line longer than the tail\n'
+
+
+class ProcessTestCase(unittest.TestCase):
+    """
+    Test running commands as subprocesses.
+    """
+    def test_output_and_status(self):
+        lines = []
+        process = Process("sh -c 'echo out; echo err >&2; exit 3'")
+        status, out, err = process.run(
+            on_line=lambda stream, line: lines.append((stream, line)))
+        assert (status, out, err) == (3, 'out\n', 'err\n')
+        assert sorted(lines) == [('stderr', 'err\n'), ('stdout', 'out\n')]
+
+    def test_streamed_output(self):
+        count = [0]
+
+        def on_line(stream, line):
+            assert line == 'y\n'
+            count[0] += 1
+
+        process = Process("sh -c 'yes | head -n 100000'")
+        status, out, _ = process.run(on_line)
+        assert status == 0
+        assert count[0] == 100000
+        # Only the tail of the output is kept
+        assert len(out) <= TAIL_BYTES
+        assert out.endswith('y\ny\n')
+
+    def test_long_lines_are_split(self):
+        lines = []
+        process = Process(
+            "sh -c \"head -c 200000 /dev/zero | tr '\\\\0' x\"")
+        status, _, _ = process.run(lambda stream, line: lines.append(line))
+        assert status == 0
+        assert max(len(line) for line in lines) == LINE_MAX
+        assert sum(len(line) for line in lines) == 200000
+
+    def test_timeout(self):
+        started = time.time()
+        process = Process("sleep 30", timeout=0.2)
+        status, _, _ = process.run()
+        assert status == -15
+        assert process.terminated
+        assert time.time() - started < 10
+
+    def test_kill_after_kill_timeout(self):
+        # The shell and the sleep it starts both ignore SIGTERM
+        process = Process("sh -c \"trap '' TERM; sleep 30; true\"",
+                          timeout=0.2, kill_timeout=0.2)
+        started = time.time()
+        status, _, _ = process.run()
+        assert status == -9
+        assert time.time() - started < 10
+
+    def test_terminate_from_another_thread(self):
+        process = Process("sleep 30")
+        threading.Timer(0.2, process.terminate).start()
+        status, _, _ = process.run()
+        assert status == -15
+        self.assertRaises(ProcessTerminated, process.run)
+
+    def test_usage(self):
+        process = Process("dd if=/dev/zero of=/dev/null bs=1000000 count=1")
+        status, _, _ = process.run()
+        usage = process.usage
+        assert status == usage.exit_code == 0
+        assert usage.program == 'dd'
+        assert usage.wall_time > 0
+        assert usage.user_time is not None
+        assert usage.system_time is not None
+        assert usage.max_rss > 0
+        assert usage.read_chars >= 1000000
+        assert usage.write_chars >= 1000000
+        assert 'dd exited with 0' in str(usage)
+
+
+class ShareScannerTestCase(unittest.TestCase):
+    """
+    Test scanning shares for changes.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.share = os.path.join(self.scratch, 'share')
+        os.makedirs(os.path.join(self.share, 'math', 'grades'))
+        for relpath in ('a.txt', os.path.join('math', 'b.txt'),
+                        os.path.join('math', 'grades', 'c.txt')):
+            with open(os.path.join(self.share, relpath), 'w') as f:
+                f.write(relpath)
+        self.lstat_entries = scan._lstat_entries
+
+    def tearDown(self):
+        scan._lstat_entries = self.lstat_entries
+        shutil.rmtree(self.scratch)
+
+    def scan(self):
+        """ Scans the share, failing rather than waiting forever. """
+        results = []
+        scanner = threading.Thread(target=lambda: results.append(
+            ShareScanner(self.share, workers=4).scan()))
+        scanner.daemon = True
+        scanner.start()
+        scanner.join(10)
+        assert not scanner.is_alive()
+        return results[0]
+
+    def test_scan(self):
+        result = self.scan()
+        assert result.complete
+        assert sorted(result.entries) == \
+            ['a.txt', 'math', os.path.join('math', 'b.txt'),
+             os.path.join('math', 'grades'),
+             os.path.join('math', 'grades', 'c.txt')]
+        assert result.entries['a.txt'][0] == len('a.txt')
+
+    def test_compare(self):
+        previous = self.scan().entries
+        with open(os.path.join(self.share, 'a.txt'), 'w') as f:
+            f.write('changed')
+        os.remove(os.path.join(self.share, 'math', 'b.txt'))
+        result = self.scan()
+        result.compare(previous)
+        assert 'a.txt' in result.changed
+        assert result.deleted == [os.path.join('math', 'b.txt')]
+        assert not result.unchanged
+
+        result = self.scan()
+        result.compare(result.entries)
+        assert result.unchanged
+
+    def test_listing_error(self):
+        def lstat_entries(directory):
+            if directory.endswith('grades'):
+                # Not an OSError, as from an undecodable file name
+                raise UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid')
+            return self.lstat_entries(directory)
+
+        scan._lstat_entries = lstat_entries
+        result = self.scan()
+        assert not result.complete
+        assert [path for path, _ in result.errors] == \
+            [os.path.join('math', 'grades')]
+        result.compare(result.entries)
+        assert not result.unchanged
+
+
+class ScanIndexTestCase(unittest.TestCase):
+    """
+    Test storing the index of the last backup's scan.
+    """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.index = ScanIndex(os.path.join(self.scratch, 'scan', '1.json.gz'))
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_save_load(self):
+        assert self.index.load() is None
+        entries = {'a.txt': (5, 1.5), 'math': (4096, 2.0)}
+        self.index.save(entries)
+        assert self.index.load() == entries
+
+    def test_delete(self):
+        self.index.save({'a.txt': (5, 1.5)})
+        self.index.delete()
+        assert self.index.load() is None
+        self.index.delete()
+
+    def test_corrupt_index(self):
+        os.makedirs(os.path.dirname(self.index.path))
+        with open(self.index.path, 'wb') as f:
+            f.write(b'not gzip')
+        assert self.index.load() is None
+
+
+def becomes_stopped(pid, stopped=True):
+    """
+    Returns True if a process is, or within a second becomes, stopped or
+    running as given. Signals are not delivered at once.
+    """
+    for _ in range(100):
+        with open('/proc/{}/stat'.format(pid)) as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+        if (state in 'Tt') == stopped:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Test the token buckets of the throttle.
+    """
+    def test_consume_and_refill(self):
+        bucket = TokenBucket(100, now=0)
+        bucket.consume(150)
+        assert bucket.exhausted
+        bucket.refill(0.25)
+        assert bucket.tokens == -25
+        bucket.refill(1.0)
+        assert not bucket.exhausted
+        # The burst is one second of tokens
+        bucket.refill(10.0)
+        assert bucket.tokens == 100
+
+    def test_unlimited(self):
+        bucket = TokenBucket(None, now=0)
+        bucket.consume(10 ** 12)
+        bucket.refill(1.0)
+        assert not bucket.exhausted
+
+
+class ThrottleTestCase(unittest.TestCase):
+    """
+    Test the schedule, in-process charges and pausing of processes.
+    """
+    def setUp(self):
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            os.killpg(process.pid, 9)
+            process.wait()
+
+    def at(self, hour):
+        return datetime.datetime(2015, 3, 18, hour)
+
+    def test_limits(self):
+        throttle = Throttle([(8, 17, 100, 25), (22, 6, 400, 100)])
+        assert throttle.limits(self.at(8)) == (100, 25)
+        assert throttle.limits(self.at(17)) == (100, 25)
+        assert throttle.limits(self.at(23)) == (400, 100)
+        assert throttle.limits(self.at(0)) == (400, 100)
+        assert throttle.limits(self.at(6)) == (400, 100)
+        assert throttle.limits(self.at(7)) == (None, None)
+        assert throttle.limits(self.at(20)) == (None, None)
+
+    def test_charge_sleeps_off_debt(self):
+        throttle = Throttle([(0, 23, 1000, None)])
+        started = time.time()
+        throttle.charge('winshare01', 200)
+        assert time.time() - started >= 0.1
+
+        throttle = Throttle([])
+        started = time.time()
+        throttle.charge('winshare01', 10 ** 9)
+        assert time.time() - started < 0.1
+
+    def spawn(self):
+        process = subprocess.Popen(['sleep', '30'], preexec_fn=os.setsid)
+        self.processes.append(process)
+        return process.pid
+
+    def test_sample(self):
+        throttle = Throttle([])
+        throttle.register(os.getpid(), 'WinShare01')
+        process = throttle._processes[os.getpid()]
+        assert process.server == 'winshare01'
+        with open(__file__, 'rb') as f:
+            size = len(f.read())
+        assert process.sample() >= size
+        throttle.unregister(os.getpid())
+
+    def test_pause_and_resume(self):
+        pid = self.spawn()
+        throttle = Throttle([(0, 23, 1000, None)])
+        throttle.register(pid, 'winshare01')
+        process = throttle._processes[pid]
+        transferred = [5000]
+        process.sample = lambda: transferred.pop() if transferred else 0
+
+        now = time.time()
+        throttle.tick(now)
+        assert process.paused
+        assert becomes_stopped(pid)
+        # The debt takes five seconds to pay off at 1000 bytes per second
+        throttle.tick(now + 2)
+        assert process.paused
+        throttle.tick(now + 5)
+        assert not process.paused
+        assert becomes_stopped(pid, stopped=False)
+
+    def test_unregister_resumes(self):
+        pid = self.spawn()
+        throttle = Throttle([(0, 23, 1000, None)])
+        throttle.register(pid, 'winshare01')
+        throttle._processes[pid].sample = lambda: 5000
+        throttle.tick(time.time())
+        assert becomes_stopped(pid)
+        throttle.unregister(pid)
+        assert becomes_stopped(pid, stopped=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
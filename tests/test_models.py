@@ -1,11 +1,14 @@
+import datetime
 import os
+import sqlite3
 import tempfile
 import unittest
 
 from flask.ext.bcrypt import Bcrypt
 
 from app import app, db
-from app.models import Backup
+from app.catalog import Catalog
+from app.models import Backup, BackupRun, BackupRunProcess, Restore
 
 bcrypt = Bcrypt(app)
 
@@ -61,6 +64,54 @@ class BackupModelTestCase(BaseTestCase):
         assert b.status == Backup.STATUS.RUNNING
         assert b.error_message == ''
 
+    def test_backup_cancelled(self):
+        b = Backup(name='Teachers Backup', server='winshare01', port=445,
+                   protocol=Backup.PROTOCOL.SMB, location='F:/teachers',
+                   username='testuser', password='testpassword',
+                   start_time=1, start_day=Backup.DAY.SUNDAY, interval=24,
+                   retention=24)
+        b.started()
+        b.cancel_requested = True
+        b.cancelled("Cancelled by user.")
+        assert not b.cancel_requested
+        assert b.status == Backup.STATUS.CANCELLED
+        assert b.error_message == "Cancelled by user."
+
+    def test_backup_pruned(self):
+        b = Backup(name='Teachers Backup', server='winshare01', port=445,
+                   protocol=Backup.PROTOCOL.SMB, location='F:/teachers',
+                   username='testuser', password='testpassword',
+                   start_time=1, start_day=Backup.DAY.SUNDAY, interval=24,
+                   retention=24)
+        assert not b.last_pruned
+        b.pruned(1024)
+        assert b.last_pruned
+        assert b.pruned_bytes == 1024
+
+    def test_backup_verified(self):
+        b = Backup(name='Teachers Backup', server='winshare01', port=445,
+                   protocol=Backup.PROTOCOL.SMB, location='F:/teachers',
+                   username='testuser', password='testpassword',
+                   start_time=1, start_day=Backup.DAY.SUNDAY, interval=24,
+                   retention=24)
+        now = datetime.datetime.now()
+        assert b.verify_due(now)
+        b.verified(100, 5, [], 3600)
+        assert b.verify_status == Backup.VERIFY.PASSED
+        assert b.last_verified
+        assert not b.verify_due(now)
+        assert b.verify_due(now + datetime.timedelta(hours=2))
+
+    def test_backup_verify_failed(self):
+        b = Backup(name='Teachers Backup', server='winshare01', port=445,
+                   protocol=Backup.PROTOCOL.SMB, location='F:/teachers',
+                   username='testuser', password='testpassword',
+                   start_time=1, start_day=Backup.DAY.SUNDAY, interval=24,
+                   retention=24)
+        b.verified(100, 5, ['a.txt: SHA-1 digest does not match.'], 3600)
+        assert b.verify_status == Backup.VERIFY.FAILED
+        assert 'a.txt' in b.verify_message
+
     def test_backup_never_started(self):
         b = Backup(name='Teachers Backup', server='winshare01', port=445,
                    protocol=Backup.PROTOCOL.SMB, location='F:/teachers',
@@ -71,5 +122,313 @@ class BackupModelTestCase(BaseTestCase):
         assert b.error_message == ''
 
 
+class BackupScheduleTestCase(BaseTestCase):
+    """
+    Test the schedule of the Backup database model.
+    """
+    # Wednesday, 2015-03-18 10:30
+    now = datetime.datetime(2015, 3, 18, 10, 30)
+
+    def new_backup(self, start_time, start_day, interval):
+        return Backup(name='Teachers Backup', server='winshare01', port=445,
+                      protocol=Backup.PROTOCOL.SMB, location='F:/teachers',
+                      username='testuser', password='testpassword',
+                      start_time=start_time, start_day=start_day,
+                      interval=interval, retention=14)
+
+    def test_daily_later_today(self):
+        b = self.new_backup(22, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 3, 18, 22)
+
+    def test_daily_tomorrow(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 3, 19, 1)
+
+    def test_daily_midnight(self):
+        b = self.new_backup(24, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 3, 19, 0)
+
+    def test_weekly(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, Backup.INTERVAL.WEEKLY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 3, 22, 1)
+
+    def test_weekly_same_day_passed(self):
+        b = self.new_backup(1, Backup.DAY.WEDNESDAY, Backup.INTERVAL.WEEKLY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 3, 25, 1)
+
+    def test_monthly(self):
+        b = self.new_backup(1, Backup.DAY.MONDAY, Backup.INTERVAL.MONTHLY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 4, 6, 1)
+
+    def test_weekly_same_day_later(self):
+        b = self.new_backup(22, Backup.DAY.WEDNESDAY, Backup.INTERVAL.WEEKLY)
+        assert b.next_run_after(self.now) == \
+            datetime.datetime(2015, 3, 18, 22)
+
+    def test_weekly_across_month(self):
+        b = self.new_backup(1, Backup.DAY.TUESDAY, Backup.INTERVAL.WEEKLY)
+        now = datetime.datetime(2015, 3, 31, 2)
+        assert b.next_run_after(now) == datetime.datetime(2015, 4, 7, 1)
+
+    def test_monthly_later_this_month(self):
+        b = self.new_backup(1, Backup.DAY.FRIDAY, Backup.INTERVAL.MONTHLY)
+        now = datetime.datetime(2015, 3, 1)
+        assert b.next_run_after(now) == datetime.datetime(2015, 3, 6, 1)
+
+    def test_monthly_same_day_passed(self):
+        # The first Monday of February 2016 is the 1st
+        b = self.new_backup(1, Backup.DAY.MONDAY, Backup.INTERVAL.MONTHLY)
+        now = datetime.datetime(2016, 2, 1, 10, 30)
+        assert b.next_run_after(now) == datetime.datetime(2016, 3, 7, 1)
+
+    def test_monthly_december(self):
+        b = self.new_backup(1, Backup.DAY.FRIDAY, Backup.INTERVAL.MONTHLY)
+        now = datetime.datetime(2015, 12, 20)
+        assert b.next_run_after(now) == datetime.datetime(2016, 1, 1, 1)
+
+    def test_invalid_interval(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, 24)
+        assert b.next_run_after(self.now) is None
+        assert not b.is_due(self.now)
+
+    def test_new_backup_is_scheduled(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        assert b.next_run_at > datetime.datetime.now()
+
+    def test_due(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        b.schedule_next_run(self.now)
+        assert not b.is_due(self.now)
+        assert b.is_due(datetime.datetime(2015, 3, 19, 1))
+
+    def test_disabled_is_not_scheduled(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        b.enabled = False
+        b.start_now = True
+        b.schedule_next_run(self.now)
+        assert b.next_run_at is None
+        assert not b.is_due(self.now)
+
+    def test_started_moves_next_run(self):
+        b = self.new_backup(1, Backup.DAY.SUNDAY, Backup.INTERVAL.DAILY)
+        b.next_run_at = datetime.datetime(2015, 3, 18, 1)
+        b.started()
+        assert b.next_run_at > datetime.datetime.now()
+
+
+class BackupLeaseTestCase(BaseTestCase):
+    """
+    Test claiming leases of backup jobs.
+    """
+    def setUp(self):
+        super(BackupLeaseTestCase, self).setUp()
+        self.backup = Backup(name='Teachers Backup', server='winshare01',
+                             port=445, protocol=Backup.PROTOCOL.SMB,
+                             location='F:/teachers', username='testuser',
+                             password='testpassword', start_time=1,
+                             start_day=Backup.DAY.SUNDAY,
+                             interval=Backup.INTERVAL.DAILY, retention=14)
+        db.session.add(self.backup)
+        db.session.commit()
+
+    def tearDown(self):
+        super(BackupLeaseTestCase, self).tearDown()
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_claim_free_lease(self):
+        assert Backup.claim(self.backup.id, 'runner-a', 60)
+        db.session.commit()
+        db.session.refresh(self.backup)
+        assert self.backup.lease_owner == 'runner-a'
+        assert self.backup.lease_expires > datetime.datetime.now()
+
+    def test_claim_held_lease(self):
+        assert Backup.claim(self.backup.id, 'runner-a', 60)
+        assert not Backup.claim(self.backup.id, 'runner-b', 60)
+        assert Backup.claim(self.backup.id, 'runner-a', 60)
+
+    def test_claim_expired_lease(self):
+        past = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        assert Backup.claim(self.backup.id, 'runner-a', 60, now=past)
+        assert Backup.claim(self.backup.id, 'runner-b', 60)
+
+    def test_release_lease(self):
+        assert Backup.claim(self.backup.id, 'runner-a', 60)
+        Backup.release(self.backup.id, 'runner-b')
+        assert not Backup.claim(self.backup.id, 'runner-b', 60)
+        Backup.release(self.backup.id, 'runner-a')
+        assert Backup.claim(self.backup.id, 'runner-b', 60)
+
+    def test_renew_leases(self):
+        assert Backup.claim(self.backup.id, 'runner-a', 60)
+        assert Backup.renew_leases([self.backup.id], 'runner-a', 60) == 1
+        assert Backup.renew_leases([self.backup.id], 'runner-b', 60) == 0
+
+    def test_expired_running_job_is_due(self):
+        now = datetime.datetime.now()
+        self.backup.started()
+        self.backup.lease_owner = 'runner-a'
+        self.backup.lease_expires = now + datetime.timedelta(seconds=60)
+        assert not self.backup.is_due(now)
+        self.backup.lease_expires = now - datetime.timedelta(seconds=1)
+        assert self.backup.is_due(now)
+
+
+class RestoreModelTestCase(BaseTestCase):
+    """
+    Test the restore model.
+    """
+    def setUp(self):
+        super(RestoreModelTestCase, self).setUp()
+        self.backup = Backup(name='Teachers Backup', server='winshare01',
+                             port=445, protocol=Backup.PROTOCOL.SMB,
+                             location='F:/teachers', username='testuser',
+                             password='testpassword', start_time=1,
+                             start_day=Backup.DAY.SUNDAY, interval=24,
+                             retention=24)
+
+    def test_restore_queued(self):
+        r = Restore(backup=self.backup, path='/math', time_format='now')
+        assert r.status == Restore.STATUS.QUEUED
+        assert r.requested_at
+        assert r.progress == 0
+
+    def test_restore_progress(self):
+        r = Restore(backup=self.backup, path='/math', time_format='now')
+        r.started()
+        assert r.status == Restore.STATUS.RUNNING
+        r.progressed(25, 100)
+        assert r.progress == 25
+        r.finished()
+        assert r.status == Restore.STATUS.FINISHED
+        assert r.progress == 100
+
+    def test_restore_failed(self):
+        r = Restore(backup=self.backup, path='/math', time_format='now')
+        r.started()
+        r.failed("Restore was terminated.")
+        assert r.status == Restore.STATUS.ERROR
+        assert r.error_message == "Restore was terminated."
+
+
+class BackupRunModelTestCase(BaseTestCase):
+    """
+    Test the backup run model.
+    """
+    def setUp(self):
+        super(BackupRunModelTestCase, self).setUp()
+        self.backup = Backup(name='Teachers Backup', server='winshare01',
+                             port=445, protocol=Backup.PROTOCOL.SMB,
+                             location='F:/teachers', username='testuser',
+                             password='testpassword', start_time=1,
+                             start_day=Backup.DAY.SUNDAY, interval=24,
+                             retention=24)
+
+    def tearDown(self):
+        super(BackupRunModelTestCase, self).tearDown()
+        BackupRunProcess.query.delete()
+        BackupRun.query.delete()
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_backup_run_finished(self):
+        run = BackupRun(backup=self.backup)
+        assert run.status == BackupRun.STATUS.RUNNING
+        run.finished({'SourceFiles': 10, 'SourceFileSize': 1000,
+                      'NewFiles': 1, 'NewFileSize': 100, 'ChangedFiles': 2,
+                      'ChangedSourceSize': 200, 'IncrementFileSize': 50,
+                      'Errors': 0})
+        assert run.status == BackupRun.STATUS.FINISHED
+        assert run.duration is not None
+        assert run.source_files == 10
+        assert run.changed_files == 3
+        assert run.changed_bytes == 300
+        assert run.increment_bytes == 50
+
+    def test_backup_run_failed(self):
+        run = BackupRun(backup=self.backup)
+        run.failed("Something has gone wrong.")
+        assert run.status == BackupRun.STATUS.ERROR
+        assert run.error_message == "Something has gone wrong."
+        assert run.changed_bytes is None
+        assert run.throughput is None
+
+    def test_backup_run_used(self):
+        class Usage(object):
+            def __init__(self, program, user_time, read_chars, write_bytes):
+                self.program = program
+                self.started_at = datetime.datetime.now()
+                self.exit_code = 0
+                self.wall_time = 10.0
+                self.user_time = user_time
+                self.system_time = 1.0
+                self.max_rss = 1024
+                self.read_chars = read_chars
+                self.write_chars = write_bytes
+                self.read_bytes = 0
+                self.write_bytes = write_bytes
+
+        run = BackupRun(backup=self.backup)
+        assert run.cpu_time is None
+        run.used([Usage('mount', 0.5, 100, 0),
+                  Usage('rdiff-backup', 5.5, 1000, 400)])
+        run.finished()
+        db.session.add(run)
+        db.session.commit()
+        assert [p.program for p in run.processes] == ['mount', 'rdiff-backup']
+        assert run.cpu_time == 8.0
+        assert run.read_chars == 1100
+        assert run.write_bytes == 400
+
+
+class CatalogTestCase(unittest.TestCase):
+    """
+    Test the file catalog of a backup.
+    """
+    def setUp(self):
+        self.catalog_fd, self.catalog_path = tempfile.mkstemp()
+        self.catalog = Catalog(self.catalog_path)
+
+    def tearDown(self):
+        self.catalog.close()
+        os.close(self.catalog_fd)
+        os.unlink(self.catalog_path)
+
+    def test_catalog_history(self):
+        self.catalog.add_increment(1, [('math/grades.xls', 10, 1.0)])
+        self.catalog.add_increment(2, [('math/grades.xls', 10, 1.0)])
+        self.catalog.add_increment(3, [('math/grades.xls', 20, 3.0)])
+        self.catalog.add_increment(4, [])
+        history = self.catalog.history('math/grades.xls')
+        assert [size for _, size, _ in history] == [10, 10, 20]
+        assert self.catalog.search('grades') == ['math/grades.xls']
+
+    def test_catalog_remove_before(self):
+        self.catalog.add_increment(1, [('math/old.xls', 10, 1.0)])
+        self.catalog.add_increment(2, [('math/new.xls', 10, 2.0)])
+        self.catalog.remove_before(2)
+        assert self.catalog.increments() == [2]
+        assert self.catalog.search('old') == []
+
+    def test_catalog_read_only(self):
+        self.catalog.add_increment(1, [('math/grades.xls', 10, 1.0)])
+        catalog = Catalog(self.catalog_path, read_only=True)
+        try:
+            assert [time for _, time, _ in catalog.restore_points()] == [1]
+            assert catalog.fts == self.catalog.fts
+            self.assertRaises(sqlite3.DatabaseError, catalog.add_increment,
+                              2, [('math/grades.xls', 20, 2.0)])
+        finally:
+            catalog.close()
+        assert self.catalog.increments() == [1]
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
+import logging
 import os
 import random
+import shutil
 import string
 import tempfile
 import unittest
@@ -7,7 +9,9 @@ import unittest
 from flask.ext.bcrypt import Bcrypt
 
 from app import app, db
-from app.models import Backup, User
+from app.catalog import catalog_for
+from app.models import Backup, BackupRun, Restore, User
+from app.wakeup import WakeupListener
 
 bcrypt = Bcrypt(app)
 
@@ -29,8 +33,9 @@ class BaseTestCase(unittest.TestCase):
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])
 
-        # Delete all users
+        # Delete all users and backups
         User.query.delete()
+        Backup.query.delete()
         db.session.commit()
 
     def create_test_user(self, email, password):
@@ -175,6 +180,92 @@ class CreateBackupTestCase(BaseAuthenticatedTestCase):
         assert resp.status_code == 200
         assert Backup.query.count() == 1
 
+    def test_create_backup_schedules_next_run(self):
+        """ Test that a new backup job is scheduled to run. """
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+        }
+        self.app.post('/backups/new', data=data, follow_redirects=True)
+        backup = Backup.query.first()
+        assert backup.next_run_at is not None
+        assert backup.next_run_at.hour == 1
+        assert not backup.should_start
+
+    def test_create_backup_with_shards(self):
+        """ Test creating a new backup job split into shards. """
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+            'shards': 4,
+        }
+        resp = self.app.post('/backups/new', data=data, follow_redirects=True)
+        assert resp.status_code == 200
+        assert Backup.query.first().shards == 4
+
+    def test_create_backup_with_dedup_engine(self):
+        """ Test creating a new deduplicated backup job. """
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+            'engine': 2,
+        }
+        resp = self.app.post('/backups/new', data=data, follow_redirects=True)
+        assert resp.status_code == 200
+        assert Backup.query.first().engine == Backup.ENGINE.DEDUP
+
+    def test_create_backup_with_shards_above_maximum(self):
+        """ Test creating a new backup job with too many shards. """
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+            'shards': 33,
+        }
+        resp = self.app.post('/backups/new', data=data, follow_redirects=True)
+        assert resp.status_code == 200
+        assert Backup.query.count() == 0
+        assert 'Number must be between 1 and 32.' in resp.data
+
     def test_create_backup_with_missing_name_setting(self):
         """ Test creating a new backup job with missing name setting. """
         
@@ -499,6 +590,7 @@ class EditBackupTestCase(BaseAuthenticatedTestCase):
     def tearDown(self):
         super(EditBackupTestCase, self).tearDown()
 
+        BackupRun.query.delete()
         Backup.query.delete()
         db.session.commit()
 
@@ -534,6 +626,93 @@ class EditBackupTestCase(BaseAuthenticatedTestCase):
         resp = self.app.post(self.edit_backup_url, data=data, follow_redirects=True)
         assert resp.status_code == 200
 
+    def test_edit_backup_shards(self):
+        """ Test splitting a backup job that has not run into shards. """
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+            'shards': 4,
+        }
+        resp = self.app.post(self.edit_backup_url, data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        assert Backup.query.first().shards == 4
+
+    def test_edit_backup_shards_after_backup(self):
+        """ Test that the shards of a backup job that has run are fixed. """
+
+        self.new_backup.finished()
+        db.session.commit()
+
+        resp = self.app.get(self.edit_backup_url, follow_redirects=True)
+        assert 'disabled="disabled"' in resp.data
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+            'shards': 4,
+        }
+        resp = self.app.post(self.edit_backup_url, data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Cannot be changed once the backup has run.' in resp.data
+        assert Backup.query.first().shards == 1
+
+        # A form without the disabled field keeps the shards
+        del data['shards']
+        resp = self.app.post(self.edit_backup_url, data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        backup = Backup.query.first()
+        assert backup.name == 'Teacher Backups'
+        assert backup.shards == 1
+
+    def test_edit_backup_engine_after_backup(self):
+        """ Test that the engine of a backup job that has run is fixed. """
+
+        run = BackupRun(backup=self.new_backup)
+        db.session.add(run)
+        db.session.commit()
+
+        data = {
+            'name': 'Teacher Backups',
+            'server': '192.168.11.52',
+            'port': 445,
+            'protocol': 1,
+            'location': '/teachers',
+            'username': 'testuser',
+            'password': 'testpass',
+            'start_time': 1,
+            'start_day': 1,
+            'interval': 1,
+            'retention': 14,
+            'engine': 2,
+        }
+        resp = self.app.post(self.edit_backup_url, data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Cannot be changed once the backup has run.' in resp.data
+        assert Backup.query.first().engine == Backup.ENGINE.RDIFF
+
     def test_edit_invalid_backup(self):
         """
         Test editing an invalid backup, or a backup job that doesn't exist.
@@ -1051,6 +1230,22 @@ class StartBackupTestCase(BaseAuthenticatedTestCase):
         assert Backup.query.filter(Backup.id==self.new_backup.id).first()\
             .should_start
 
+    def test_start_backup_wakes_runner(self):
+        """ Test that starting a backup wakes up the runner. """
+        socket_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(socket_dir, 'runner.sock')
+        old_socket_path = app.config['RUNNER_SOCKET']
+        app.config['RUNNER_SOCKET'] = socket_path
+        listener = WakeupListener(socket_path)
+        try:
+            assert not listener.wait(0)
+            self.app.post(self.start_backup_url, follow_redirects=True)
+            assert listener.wait(1)
+        finally:
+            listener.close()
+            os.rmdir(socket_dir)
+            app.config['RUNNER_SOCKET'] = old_socket_path
+
     def test_start_invalid_backup(self):
         """ Test enabling an invalid backup. """
         resp = self.app.get('/backups/start/12345', follow_redirects=True)
@@ -1060,6 +1255,69 @@ class StartBackupTestCase(BaseAuthenticatedTestCase):
         assert resp.status_code == 404
 
 
+class CancelBackupTestCase(BaseAuthenticatedTestCase):
+    """ Test cancelling running backup jobs. """
+
+    def setUp(self):
+        super(CancelBackupTestCase, self).setUp()
+
+        # New Backup object for each test
+        self.new_backup = Backup(name='Teachers Backup', server='winshare01', 
+                                 port=445, protocol=Backup.PROTOCOL.SMB,
+                                 location='F:/teachers',
+                                 username='testuser', password='password',
+                                 start_time=1,
+                                 start_day=Backup.DAY.SUNDAY,
+                                 interval=24, retention=14)
+
+        db.session.add(self.new_backup)
+        db.session.commit()
+
+        # URL for cancelling the newly created Backup object
+        self.cancel_backup_url = "/backups/cancel/{}".format(self.new_backup.id)
+
+    def tearDown(self):
+        super(CancelBackupTestCase, self).tearDown()
+
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_cancel_running_backup(self):
+        """ Test cancelling a running backup. """
+
+        self.new_backup.started()
+        db.session.commit()
+
+        resp = self.app.get(self.cancel_backup_url, follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Cancel Backup' in resp.data
+
+        resp = self.app.post(self.cancel_backup_url, follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Backup job was scheduled to be cancelled.' in resp.data
+
+        assert Backup.query.filter(Backup.id==self.new_backup.id).first()\
+            .cancel_requested
+
+    def test_cancel_backup_not_running(self):
+        """ Test cancelling a backup that is not running. """
+
+        resp = self.app.post(self.cancel_backup_url, follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Backup job is not running.' in resp.data
+
+        assert not Backup.query.filter(Backup.id==self.new_backup.id)\
+            .first().cancel_requested
+
+    def test_cancel_invalid_backup(self):
+        """ Test cancelling an invalid backup. """
+        resp = self.app.get('/backups/cancel/12345', follow_redirects=True)
+        assert resp.status_code == 404
+
+        resp = self.app.post('/backups/cancel/12345', follow_redirects=True)
+        assert resp.status_code == 404
+
+
 class ListBackupTestCase(BaseAuthenticatedTestCase):
     """ Test listing backup jobs. """
 
@@ -1167,5 +1425,330 @@ class EditAccountTestCase(BaseAuthenticatedTestCase):
         assert 'Invalid Login' not in resp.data
 
 
+class RestoreTestCase(BaseAuthenticatedTestCase):
+    """ Test requesting restores. """
+
+    def setUp(self):
+        super(RestoreTestCase, self).setUp()
+
+        # New Backup object for each test
+        self.new_backup = Backup(name='Teachers Backup', server='winshare01',
+                                 port=445, protocol=Backup.PROTOCOL.SMB,
+                                 location='F:/teachers',
+                                 username='testuser', password='password',
+                                 start_time=1,
+                                 start_day=Backup.DAY.SUNDAY,
+                                 interval=24, retention=14)
+
+        db.session.add(self.new_backup)
+        db.session.commit()
+
+    def tearDown(self):
+        super(RestoreTestCase, self).tearDown()
+
+        Restore.query.delete()
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_restores_page(self):
+        """ Test the restores page. """
+
+        db.session.add(Restore(backup=self.new_backup, path='/math',
+                               time_format='now'))
+        db.session.commit()
+
+        resp = self.app.get('/restore', follow_redirects=True)
+        assert resp.status_code == 200
+        assert '/math' in resp.data
+
+    def test_new_restore(self):
+        """ Test requesting a restore. """
+
+        resp = self.app.get('/restore/new', follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Teachers Backup' in resp.data
+
+        data = {
+            'backup': self.new_backup.id,
+            'path': '/math/grades',
+            'time_format': '3D',
+        }
+        resp = self.app.post('/restore/new', data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Restore was scheduled to start.' in resp.data
+
+        restore = Restore.query.first()
+        assert restore.backup_id == self.new_backup.id
+        assert restore.path == '/math/grades'
+        assert restore.time_format == '3D'
+        assert restore.status == Restore.STATUS.QUEUED
+
+    def test_new_restore_invalid_time(self):
+        """ Test requesting a restore with an invalid point in time. """
+
+        data = {
+            'backup': self.new_backup.id,
+            'path': '/math',
+            'time_format': '3D; rm -rf /',
+        }
+        resp = self.app.post('/restore/new', data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Invalid point in time.' in resp.data
+        assert Restore.query.count() == 0
+
+    def test_new_restore_outside_share(self):
+        """ Test requesting a restore of a path outside of the share. """
+
+        data = {
+            'backup': self.new_backup.id,
+            'path': '/math/../../2',
+            'time_format': 'now',
+        }
+        resp = self.app.post('/restore/new', data=data,
+                             follow_redirects=True)
+        assert resp.status_code == 200
+        assert 'Path is outside of the share.' in resp.data
+        assert Restore.query.count() == 0
+
+    def test_new_restore_time_with_options(self):
+        """ Test that a point in time cannot add rdiff-backup options. """
+
+        for time_format in ('now --remote-schema x', '--force'):
+            data = {
+                'backup': self.new_backup.id,
+                'path': '/math',
+                'time_format': time_format,
+            }
+            resp = self.app.post('/restore/new', data=data,
+                                 follow_redirects=True)
+            assert resp.status_code == 200
+            assert 'Invalid point in time.' in resp.data
+        assert Restore.query.count() == 0
+
+
+class BrowseBackupTestCase(BaseAuthenticatedTestCase):
+    """ Test browsing the contents of a backup. """
+
+    def setUp(self):
+        super(BrowseBackupTestCase, self).setUp()
+
+        self.catalog_dir = tempfile.mkdtemp()
+        app.config['CATALOG_DIR'] = self.catalog_dir
+        app.config['BROWSE_PAGE_SIZE'] = 2
+
+        self.new_backup = Backup(name='Teachers Backup', server='winshare01',
+                                 port=445, protocol=Backup.PROTOCOL.SMB,
+                                 location='F:/teachers',
+                                 username='testuser', password='password',
+                                 start_time=1,
+                                 start_day=Backup.DAY.SUNDAY,
+                                 interval=24, retention=14)
+
+        db.session.add(self.new_backup)
+        db.session.commit()
+
+    def tearDown(self):
+        super(BrowseBackupTestCase, self).tearDown()
+
+        shutil.rmtree(self.catalog_dir)
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_browse_backup_not_catalogued(self):
+        """ Test browsing a backup that has no catalog yet. """
+
+        resp = self.app.get('/backups/browse/{}'.format(self.new_backup.id))
+        assert resp.status_code == 200
+        assert 'Nothing has been catalogued' in resp.data
+
+    def test_browse_backup_pages(self):
+        """ Test browsing a directory one page at a time. """
+
+        catalog = catalog_for(self.new_backup.id)
+        catalog.add_increment(1, [('math', None, 1.0),
+                                  ('math/algebra.doc', 10, 1.0),
+                                  ('math/geometry.doc', 10, 1.0),
+                                  ('math/grades.xls', 10, 1.0)])
+        catalog.close()
+
+        url = '/backups/browse/{}'.format(self.new_backup.id)
+        resp = self.app.get(url + '?path=math')
+        assert resp.status_code == 200
+        assert 'algebra.doc' in resp.data
+        assert 'grades.xls' not in resp.data
+        assert 'Next page' in resp.data
+
+        resp = self.app.get(url + '?path=math&after=geometry.doc')
+        assert resp.status_code == 200
+        assert 'grades.xls' in resp.data
+        assert 'Next page' not in resp.data
+
+    def test_browse_missing_backup(self):
+        """ Test browsing a backup that does not exist. """
+
+        resp = self.app.get('/backups/browse/999')
+        assert resp.status_code == 404
+
+    def test_search_backups(self):
+        """ Test searching the catalogs of the backups for a file. """
+
+        catalog = catalog_for(self.new_backup.id)
+        catalog.add_increment(1, [('math', None, 1.0),
+                                  ('math/grades.xls', 10, 1.0)])
+        catalog.add_increment(2, [('math', None, 1.0),
+                                  ('math/grades.xls', 20, 2.0)])
+        catalog.close()
+
+        resp = self.app.get('/backups/search?q=grades')
+        assert resp.status_code == 200
+        assert 'Teachers Backup' in resp.data
+        assert 'math/grades.xls' in resp.data
+        assert '20 Bytes' in resp.data
+
+        resp = self.app.get('/backups/search?q=report')
+        assert resp.status_code == 200
+        assert 'No catalogued file matches' in resp.data
+
+
+class BackupHistoryTestCase(BaseAuthenticatedTestCase):
+    """ Test the run history of a backup. """
+
+    def setUp(self):
+        super(BackupHistoryTestCase, self).setUp()
+
+        self.new_backup = Backup(name='Teachers Backup', server='winshare01',
+                                 port=445, protocol=Backup.PROTOCOL.SMB,
+                                 location='F:/teachers',
+                                 username='testuser', password='password',
+                                 start_time=1,
+                                 start_day=Backup.DAY.SUNDAY,
+                                 interval=24, retention=14)
+
+        db.session.add(self.new_backup)
+        db.session.commit()
+
+    def tearDown(self):
+        super(BackupHistoryTestCase, self).tearDown()
+
+        BackupRun.query.delete()
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_backup_history(self):
+        """ Test the history page of a backup that has run. """
+
+        run = BackupRun(backup=self.new_backup)
+        run.failed("Share is unreachable.")
+        db.session.add(run)
+        db.session.commit()
+
+        resp = self.app.get('/backups/history/{}'.format(self.new_backup.id))
+        assert resp.status_code == 200
+        assert 'Share is unreachable.' in resp.data
+
+    def test_backup_history_missing_backup(self):
+        """ Test the history page of a backup that does not exist. """
+
+        resp = self.app.get('/backups/history/999')
+        assert resp.status_code == 404
+
+
+class RequestProfilingTestCase(BaseAuthenticatedTestCase):
+    """ Test the profiling of requests. """
+
+    def setUp(self):
+        super(RequestProfilingTestCase, self).setUp()
+
+        self.new_backup = Backup(name='Teachers Backup', server='winshare01',
+                                 port=445, protocol=Backup.PROTOCOL.SMB,
+                                 location='F:/teachers',
+                                 username='testuser', password='password',
+                                 start_time=1,
+                                 start_day=Backup.DAY.SUNDAY,
+                                 interval=24, retention=14)
+
+        db.session.add(self.new_backup)
+        db.session.commit()
+
+        self.slow_log = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: \
+            self.slow_log.append(record.getMessage())
+        logging.getLogger('app.profiling.slow').addHandler(self.handler)
+
+        app.config['PROFILE_REQUESTS'] = True
+        app.config['SLOW_REQUEST_SECONDS'] = 0
+
+    def tearDown(self):
+        app.config['PROFILE_REQUESTS'] = False
+        logging.getLogger('app.profiling.slow').removeHandler(self.handler)
+
+        super(RequestProfilingTestCase, self).tearDown()
+
+        Backup.query.delete()
+        db.session.commit()
+
+    def test_slow_request_log(self):
+        """ Test that slow requests are logged with their statements. """
+
+        resp = self.app.get('/backups/edit/{}'.format(self.new_backup.id))
+        assert resp.status_code == 200
+
+        assert len(self.slow_log) == 1
+        entry = self.slow_log[0]
+        assert entry.startswith(
+            'GET /backups/edit/{} 200'.format(self.new_backup.id))
+        assert 'FROM backup' in entry
+        assert '(0 repeated)' in entry
+
+    def test_requests_not_profiled_by_default(self):
+        """ Test that requests are only profiled when enabled. """
+
+        app.config['PROFILE_REQUESTS'] = False
+
+        self.app.get('/backups/edit/{}'.format(self.new_backup.id))
+        assert self.slow_log == []
+
+
+class MetricsTestCase(BaseTestCase):
+    """
+    Tests related to the metrics endpoint.
+    """
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.metrics_fd, self.metrics_path = tempfile.mkstemp()
+        app.config['RUNNER_METRICS_FILE'] = self.metrics_path
+
+    def tearDown(self):
+        super(MetricsTestCase, self).tearDown()
+        os.close(self.metrics_fd)
+        os.unlink(self.metrics_path)
+
+    def test_metrics(self):
+        """ Test that the metrics are served without logging in. """
+
+        with open(self.metrics_path, 'w') as metrics:
+            metrics.write('storagebright_backups_due 3\n')
+
+        self.app.get('/login')
+        resp = self.app.get('/metrics')
+        assert resp.status_code == 200
+        assert 'endpoint="login"' in resp.data
+        assert 'storagebright_runner_up 1' in resp.data
+        assert 'storagebright_backups_due 3' in resp.data
+
+    def test_metrics_without_runner(self):
+        """ Test the metrics when the runner has not written any. """
+
+        os.utime(self.metrics_path, (0, 0))
+
+        resp = self.app.get('/metrics')
+        assert resp.status_code == 200
+        assert 'storagebright_runner_up 0' in resp.data
+
+
 if __name__ == '__main__':
     unittest.main()